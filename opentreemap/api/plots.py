@@ -12,8 +12,9 @@ from django.contrib.gis.measure import D
 
 from treemap.exceptions import HttpBadRequestException
 
+from treemap.ecobenefits import batch_tree_benefits
 from treemap.views import context_dict_for_plot, update_map_feature
-from treemap.models import Plot
+from treemap.models import Plot, Tree
 
 
 def plots_closest_to_point(request, instance, lat, lng):
@@ -39,13 +40,29 @@ def plots_closest_to_point(request, instance, lat, lng):
                         .filter(instance=instance)\
                         .filter(geom__distance_lte=(point, D(m=distance)))\
                         .order_by('distance')[0:max_plots]
+    plots = list(plots)
+
+    # Get the benefits of every tree at once, rather than letting
+    # context_dict_for_plot ask for them one tree at a time
+    if request.instance_supports_ecobenefits:
+        trees = Tree.objects.filter(plot__in=[p.pk for p in plots])\
+                            .select_related('species', 'plot')\
+                            .order_by('pk')
+        tree_ids = {}
+        for tree in trees:
+            tree_ids.setdefault(tree.plot_id, tree.pk)
+
+        benefits = batch_tree_benefits(request.instance, trees)
+    else:
+        tree_ids, benefits = {}, {}
 
     def ctxt_for_plot(plot):
         return context_dict_for_plot(
             request.instance,
             plot,
             user=request.user,
-            supports_eco=request.instance_supports_ecobenefits)
+            supports_eco=request.instance_supports_ecobenefits,
+            benefits_and_error=benefits.get(tree_ids.get(plot.pk)))
 
     return [ctxt_for_plot(plot) for plot in plots]
 
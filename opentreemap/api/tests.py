@@ -28,8 +28,10 @@ from django.core.urlresolvers import reverse
 from django.core.files import File
 
 from treemap.udf import DATETIME_FORMAT
-from treemap.models import Species, Plot, Tree, User, InstanceUser
+from treemap.models import Species, Plot, Tree, User, InstanceUser, ITreeRegion
 from treemap.audit import ReputationMetric, Audit
+from treemap.cache import get_search_cache
+from treemap import ecobackend, ecobenefits
 from treemap.tests import (make_user, make_commander_user, make_request,
                            make_instance, LocalMediaTestCase, media_dir,
                            make_commander_role)
@@ -38,6 +40,7 @@ from api.test_utils import setupTreemapEnv, teardownTreemapEnv, mkPlot, mkTree
 from api.models import APIAccessCredential
 from api.views import add_photo_endpoint, update_profile_photo_endpoint
 from api.instance import instances_closest_to_point, instance_info
+from api.plots import plots_closest_to_point
 from api.user import create_user, users_json, users_csv
 from api.auth import (get_signature_for_request, check_signature,
                       SIG_TIMESTAMP_FORMAT)
@@ -1125,6 +1128,65 @@ class InstancesClosestToPoint(TestCase):
         self.assertEqual(self.i2.pk, instance_infos['personal'][0]['id'])
 
 
+class PlotsClosestToPoint(TestCase):
+    def setUp(self):
+        region = ITreeRegion.objects.get(code='NoEastXXX')
+        p = region.geometry.point_on_surface
+
+        self.instance = make_instance(is_public=True, point=p)
+        self.user = make_commander_user(self.instance)
+
+        species = Species(otm_code='CEAT', genus='cedrus',
+                          species='atlantica', max_dbh=2000,
+                          max_height=100, instance=self.instance)
+        species.save_with_user(self.user)
+
+        for offset in (0, 5):
+            plot = Plot(geom=Point(p.x + offset, p.y, srid=p.srid),
+                        instance=self.instance)
+            plot.save_with_user(self.user)
+
+            tree = Tree(plot=plot, instance=self.instance,
+                        species=species, diameter=1630)
+            tree.save_with_user(self.user)
+
+        self.point = p.transform(4326, clone=True)
+
+        ecobenefits._tree_benefits_memo.reset()
+        get_search_cache().clear()
+
+        self.calls = []
+
+        def mockbenefits(endpoint, params, *args, **kwargs):
+            self.calls.append((endpoint, dict(params)))
+            return ({'Benefits': {f: 1.0 for f in ecobackend.FACTORS}},
+                    None)
+
+        self.origBenefitFn = ecobackend.json_benefits_call
+        ecobackend.json_benefits_call = mockbenefits
+
+    def tearDown(self):
+        ecobackend.json_benefits_call = self.origBenefitFn
+
+    def test_benefits_of_nearby_trees(self):
+        request = make_request({'max_plots': 2, 'distance': 100},
+                               user=self.user)
+        request.instance = self.instance
+        request.instance_supports_ecobenefits = True
+
+        plots = plots_closest_to_point(request, self.instance,
+                                       self.point.y, self.point.x)
+
+        self.assertEqual(len(plots), 2)
+        for plot in plots:
+            self.assertEqual(len(plot['tree_benefits']), 5)
+
+        # Both trees have the same species and diameter, so the eco
+        # service only needs to be asked once
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0][0], 'eco.json')
+
+
 class TreePhotoTest(LocalMediaTestCase):
     test_jpeg_path = os.path.join(
         os.path.dirname(__file__),
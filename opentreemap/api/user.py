@@ -20,6 +20,7 @@ from registration.models import RegistrationProfile
 from treemap.views import upload_user_photo
 from treemap.udf import DATETIME_FORMAT
 from treemap.models import User, Audit
+from treemap.auditarchive import exclude_archived
 
 
 REQ_FIELDS = {'email', 'username', 'password', 'allow_email_contact'}
@@ -219,9 +220,13 @@ def _user_as_dict(user, instance):
                  'created': str(user.created),
                  'role': role_name}
 
-    last_edits = Audit.objects.filter(instance=instance,
-                                      user=user)\
-                              .order_by('-updated')[:1]
+    user_audits = Audit.objects.filter(instance=instance,
+                                       user=user)\
+                               .order_by('-updated')
+
+    # Only look through the archive for users who haven't edited since
+    last_edits = (exclude_archived(user_audits)[:1] or
+                  user_audits[:1])
 
     if last_edits:
         last_edit = last_edits[0]
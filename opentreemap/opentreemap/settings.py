@@ -20,6 +20,65 @@ SYSTEM_USER_ID = -1
 #
 ECO_SERVICE_URL = 'http://localhost:13000'
 
+# Timeouts (in seconds) for connecting to and reading from the eco
+# service. Failed requests are retried ECO_SERVICE_RETRIES times,
+# waiting ECO_SERVICE_RETRY_BACKOFF seconds before the first retry and
+# doubling each time. After ECO_SERVICE_FAILURE_THRESHOLD failed
+# requests in a row benefits are reported as unavailable, without
+# calling the service, for ECO_SERVICE_RECOVERY_TIME seconds.
+ECO_SERVICE_CONNECT_TIMEOUT = 2
+ECO_SERVICE_READ_TIMEOUT = 10
+ECO_SERVICE_RETRIES = 2
+ECO_SERVICE_RETRY_BACKOFF = 0.1
+ECO_SERVICE_FAILURE_THRESHOLD = 5
+ECO_SERVICE_RECOVERY_TIME = 30
+
+# Whether the eco service has the eco_batch.json endpoint, which
+# calculates the benefits of many trees in one request. Without it
+# the http backend makes one eco.json request per tree.
+ECO_SERVICE_BATCH = False
+
+# How eco benefits are calculated. 'http' calls the eco service at
+# ECO_SERVICE_URL, 'local' interpolates the i-Tree coefficient tables
+# in ECO_COEFFICIENTS_DIR (one <region code>.csv per region, see
+# treemap/ecolocal.py) in process, and 'sql' sums benefits in the
+# database from those tables, once they have been loaded with the
+# load_itree_coefficients command
+ECO_BACKEND = 'http'
+ECO_COEFFICIENTS_DIR = None
+
+# Keep the benefits of each tree in the treemap_treebenefit table, so
+# that benefit summaries are a SUM instead of a calculation. Rows are
+# updated in a celery task when STORE_TREE_BENEFITS_ASYNC is set, and
+# during the save otherwise. Run 'backfill_tree_benefits' after
+# turning this on.
+STORE_TREE_BENEFITS = False
+STORE_TREE_BENEFITS_ASYNC = True
+
+# Alias (from CACHES) of the cache used to store search result
+# counts. They are keyed on each instance's search_rev, which is kept
+# in the database, so a per-process cache is never stale; a shared
+# backend (e.g. memcached) lets processes reuse each other's counts.
+SEARCH_CACHE_ALIAS = 'default'
+
+# Count search results with the in-memory column store in
+# treemap/columnar.py instead of SQL. Each process keeps its own
+# copy of the data for the instances it serves.
+SEARCH_COLUMNAR_ENGINE = False
+
+# Summary benefits of a search are cached, and served even once the
+# data has changed while a celery task recalculates them. Turn this
+# off to recalculate during the request instead.
+SEARCH_BENEFITS_REFRESH_ASYNC = True
+
+# Audits older than this many months are moved into archive tables
+# (one per AUDIT_ARCHIVE_INSTANCES_PER_PARTITION instance ids and
+# month) by the 'archive_audits' command or the monthly celery beat
+# task, and left out of the edit feeds unless they ask for them.
+# None keeps every audit in treemap_audit.
+AUDIT_ARCHIVE_MONTHS = None
+AUDIT_ARCHIVE_INSTANCES_PER_PARTITION = 100
+
 # This should be the google analytics id without
 # the 'GTM-' prefix
 GOOGLE_ANALYTICS_ID = None
@@ -312,6 +371,20 @@ STORAGE_UNITS.update(EXTRA_STORAGE_UNITS)
 import djcelery
 djcelery.setup_loader()
 
+# Run with 'celery beat' (or a worker started with -B) to record
+# each day's eco benefits history and archive old audits
+from celery.schedules import crontab
+CELERYBEAT_SCHEDULE = {
+    'update-benefits-history': {
+        'task': 'treemap.tasks.update_all_benefits_history',
+        'schedule': crontab(hour=1, minute=0),
+    },
+    'archive-audits': {
+        'task': 'treemap.tasks.archive_audits',
+        'schedule': crontab(day_of_month=1, hour=2, minute=0),
+    },
+}
+
 # Time in ms for two clicks to be considered a double-click in some scenarios
 DOUBLE_CLICK_INTERVAL = 300
 
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 from __future__ import division
 
 import hashlib
+from collections import defaultdict
 from functools import partial
 
 from django.contrib.gis.db import models
@@ -11,7 +12,7 @@ from django.contrib.gis.geos import GEOSGeometry
 from django.forms.models import model_to_dict
 from django.utils.translation import ugettext as trans
 from django.dispatch import receiver
-from django.db.models import OneToOneField
+from django.db.models import OneToOneField, F
 from django.db.models.signals import post_save
 from django.db.models.fields import FieldDoesNotExist
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
@@ -19,7 +20,8 @@ from django.db import IntegrityError, connection, transaction
 
 from treemap.units import (is_convertible, is_convertible_or_formattable,
                            get_display_value, get_units, get_unit_name)
-from treemap.util import leaf_subclasses
+from treemap.util import leaf_subclasses, save_kwargs_without_counter
+from treemap.cache import audit_changes_search, bump_revision
 
 
 def model_hasattr(obj, name):
@@ -158,6 +160,9 @@ def _add_default_permissions(models, role, instance):
             perm.permission_level = role.default_permission
         FieldPermission.objects.bulk_create(perms)
 
+        # bulk_create doesn't send the post_save that would do this
+        Role.increment_visibility_rev(pk=role.pk)
+
 
 def approve_or_reject_existing_edit(audit, user, approved):
     """
@@ -188,6 +193,7 @@ def approve_or_reject_existing_edit(audit, user, approved):
                          instance=audit.instance, field=audit.field,
                          previous_value=audit.previous_value,
                          current_value=audit.current_value,
+                         map_feature_id=audit.map_feature_id,
                          user=user)
 
     # Regardless of what we're doing, we need to make sure
@@ -254,9 +260,19 @@ def approve_or_reject_existing_edit(audit, user, approved):
     audit.ref = review_audit
     audit.save()
 
+    _increment_revision(TheModel, audit.model_id)
+
     return review_audit
 
 
+def _increment_revision(model_class, model_id):
+    # Reviews change what is shown for an object even when they don't
+    # change the object itself, so models that keep a revision for
+    # their hash need to know about them
+    if hasattr(model_class, 'increment_revision'):
+        model_class.increment_revision(model_id)
+
+
 def approve_or_reject_audit_and_apply(audit, user, approved):
     """
     Approve or reject a given audit and apply it to the
@@ -284,6 +300,7 @@ def approve_or_reject_audit_and_apply(audit, user, approved):
                          instance=audit.instance, field=audit.field,
                          previous_value=audit.previous_value,
                          current_value=audit.current_value,
+                         map_feature_id=audit.map_feature_id,
                          user=user)
 
     TheModel = _get_auditable_class(audit.model)
@@ -302,6 +319,7 @@ def approve_or_reject_audit_and_apply(audit, user, approved):
             # call save on the object's parent here.
 
             obj.save_base()
+            obj.approved_changes_saved([audit.field])
 
         except ObjectDoesNotExist:
             if audit.field == 'id':
@@ -322,6 +340,8 @@ def approve_or_reject_audit_and_apply(audit, user, approved):
     audit.ref = review_audit
     audit.save()
 
+    _increment_revision(TheModel, audit.model_id)
+
     return review_audit
 
 
@@ -339,6 +359,7 @@ def _process_approved_pending_insert(model_class, user, audit):
 
     obj.validate_foreign_keys_exist()
     obj.save_base()
+    obj.approved_changes_saved(None)
 
 
 def get_related_audits(insert_audit, approved_only=False):
@@ -428,6 +449,15 @@ class UserTrackable(Dictable):
         # is none, set it to the default value of the field.
         setattr(self, key, orig_value)
 
+    def approved_changes_saved(self, fields):
+        """
+        Called after approved pending changes to fields have been saved,
+        which doesn't go through save_with_user. fields is None when a
+        pending insert was approved. Models that keep anything else in
+        step in save_with_user should do it here too.
+        """
+        pass
+
     def _fields_required_for_create(self):
         return [field for field in self._meta.fields
                 if (not field.null and
@@ -586,6 +616,21 @@ class Role(models.Model):
                                              default=FieldPermission.NONE)
     rep_thresh = models.IntegerField()
 
+    # Incremented whenever the role's field permissions or its
+    # instance's UDFs change. Cached visibility of the role's fields is
+    # keyed on it (see treemap.cache.get_many_visible_audit_names)
+    visibility_rev = models.IntegerField(default=1)
+
+    def save(self, *args, **kwargs):
+        kwargs = save_kwargs_without_counter(self, 'visibility_rev',
+                                             args, kwargs)
+        super(Role, self).save(**kwargs)
+
+    @classmethod
+    def increment_visibility_rev(cls, **filters):
+        Role.objects.filter(**filters)\
+                    .update(visibility_rev=F('visibility_rev') + 1)
+
     @property
     def tree_permissions(self):
         return self.model_permissions('Tree')
@@ -842,11 +887,20 @@ class Auditable(UserTrackable):
     def audits(self):
         return Audit.audits_for_object(self)
 
+    @property
+    def audit_map_feature_id(self):
+        """
+        The id of the map feature whose history this object's audits
+        are part of, if any
+        """
+        return None
+
     def delete_with_user(self, user, *args, **kwargs):
         a = Audit(
             model=self._model_name,
             model_id=self.pk,
             instance=self.instance if hasattr(self, 'instance') else None,
+            map_feature_id=self.audit_map_feature_id,
             user=user, action=Audit.Type.Delete)
 
         super(Auditable, self).delete_with_user(user, *args, **kwargs)
@@ -955,21 +1009,31 @@ class Auditable(UserTrackable):
             else:
                 updates['id'] = [None, model_id]
 
-        def make_audit_and_save(field, prev_val, cur_val, pending):
+        audits = []
+        map_feature_id = self.audit_map_feature_id
 
-            Audit(model=self._model_name, model_id=model_id,
-                  instance=instance, field=field,
-                  previous_value=prev_val,
-                  current_value=cur_val,
-                  user=user, action=action,
-                  requires_auth=pending,
-                  ref=None).save()
+        def make_audit(field, prev_val, cur_val, pending):
+
+            audits.append(
+                Audit(model=self._model_name, model_id=model_id,
+                      instance=instance, field=field,
+                      map_feature_id=map_feature_id,
+                      previous_value=prev_val,
+                      current_value=cur_val,
+                      user=user, action=action,
+                      requires_auth=pending,
+                      ref=None))
 
         for [field, values] in updates.iteritems():
-            make_audit_and_save(field, values[0], values[1], False)
+            make_audit(field, values[0], values[1], False)
 
         for (field, (prev_val, next_val)) in pending_audits:
-            make_audit_and_save(field, prev_val, next_val, True)
+            make_audit(field, prev_val, next_val, True)
+
+        # bulk_create doesn't send post_save, so do what
+        # audit_presave_actions would have done for the whole batch
+        Audit.objects.bulk_create(audits)
+        audits_bulk_created(audits)
 
     @property
     def hash(self):
@@ -1057,6 +1121,12 @@ class Audit(models.Model):
     requires_auth = models.BooleanField(default=False)
     ref = models.ForeignKey('Audit', null=True)
 
+    # The map feature whose history this audit is part of (for audits
+    # of map features, trees, tree photos and their collection UDFs).
+    # Indexed along with 'updated' so a feature's recent history is a
+    # single index scan.
+    map_feature_id = models.IntegerField(null=True)
+
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True, db_index=True)
 
@@ -1271,11 +1341,69 @@ class ReputationMetric(models.Model):
             iuser.reputation += rm.direct_write_score
             iuser.save_base()
 
+    @staticmethod
+    def apply_direct_write_adjustments(audits):
+        """
+        Apply the direct write scores of a batch of audits with a single
+        update per user, rather than one lookup and save per audit.
+        Audits requiring authorization are skipped, since their scores
+        only apply once they are approved or rejected.
+        """
+        counts = defaultdict(int)
+        for audit in audits:
+            if not audit.requires_auth and audit.instance_id:
+                counts[(audit.instance_id, audit.user_id,
+                        audit.model, unicode(audit.action))] += 1
+
+        if not counts:
+            return
+
+        instance_ids = {instance_id for instance_id, __, __, __ in counts}
+        model_names = {model for __, __, model, __ in counts}
+
+        metrics = ReputationMetric.objects\
+            .filter(instance_id__in=instance_ids,
+                    model_name__in=model_names)\
+            .values_list('instance_id', 'model_name', 'action',
+                         'direct_write_score')
+        scores = {(instance_id, model, action): score
+                  for instance_id, model, action, score in metrics}
+
+        adjustments = defaultdict(int)
+        for (instance_id, user_id, model, action), n in counts.iteritems():
+            score = scores.get((instance_id, model, action))
+            if score:
+                adjustments[(instance_id, user_id)] += n * score
+
+        from treemap.models import InstanceUser  # prevent circular import
+
+        for (instance_id, user_id), adjustment in adjustments.iteritems():
+            InstanceUser.objects\
+                .filter(instance_id=instance_id, user_id=user_id)\
+                .update(reputation=F('reputation') + adjustment)
+
 
 @receiver(post_save, sender=Audit)
 def audit_presave_actions(sender, instance, **kwargs):
     ReputationMetric.apply_adjustment(instance)
 
+    if audit_changes_search(instance):
+        bump_revision(instance.instance_id)
+
+
+def audits_bulk_created(audits):
+    """
+    The equivalent of audit_presave_actions for audits written with
+    bulk_create, which only touches each user and instance once.
+    Audits written by save_with_user are never reviews, so only direct
+    write scores apply.
+    """
+    ReputationMetric.apply_direct_write_adjustments(audits)
+
+    for instance_id in {audit.instance_id for audit in audits
+                        if audit_changes_search(audit)}:
+        bump_revision(instance_id)
+
 
 def _get_model_class(class_dict, cls, model_name):
     """
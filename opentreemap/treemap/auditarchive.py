@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+# Audits that are older than the archive cutoff are moved out of
+# treemap_audit into child tables that inherit from it, one per range
+# of instance ids and month. Queries on treemap_audit still see them,
+# but a query with a 'created >= <cutoff>' condition skips them
+# entirely (through postgres' constraint exclusion), as does a query
+# for one instance id, which skips the other ranges.
+#
+# Newer audits stay in treemap_audit itself, as do pending edits that
+# haven't been reviewed yet, so that reviewing them doesn't have to
+# update an archive table. Routing inserts to child
+# tables would need a trigger, and rows inserted through a trigger
+# don't return their id to django.
+#
+# A foreign key only sees the rows of its own table, so treemap_audit
+# has none on 'ref' (see migration 0074), which reviews of archived
+# audits would violate.
+ARCHIVE_TABLE_SUFFIX = '_archive'
+
+# Indexes of each archive table, by name suffix
+ARCHIVE_INDEXES = (('pkey', 'PRIMARY KEY', '(id)'),
+                   ('instance_created', 'INDEX', '(instance_id, created)'),
+                   ('model_model_id', 'INDEX', '(model, model_id)'),
+                   ('user_id', 'INDEX', '(user_id)'),
+                   ('updated', 'INDEX', '(updated)'),
+                   ('feature_updated', 'INDEX', '(map_feature_id, updated)'),
+                   ('created_id', 'INDEX', '(created, id)'))
+
+
+def _month_start(year, month):
+    return datetime.datetime(year, month, 1, tzinfo=timezone.utc)
+
+
+def _add_months(date, months):
+    index = date.year * 12 + date.month - 1 + months
+    return _month_start(index // 12, index % 12 + 1)
+
+
+def archive_cutoff(months=None, now=None):
+    """
+    The time before which audits are archived: the start of the month
+    that was AUDIT_ARCHIVE_MONTHS months ago (in UTC, like the archive
+    tables). None if audits aren't archived.
+    """
+    if months is None:
+        months = settings.AUDIT_ARCHIVE_MONTHS
+    if months is None:
+        return None
+
+    return _add_months(now or timezone.now(), -months)
+
+
+def exclude_archived(audits, include_archived=False):
+    """
+    Filter an Audit queryset down to the audits created since the
+    archive cutoff, unless include_archived is set
+    """
+    cutoff = archive_cutoff()
+    if include_archived or cutoff is None:
+        return audits
+    return audits.filter(created__gte=cutoff)
+
+
+def partition_name(table, lo, hi, month):
+    if lo is None:
+        instances = 'none'
+    else:
+        instances = '%s_%s' % (lo, hi)
+
+    return '%s%s_%s_%s' % (table, ARCHIVE_TABLE_SUFFIX, instances,
+                           month.strftime('%Y%m'))
+
+
+def _instance_check(lo, hi):
+    if lo is None:
+        return 'instance_id IS NULL'
+    else:
+        return 'instance_id >= %d AND instance_id < %d' % (lo, hi)
+
+
+def existing_partitions(table='treemap_audit'):
+    cursor = connection.cursor()
+    cursor.execute('SELECT c.relname FROM pg_inherits i '
+                   'JOIN pg_class c ON c.oid = i.inhrelid '
+                   'WHERE i.inhparent = %s::regclass '
+                   'ORDER BY c.relname', [table])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def create_partition(cursor, table, lo, hi, month, temporary=False):
+    """
+    Create the archive table for the audits of instances lo to hi
+    (or without an instance, if lo is None) made during month, if it
+    doesn't already exist.
+
+    Returns the name of the table
+    """
+    name = partition_name(table, lo, hi, month)
+
+    if name not in existing_partitions(table):
+        cursor.execute(
+            'CREATE %sTABLE %s ('
+            '  CHECK (%s AND created >= %%s AND created < %%s)'
+            ') INHERITS (%s)' % ('TEMPORARY ' if temporary else '', name,
+                                 _instance_check(lo, hi), table),
+            [month, _add_months(month, 1)])
+
+    # Tables created before an index was added to ARCHIVE_INDEXES get
+    # it the next time they are archived to
+    cursor.execute('SELECT conname FROM pg_constraint '
+                   'WHERE conrelid = %s::regclass '
+                   'UNION SELECT indexname FROM pg_indexes '
+                   'WHERE tablename = %s', [name, name])
+    existing = {row[0] for row in cursor.fetchall()}
+
+    for suffix, kind, columns in ARCHIVE_INDEXES:
+        if '%s_%s' % (name, suffix) in existing:
+            continue
+        elif kind == 'PRIMARY KEY':
+            cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s_%s '
+                           'PRIMARY KEY %s' % (name, name, suffix, columns))
+        else:
+            cursor.execute('CREATE INDEX %s_%s ON %s %s'
+                           % (name, suffix, name, columns))
+
+    return name
+
+
+# Pending edits that haven't been reviewed yet are never archived
+_NOT_PENDING = 'NOT (requires_auth AND ref_id IS NULL)'
+
+
+def _months_to_archive(cursor, table, cutoff, instances_per_partition):
+    cursor.execute(
+        "SELECT DISTINCT instance_id / %%s, "
+        "       date_trunc('month', created AT TIME ZONE 'UTC') "
+        "FROM ONLY %s WHERE created < %%s AND %s" % (table, _NOT_PENDING),
+        [instances_per_partition, cutoff])
+
+    for bucket, month in cursor.fetchall():
+        if bucket is None:
+            lo = hi = None
+        else:
+            lo = bucket * instances_per_partition
+            hi = lo + instances_per_partition
+        yield lo, hi, month.replace(tzinfo=timezone.utc)
+
+
+def archive_audits(cutoff=None, instances_per_partition=None,
+                   table='treemap_audit', temporary=False):
+    """
+    Move the audits created before cutoff (by default archive_cutoff()),
+    other than unreviewed pending edits, out of table and into archive
+    tables, creating them as needed.
+    Each archive table is filled in its own transaction, unless there
+    is one already.
+
+    Returns a dictionary of archive table name to the number of audits
+    moved into it
+    """
+    cutoff = cutoff or archive_cutoff()
+    if cutoff is None:
+        return {}
+
+    instances_per_partition = (instances_per_partition or
+                               settings.AUDIT_ARCHIVE_INSTANCES_PER_PARTITION)
+
+    cursor = connection.cursor()
+
+    moved = {}
+    for lo, hi, month in sorted(_months_to_archive(
+            cursor, table, cutoff, instances_per_partition)):
+        name = create_partition(cursor, table, lo, hi, month, temporary)
+
+        cursor.execute(
+            'WITH moved AS ('
+            '  DELETE FROM ONLY %s'
+            '  WHERE %s AND created >= %%s AND created < %%s'
+            '    AND created < %%s AND %s'
+            '  RETURNING *'
+            ') INSERT INTO %s SELECT * FROM moved'
+            % (table, _instance_check(lo, hi), _NOT_PENDING, name),
+            [month, _add_months(month, 1), cutoff])
+
+        moved[name] = moved.get(name, 0) + cursor.rowcount
+        transaction.commit_unless_managed()
+
+    return moved
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models import F
+
+from treemap.exceptions import EcoServiceUnavailable
+from treemap.instance import Instance
+
+# Audits on these models can change the result of a search
+SEARCHABLE_AUDIT_MODELS = {'Plot', 'Tree', 'Species', 'TreePhoto'}
+
+COUNT_TIMEOUT = 60 * 60 * 24
+
+STATS_TIMEOUT = 60 * 60 * 24 * 30
+
+# Summaries are served even when they are out of date, so they are
+# kept for longer than the counts
+SUMMARY_TIMEOUT = 60 * 60 * 24 * 7
+
+# How long a refresh can take before another one is allowed to start
+SUMMARY_REFRESH_LOCK_TIMEOUT = 60 * 5
+
+
+_caches = {}
+
+
+def get_search_cache():
+    alias = settings.SEARCH_CACHE_ALIAS
+    if alias not in _caches:
+        _caches[alias] = get_cache(alias)
+    return _caches[alias]
+
+
+def get_revision(instance_id):
+    """
+    The current data revision of an instance. It advances whenever an
+    audit is written that might change search results.
+
+    The revision is kept in the database, so cached entries keyed on it
+    are never served after an edit, even by processes that don't share
+    a cache with the one that made it
+    """
+    return Instance.objects.filter(pk=instance_id)\
+                           .values_list('search_rev', flat=True)[0]
+
+
+def bump_revision(instance_id):
+    Instance.objects.filter(pk=instance_id)\
+                    .update(search_rev=F('search_rev') + 1)
+
+
+def audit_changes_search(audit):
+    return (audit.model in SEARCHABLE_AUDIT_MODELS
+            or audit.model.startswith('udf:'))
+
+
+def _increment_counter(name, delta=1):
+    cache = get_search_cache()
+    key = 'treemap:search:stats:%s' % name
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, 0, STATS_TIMEOUT)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            pass
+
+
+def get_counters(names):
+    cache = get_search_cache()
+    values = cache.get_many(['treemap:search:stats:%s' % n for n in names])
+    return {n: values.get('treemap:search:stats:%s' % n, 0) for n in names}
+
+
+def search_cache_stats():
+    """
+    Hit and miss counters for the count cache, shared by every process
+    using the same cache backend
+    """
+    return get_counters(('hits', 'misses'))
+
+
+def _counts_key(instance, filter_key, revision):
+    return 'treemap:search:counts:%s:%s:%s' % (
+        instance.pk, filter_key, revision)
+
+
+def get_search_counts(instance, filter_key, compute_counts):
+    """
+    Returns the cached result of compute_counts() for the given
+    instance and filter at the current data revision, calling
+    compute_counts() only on a miss.
+
+    filter_key should identify the filter regardless of how it was
+    written, e.g. treemap.search.filter_hash
+    """
+    cache = get_search_cache()
+    key = _counts_key(instance, filter_key, get_revision(instance.pk))
+
+    counts = cache.get(key)
+    if counts is None:
+        _increment_counter('misses')
+        counts = compute_counts()
+        cache.set(key, counts, COUNT_TIMEOUT)
+    else:
+        _increment_counter('hits')
+
+    return counts
+
+
+def get_many_search_counts(instance, filter_keys, compute_counts):
+    """
+    Like get_search_counts, but for several filters at once.
+    compute_counts is called with the list of filter keys that were not
+    in the cache, and should return their counts in the same order.
+
+    Returns a dictionary of filter key to counts
+    """
+    cache = get_search_cache()
+    revision = get_revision(instance.pk)
+    keys = {_counts_key(instance, filter_key, revision): filter_key
+            for filter_key in filter_keys}
+
+    cached = cache.get_many(keys.keys())
+    counts = {keys[key]: value for key, value in cached.iteritems()}
+
+    missing = [k for k in set(filter_keys) if k not in counts]
+    if counts:
+        _increment_counter('hits', len(counts))
+    if missing:
+        _increment_counter('misses', len(missing))
+
+    if missing:
+        computed = dict(zip(missing, compute_counts(missing)))
+        cache.set_many({_counts_key(instance, k, revision): v
+                        for k, v in computed.iteritems()}, COUNT_TIMEOUT)
+        counts.update(computed)
+
+    return counts
+
+
+def _summary_key(instance, filter_key, variant):
+    return 'treemap:search:summary:%s:%s:%s' % (
+        instance.pk, filter_key, variant)
+
+
+def get_summary(instance, filter_key, variant, compute, refresh):
+    """
+    Stale-while-revalidate caching for expensive summaries of a search.
+
+    If a summary was cached at the current data revision it is
+    returned as is. If it was cached at an older revision it is still
+    returned, and refresh() is called to bring it up to date
+    (normally by starting a task that ends with set_summary). If
+    refresh() calls set_summary before returning, the new summary is
+    returned instead, and if it fails because the eco service is
+    unavailable the old one is. Only one refresh is started per
+    summary at a time. compute() is only called when nothing is
+    cached at all.
+
+    variant distinguishes summaries of the same search that differ for
+    other reasons, e.g. currency conversions.
+
+    Returns a tuple of (summary, whether it is up to date)
+    """
+    cache = get_search_cache()
+    key = _summary_key(instance, filter_key, variant)
+    revision = get_revision(instance.pk)
+
+    entry = cache.get(key)
+
+    if entry is None:
+        _increment_counter('summary_misses')
+        value = compute()
+        cache.set(key, {'value': value, 'revision': revision},
+                  SUMMARY_TIMEOUT)
+        return value, True
+    elif entry['revision'] == revision:
+        _increment_counter('summary_hits')
+        return entry['value'], True
+    else:
+        _increment_counter('summary_stale_hits')
+        if cache.add(key + ':refresh', True, SUMMARY_REFRESH_LOCK_TIMEOUT):
+            try:
+                refresh()
+            except EcoServiceUnavailable:
+                # Let the next request try again
+                cache.delete(key + ':refresh')
+                return entry['value'], False
+            # A refresh that ran synchronously has already stored the
+            # up to date summary
+            entry = cache.get(key) or entry
+        return entry['value'], entry['revision'] == revision
+
+
+def set_summary(instance, filter_key, variant, value, revision):
+    """
+    Store a summary computed from the data at revision. The revision
+    should be read before the computation starts, so that changes made
+    while it runs leave the summary stale.
+    """
+    cache = get_search_cache()
+    key = _summary_key(instance, filter_key, variant)
+
+    cache.set(key, {'value': value, 'revision': revision}, SUMMARY_TIMEOUT)
+    cache.delete(key + ':refresh')
+
+
+# Visible audit names are keyed on their role's visibility_rev, which
+# is kept in the database and incremented whenever the field
+# permissions or UDFs they depend on change, so no process sees names
+# that are out of date. They expire so that old revisions don't stay
+# in the cache.
+VISIBILITY_TIMEOUT = 60 * 60
+
+
+def _visibility_key(role_id, revision, model_name):
+    return 'treemap:visibility:%s:%s:%s' % (role_id, revision, model_name)
+
+
+def get_many_visible_audit_names(role_models, revisions, compute_names):
+    """
+    The cached audit names visible to each of a list of (role id,
+    model name) pairs. revisions is a dictionary of role id to the
+    role's visibility_rev. compute_names is called with the list of
+    pairs that were not in the cache, and should return their names in
+    the same order.
+
+    Returns a dictionary of (role id, model name) to names
+    """
+    cache = get_search_cache()
+
+    def key(role_model):
+        role_id, model_name = role_model
+        return _visibility_key(role_id, revisions.get(role_id), model_name)
+
+    keys = {key(role_model): role_model for role_model in role_models}
+
+    cached = cache.get_many(keys.keys())
+    names = {keys[k]: value for k, value in cached.iteritems()}
+
+    missing = [rm for rm in set(role_models) if rm not in names]
+    if missing:
+        computed = dict(zip(missing, compute_names(missing)))
+        cache.set_many({key(rm): v for rm, v in computed.iteritems()},
+                       VISIBILITY_TIMEOUT)
+        names.update(computed)
+
+    return names
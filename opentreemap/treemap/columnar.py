@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import threading
+import time
+from datetime import date, datetime
+
+import numpy as np
+
+from treemap.audit import Audit
+from treemap.models import Plot, Tree, Species, MapFeatureBoundary
+from treemap.search import canonical_filter, _parse_value
+from treemap.util import LRUCache
+
+# Number of instances to keep loaded per process
+MAX_INSTANCES = 20
+
+# Audit ids are not guaranteed to become visible in order, so the
+# arrays are rebuilt from scratch every so often
+FULL_RELOAD_INTERVAL = 60 * 60
+
+NUMBER = 'number'
+DATE = 'date'
+STRING = 'string'
+
+PLOT_FIELDS = {
+    'id': NUMBER,
+    'width': NUMBER,
+    'length': NUMBER,
+    'readonly': NUMBER,
+    'address_street': STRING,
+    'address_city': STRING,
+    'address_zip': STRING,
+    'owner_orig_id': STRING,
+}
+
+TREE_FIELDS = {
+    'id': NUMBER,
+    'species': NUMBER,
+    'readonly': NUMBER,
+    'diameter': NUMBER,
+    'height': NUMBER,
+    'canopy_height': NUMBER,
+    'date_planted': DATE,
+    'date_removed': DATE,
+}
+
+SPECIES_FIELDS = {
+    'id': NUMBER,
+    'otm_code': STRING,
+    'common_name': STRING,
+    'genus': STRING,
+    'species': STRING,
+    'cultivar': STRING,
+    'other': STRING,
+    'native_status': NUMBER,
+    'gender': STRING,
+    'bloom_period': STRING,
+    'fruit_period': STRING,
+    'fall_conspicuous': NUMBER,
+    'flower_conspicuous': NUMBER,
+    'palatable_human': NUMBER,
+    'wildlife_value': NUMBER,
+    'max_dbh': NUMBER,
+    'max_height': NUMBER,
+}
+
+# Model names used in filter keys and the columns they refer to
+ROW_MODELS = {'plot': 'plot', 'mapFeature': 'plot', 'tree': 'tree'}
+
+
+class UnsupportedFilter(Exception):
+    pass
+
+
+def _number(value):
+    if value is None:
+        return np.nan
+    elif isinstance(value, (date, datetime)):
+        return float(value.toordinal())
+    else:
+        return float(value)
+
+
+def _udf_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _query_number(value, kind):
+    if isinstance(value, bool):
+        return float(value)
+    elif isinstance(value, (int, long, float)):
+        return float(value)
+    elif kind == DATE and isinstance(value, datetime):
+        return float(value.date().toordinal())
+    else:
+        raise UnsupportedFilter('Cannot compare %r to a %s field'
+                                % (value, kind))
+
+
+def _map_objects(fn, column):
+    return np.frompyfunc(fn, 1, 1)(column).astype(bool)
+
+
+class _ColumnBuilder(object):
+    def __init__(self, fields=()):
+        self.columns = {}
+        self.kinds = {}
+        self.length = 0
+
+        for name, kind in fields:
+            self.kinds[name] = kind
+            self.columns[name] = []
+
+    def add(self, name, kind, value):
+        self.kinds[name] = kind
+        values = self.columns.setdefault(name, [None] * self.length)
+        values.append(value)
+
+    def end_row(self):
+        self.length += 1
+        for values in self.columns.itervalues():
+            if len(values) < self.length:
+                values.append(None)
+
+    def build(self):
+        arrays = {}
+        for name, values in self.columns.iteritems():
+            if self.kinds[name] == STRING:
+                array = np.empty(self.length, dtype=object)
+                array[:] = values
+            else:
+                array = np.array([_number(v) for v in values],
+                                 dtype=np.float64)
+            arrays[name] = array
+        return arrays
+
+
+class InstanceColumns(object):
+    """
+    Column arrays for a single instance. There is one row per tree,
+    plus one row for every plot without a tree. Species attributes are
+    stored in a separate table, indexed by the 'species_pos' column.
+    The last species row is all nulls, so that trees without a species
+    (species_pos == -1) read null values.
+    """
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+        self._lock = threading.Lock()
+        self.rows = None
+        self.kinds = {}
+        self.species = None
+        self.species_kinds = {}
+        self.species_ids = None
+        self.last_audit_id = None
+        self.loaded_at = 0
+
+    def _query_rows(self, plot_ids=None):
+        plots = Plot.objects.filter(instance_id=self.instance_id)\
+                            .extra(select={
+                                'x': 'ST_X(the_geom_webmercator)',
+                                'y': 'ST_Y(the_geom_webmercator)'})
+        trees = Tree.objects.filter(instance_id=self.instance_id)
+
+        if plot_ids is not None:
+            plots = plots.filter(pk__in=plot_ids)
+            trees = trees.filter(plot_id__in=plot_ids)
+
+        plot_fields = PLOT_FIELDS.keys() + ['x', 'y', 'udfs']
+        tree_fields = TREE_FIELDS.keys() + ['plot', 'udfs']
+
+        trees_by_plot = {}
+        for tree in trees.values(*tree_fields):
+            trees_by_plot.setdefault(tree['plot'], []).append(tree)
+
+        fields = ([('plot.' + f, k) for f, k in PLOT_FIELDS.iteritems()] +
+                  [('tree.' + f, k) for f, k in TREE_FIELDS.iteritems()] +
+                  [('plot.x', NUMBER), ('plot.y', NUMBER)])
+        builder = _ColumnBuilder(fields)
+
+        for plot in plots.values(*plot_fields):
+            for tree in trees_by_plot.get(plot['id'], [None]):
+                self._add_row(builder, plot, tree)
+                builder.end_row()
+
+        return builder
+
+    def _add_row(self, builder, plot, tree):
+        for field, kind in PLOT_FIELDS.iteritems():
+            builder.add('plot.' + field, kind, plot[field])
+
+        builder.add('plot.x', NUMBER, plot['x'])
+        builder.add('plot.y', NUMBER, plot['y'])
+
+        for key, value in (plot['udfs'] or {}).iteritems():
+            builder.add('plot.udf:' + key, STRING, value)
+
+        if tree is not None:
+            for field, kind in TREE_FIELDS.iteritems():
+                builder.add('tree.' + field, kind, tree[field])
+
+            for key, value in (tree['udfs'] or {}).iteritems():
+                builder.add('tree.udf:' + key, STRING, value)
+
+    def _load_species(self):
+        builder = _ColumnBuilder(
+            ('species.' + f, k) for f, k in SPECIES_FIELDS.iteritems())
+
+        species = Species.objects.filter(instance_id=self.instance_id)\
+                                 .order_by('pk')
+        for s in species.values(*SPECIES_FIELDS.keys()):
+            for field, kind in SPECIES_FIELDS.iteritems():
+                builder.add('species.' + field, kind, s[field])
+            builder.end_row()
+
+        # The trailing null row
+        builder.end_row()
+
+        self.species = builder.build()
+        self.species_kinds = builder.kinds
+        self.species_ids = self.species['species.id'][:-1]
+
+    def _species_positions(self, species_ids):
+        ids = self.species_ids
+        if len(ids) == 0:
+            return np.repeat(-1, len(species_ids))
+
+        pos = np.clip(np.searchsorted(ids, species_ids), 0, len(ids) - 1)
+        return np.where(ids[pos] == species_ids, pos, -1)
+
+    def _latest_audit_id(self):
+        audits = Audit.objects.filter(instance_id=self.instance_id)\
+                              .order_by('-pk')\
+                              .values_list('pk', flat=True)[:1]
+        return audits[0] if audits else 0
+
+    def load(self):
+        last_audit_id = self._latest_audit_id()
+
+        builder = self._query_rows()
+        rows = builder.build()
+
+        self._load_species()
+        rows['species_pos'] = self._species_positions(rows['tree.species'])
+
+        self.rows, self.kinds = rows, builder.kinds
+        self.last_audit_id = last_audit_id
+        self.loaded_at = time.time()
+
+    def _changes_since(self, audit_id):
+        changes = Audit.objects.filter(instance_id=self.instance_id,
+                                       pk__gt=audit_id)\
+                               .values_list('pk', 'model', 'model_id')
+
+        last_id = audit_id
+        plot_ids, tree_ids, species_changed = set(), set(), False
+        for pk, model, model_id in changes:
+            last_id = max(last_id, pk)
+            if model == 'Plot':
+                plot_ids.add(model_id)
+            elif model == 'Tree':
+                tree_ids.add(model_id)
+            elif model == 'Species':
+                species_changed = True
+
+        return last_id, plot_ids, tree_ids, species_changed
+
+    def _apply_changes(self, plot_ids, tree_ids):
+        rows = self.rows
+
+        # Trees may have been moved or deleted, so we need both the
+        # plots they used to be on and the ones they are on now
+        if tree_ids:
+            ids = np.array(sorted(tree_ids), dtype=np.float64)
+            old_rows = np.in1d(rows['tree.id'], ids)
+            plot_ids |= set(rows['plot.id'][old_rows].astype(int).tolist())
+            plot_ids |= set(Tree.objects.filter(pk__in=tree_ids)
+                                        .values_list('plot', flat=True))
+
+        if not plot_ids:
+            return
+
+        keep = ~np.in1d(rows['plot.id'],
+                        np.array(sorted(plot_ids), dtype=np.float64))
+
+        builder = self._query_rows(plot_ids)
+        new_rows = builder.build()
+
+        kinds = dict(self.kinds, **builder.kinds)
+        n_kept = int(keep.sum())
+        merged = {}
+        for name in kinds:
+            # A udf may only have values on one side
+            if name in rows:
+                old = rows[name][keep]
+            else:
+                old = np.empty(n_kept, dtype=object)
+
+            new = new_rows.get(name)
+            if new is None:
+                new = np.empty(builder.length, dtype=object)
+
+            merged[name] = np.concatenate([old, new])
+
+        merged['species_pos'] = self._species_positions(
+            merged['tree.species'])
+
+        self.rows, self.kinds = merged, kinds
+
+    def refresh(self):
+        """
+        Bring the arrays up to date with the audit log, loading them
+        first if needed
+        """
+        with self._lock:
+            stale = time.time() - self.loaded_at > FULL_RELOAD_INTERVAL
+            if self.rows is None or stale:
+                self.load()
+                return
+
+            last_id, plot_ids, tree_ids, species_changed = \
+                self._changes_since(self.last_audit_id)
+
+            if species_changed:
+                self._load_species()
+                self.rows['species_pos'] = self._species_positions(
+                    self.rows['tree.species'])
+
+            self._apply_changes(plot_ids, tree_ids)
+
+            self.last_audit_id = last_id
+
+    def evaluate(self, query):
+        """
+        Returns a boolean mask over the rows for a parsed (and
+        preferably canonicalized) filter
+        """
+        n = len(self.rows['plot.id'])
+
+        if query is None:
+            return np.ones(n, dtype=bool)
+        elif type(query) is dict:
+            mask = np.ones(n, dtype=bool)
+            for key, value in query.iteritems():
+                mask &= self._evaluate_predicate(key, value)
+            return mask
+        elif type(query) is list and len(query) > 1:
+            combinator = query[0]
+            masks = [self.evaluate(q) for q in query[1:]]
+            if combinator == 'AND':
+                return np.logical_and.reduce(masks)
+            elif combinator == 'OR':
+                return np.logical_or.reduce(masks)
+
+        raise UnsupportedFilter('Cannot evaluate %r' % query)
+
+    def _column(self, key):
+        parts = key.split('.')
+        if len(parts) != 2:
+            raise UnsupportedFilter('Invalid key %s' % key)
+
+        model, field = parts
+
+        if model == 'species':
+            name = 'species.' + field
+            if name not in self.species:
+                raise UnsupportedFilter('Unknown field %s' % key)
+            return (self.species[name], self.species_kinds[name],
+                    self.rows['species_pos'])
+
+        if model not in ROW_MODELS:
+            raise UnsupportedFilter('Unknown model %s' % model)
+
+        name = ROW_MODELS[model] + '.' + field
+        if name in self.rows:
+            return self.rows[name], self.kinds[name], None
+        elif field.startswith('udf:'):
+            # Nobody has set this udf yet
+            n = len(self.rows['plot.id'])
+            return np.array([None] * n, dtype=object), STRING, None
+        else:
+            raise UnsupportedFilter('Unknown field %s' % key)
+
+    def _evaluate_predicate(self, key, value):
+        if key.endswith('.geom'):
+            return self._evaluate_geom_predicate(key, value)
+
+        column, kind, positions = self._column(key)
+        is_udf = '.udf:' in key
+
+        if type(value) is dict:
+            mask = self._evaluate_dict(column, kind, value, is_udf)
+        else:
+            mask = self._evaluate_dict(column, kind, {'IS': value}, is_udf)
+
+        if positions is not None:
+            mask = mask[positions]
+
+        return mask
+
+    def _numeric(self, column, kind, is_udf):
+        if kind != STRING:
+            return column
+        elif is_udf:
+            return np.array([_udf_number(v) for v in column],
+                            dtype=np.float64)
+        else:
+            raise UnsupportedFilter('Cannot do a numeric comparison '
+                                    'on a text field')
+
+    def _evaluate_dict(self, column, kind, valuesdict, is_udf):
+        n = len(column)
+        mask = np.ones(n, dtype=bool)
+
+        for op, raw_value in valuesdict.iteritems():
+            if op in ('MIN', 'MAX'):
+                if type(raw_value) is dict:
+                    exclusive = raw_value.get('EXCLUSIVE')
+                    raw_value = raw_value.get('VALUE')
+                else:
+                    exclusive = False
+
+                value = _parse_value(raw_value)
+                numbers = self._numeric(column, kind, is_udf)
+                bound = _query_number(value, kind)
+
+                with np.errstate(invalid='ignore'):
+                    if op == 'MIN':
+                        mask &= (numbers > bound if exclusive
+                                 else numbers >= bound)
+                    else:
+                        mask &= (numbers < bound if exclusive
+                                 else numbers <= bound)
+
+            elif op in ('IS', 'IN'):
+                values = _parse_value(raw_value)
+                if op == 'IS':
+                    values = [values]
+
+                if all(isinstance(v, basestring) for v in values) \
+                        and kind == STRING:
+                    accepted = set(values)
+                    mask &= _map_objects(lambda v: v in accepted, column)
+                else:
+                    numbers = self._numeric(column, kind, is_udf)
+                    accepted = [_query_number(v, kind) for v in values]
+                    mask &= np.in1d(numbers, accepted)
+
+            elif op == 'ISNULL':
+                if kind == STRING:
+                    nulls = _map_objects(lambda v: v is None, column)
+                else:
+                    nulls = np.isnan(column)
+                mask &= nulls if raw_value else ~nulls
+
+            elif op == 'LIKE' and kind == STRING:
+                needle = unicode(raw_value).lower()
+                mask &= _map_objects(
+                    lambda v: v is not None and needle in v.lower(), column)
+
+            else:
+                raise UnsupportedFilter('Unsupported predicate %s' % op)
+
+        return mask
+
+    def _evaluate_geom_predicate(self, key, valuesdict):
+        model = key.split('.')[0]
+        if ROW_MODELS.get(model) != 'plot' or type(valuesdict) is not dict:
+            raise UnsupportedFilter('Unsupported geometry filter %s' % key)
+
+        x, y = self.rows['plot.x'], self.rows['plot.y']
+        mask = np.ones(len(x), dtype=bool)
+
+        for op, value in valuesdict.iteritems():
+            if op == 'WITHIN_RADIUS':
+                px = float(value['POINT']['x'])
+                py = float(value['POINT']['y'])
+                radius = float(value['RADIUS'])
+                mask &= (x - px) ** 2 + (y - py) ** 2 <= radius ** 2
+
+            elif op == 'IN_BBOX':
+                mask &= ((x >= float(value['XMIN'])) &
+                         (x <= float(value['XMAX'])) &
+                         (y >= float(value['YMIN'])) &
+                         (y <= float(value['YMAX'])))
+
+            elif op == 'IN_BOUNDARY':
+                ids = MapFeatureBoundary.objects\
+                                        .filter(boundary_id=value)\
+                                        .values_list('map_feature_id',
+                                                     flat=True)
+                mask &= np.in1d(self.rows['plot.id'],
+                                np.array(list(ids), dtype=np.float64))
+
+            else:
+                raise UnsupportedFilter('Unsupported predicate %s' % op)
+
+        return mask
+
+    def counts(self, query):
+        """
+        Returns (number of plots, number of trees) matching the query
+        """
+        # refresh() updates the rows and species in several steps, so
+        # they are only read together under the same lock
+        with self._lock:
+            mask = self.evaluate(query)
+
+            plot_ids = self.rows['plot.id'][mask]
+            tree_ids = self.rows['tree.id'][mask]
+
+        tree_ids = tree_ids[~np.isnan(tree_ids)]
+
+        return len(np.unique(plot_ids)), len(np.unique(tree_ids))
+
+
+_indexes = LRUCache(max_size=MAX_INSTANCES)
+
+
+def get_instance_columns(instance):
+    columns = _indexes.get(instance.pk)
+    if columns is None:
+        columns = _indexes.put(instance.pk, InstanceColumns(instance.pk))
+
+    columns.refresh()
+    return columns
+
+
+def search_counts(instance, filter_str):
+    """
+    Returns (number of plots, number of trees) matching filter_str, or
+    None if the filter uses something the engine doesn't support
+    """
+    try:
+        query = canonical_filter(filter_str)
+        return get_instance_columns(instance).counts(query)
+    except UnsupportedFilter:
+        return None
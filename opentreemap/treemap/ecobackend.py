@@ -3,19 +3,191 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
-import urllib2
-import urllib
+import httplib
 import json
+import socket
+import threading
+import time
+import urllib
+import urlparse
 
 from django.conf import settings
+from django.utils.importlib import import_module
 from django.contrib.gis.db.backends.postgis.adapter import PostGISAdapter
 from django.contrib.gis.geos import GEOSGeometry
 
+from treemap.exceptions import EcoServiceUnavailable
+
 BAD_CODE_PAIR = 'bad code pair'
+BENEFITS_UNAVAILABLE = 'benefits unavailable'
+
+# The raw factors of a Benefits dictionary
+FACTORS = ('aq_nox_avoided', 'aq_nox_dep', 'aq_ozone_dep', 'aq_pm10_avoided',
+           'aq_pm10_dep', 'aq_sox_avoided', 'aq_sox_dep', 'aq_voc_avoided',
+           'bvoc', 'co2_avoided', 'co2_sequestered', 'co2_storage',
+           'electricity', 'hydro_interception', 'natural_gas')
+
+# Values of settings.ECO_BACKEND
+BACKENDS = {
+    'http': 'treemap.ecobackend.HttpBackend',
+    'local': 'treemap.ecolocal.LocalBackend',
+    'sql': 'treemap.ecosql.SqlBackend',
+}
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to a failing service. After failure_threshold calls in
+    a row have failed the breaker opens and allow() returns False.
+    Once recovery_time seconds have passed a single trial call is let
+    through; the breaker closes again if it succeeds.
+    """
+    def __init__(self, failure_threshold, recovery_time):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            elif time.time() - self._opened_at >= self.recovery_time:
+                # Hold the breaker open for everyone else while the
+                # trial call is made
+                self._opened_at = time.time()
+                return True
+            else:
+                return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.time()
+
+
+class _ServerError(Exception):
+    pass
+
+
+class EcoServiceClient(object):
+    """
+    Makes requests to the eco service over a kept-alive connection per
+    thread. Requests that fail to connect, time out or get a 5xx
+    response are retried with exponential backoff. If they keep
+    failing EcoServiceUnavailable is raised, and after enough of those
+    the circuit breaker fails calls immediately until the service has
+    had time to recover.
+    """
+    def __init__(self, url, connect_timeout, read_timeout, retries,
+                 retry_backoff, breaker):
+        parsed = urlparse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.base_path = parsed.path.rstrip('/')
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker
+
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.connect_timeout)
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+            self._local.conn = conn
+
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _request_once(self, method, path, body, headers):
+        conn = self._connection()
+        conn.request(method, self.base_path + path, body, headers)
+
+        response = conn.getresponse()
+        data = response.read()
+
+        if response.will_close:
+            self._close()
+
+        if response.status >= 500:
+            raise _ServerError('%s: %s' % (response.status, data))
+
+        return response.status, data
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Returns a tuple of (status, response body)
+        """
+        if not self.breaker.allow():
+            raise EcoServiceUnavailable('The eco service is unavailable')
+
+        for attempt in xrange(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+
+            try:
+                rslt = self._request_once(method, path, body, headers or {})
+            except (socket.error, httplib.HTTPException, _ServerError) as e:
+                self._close()
+                error = e
+            else:
+                self.breaker.record_success()
+                return rslt
+
+        self.breaker.record_failure()
+        raise EcoServiceUnavailable('Eco service request failed: %s' % error)
+
+
+_clients = {}
+
+
+def get_client():
+    config = (settings.ECO_SERVICE_URL,
+              settings.ECO_SERVICE_CONNECT_TIMEOUT,
+              settings.ECO_SERVICE_READ_TIMEOUT,
+              settings.ECO_SERVICE_RETRIES,
+              settings.ECO_SERVICE_RETRY_BACKOFF,
+              settings.ECO_SERVICE_FAILURE_THRESHOLD,
+              settings.ECO_SERVICE_RECOVERY_TIME)
+
+    if config not in _clients:
+        breaker = CircuitBreaker(*config[5:])
+        _clients[config] = EcoServiceClient(*(config[:5] + (breaker,)))
+
+    return _clients[config]
+
+
+def _parse_response(status, data):
+    if status == 200:
+        return (json.loads(data), None)
+    elif data == 'invalid otm code for region\n':
+        return (None, BAD_CODE_PAIR)
+    else:
+        raise Exception('Eco service error %s: %s' % (status, data))
 
 
 def json_benefits_call(endpoint, params, post=False):
-    url = "%s/%s" % (settings.ECO_SERVICE_URL, endpoint)
+    path = "/%s" % endpoint
 
     if post:
         paramdata = {}
@@ -43,25 +215,173 @@ def json_benefits_call(endpoint, params, post=False):
             else:
                 paramdata[k] = v
 
-        data = json.dumps(paramdata)
-        req = urllib2.Request(url,
-                              data,
-                              #{'Content-Type': 'application/json'},
-                              {'Content-Type': 'text/plain'})
+        status, data = get_client().request(
+            'POST', path, json.dumps(paramdata),
+            {'Content-Type': 'text/plain'})
     else:
         paramString = "&".join(["%s=%s" % (urllib.quote_plus(str(name)),
                                            urllib.quote_plus(str(val)))
                                 for (name, val) in params])
 
-        # A get request is assumed by urllib2
-        req = url + '?' + paramString
+        status, data = get_client().request('GET', path + '?' + paramString)
+
+    return _parse_response(status, data)
+
+
+def json_post_call(endpoint, data):
+    """
+    POST data as json to an eco service endpoint, returning the
+    decoded response
+    """
+    status, data = get_client().request(
+        'POST', '/%s' % endpoint, json.dumps(data),
+        {'Content-Type': 'application/json'})
+
+    rslt, err = _parse_response(status, data)
+    if err:
+        raise Exception(err)
+
+    return rslt
+
+
+def _make_sql_from_query(query):
+    sql, params = query.sql_with_params()
+    quote = lambda s: "'%s'" % s if isinstance(s, basestring) else s
+    params = [quote(param) for param in params]
+
+    return sql % tuple(params)
+
+
+class HttpBackend(object):
+    """
+    Computes benefits with the eco service at settings.ECO_SERVICE_URL
+    """
+
+    def tree_benefits(self, instance, region, species, diameter):
+        params = {'otmcode': species.otm_code,
+                  'diameter': diameter,
+                  'region': region,
+                  'instanceid': instance.pk,
+                  'speciesid': species.pk}
+
+        rawb, err = json_benefits_call('eco.json', params.iteritems())
+
+        if err:
+            return (None, err)
+        else:
+            return (rawb['Benefits'], None)
+
+    def batch_tree_benefits(self, instance, trees):
+        """
+        Calls tree_benefits for each tree unless
+        settings.ECO_SERVICE_BATCH is set, in which case the
+        eco_batch.json endpoint is used. It takes:
+
+        {"instance_id": 1,
+         "trees": [{"id": "a", "region": "NoEastXXX", "otmcode": "CEAT",
+                    "speciesid": 2, "diameter": 12.0}, ...]}
+
+        and responds with the raw benefits of the trees it could
+        calculate and an error for the others, keyed by the ids that
+        were sent:
+
+        {"Benefits": {"a": {"electricity": 187, ...}},
+         "Errors": {"b": "invalid otm code for region"}}
+        """
+        if not settings.ECO_SERVICE_BATCH:
+            return {key: self.tree_benefits(instance, region, species,
+                                            diameter)
+                    for key, region, species, diameter in trees}
 
-    try:
-        rslt = json.loads(urllib2.urlopen(req).read())
-    except urllib2.HTTPError as e:
-        if e.fp.read() == 'invalid otm code for region\n':
-            return (None, BAD_CODE_PAIR)
+        data = {'instance_id': instance.pk,
+                'trees': [{'id': key,
+                           'region': region,
+                           'otmcode': species.otm_code,
+                           'speciesid': species.pk,
+                           'diameter': diameter}
+                          for key, region, species, diameter in trees]}
+
+        rslt = json_post_call('eco_batch.json', data)
+
+        results = {}
+        for key, benefits in rslt.get('Benefits', {}).iteritems():
+            results[key] = (benefits, None)
+        for key, err in rslt.get('Errors', {}).iteritems():
+            if err.strip() == 'invalid otm code for region':
+                err = BAD_CODE_PAIR
+            results[key] = (None, err)
+
+        return results
+
+    def summary_benefits(self, instance, trees, region):
+        # We want to do a values query that returns the info that
+        # we need for an eco calculation:
+        # diameter, species id and species code
+        #
+        # The species id is used to find potential overrides
+        values = ('diameter',
+                  'species__pk',
+                  'species__otm_code',)
+
+        # If there isn't a single region we need to
+        # include geometry information
+        if not region:
+            values += ('plot__geom',)
+
+        query = _make_sql_from_query(trees.values_list(*values).query)
+
+        # We want to extract x and y coordinates but django
+        # doesn't make this easy since we need to force a join
+        # on plot/mapfeature. To make sure the djago machinery
+        # does that we use "plot__geom" above and then
+        # do this rather dubious string manipulation below
+        if not region:
+            targetGeomField = '"treemap_mapfeature"."the_geom_webmercator"'
+            xyGeomFields = 'ST_X(%s), ST_Y(%s)' % \
+                           (targetGeomField, targetGeomField)
+
+            query = query.replace(targetGeomField, xyGeomFields, 1)
+
+        params = {'query': query,
+                  'instance_id': instance.pk,
+                  'region': region or ""}
+
+        rawb, err = json_benefits_call(
+            'eco_summary.json', params.iteritems(), post=True)
+
+        if err:
+            return (None, err)
         else:
-            raise
+            return (rawb['Benefits'], None)
+
+
+_backends = {}
+
+
+def get_backend():
+    """
+    The benefit calculator selected by settings.ECO_BACKEND. Backends
+    provide:
+
+    tree_benefits(instance, region, species, diameter)
+    batch_tree_benefits(instance, trees)
+    summary_benefits(instance, trees, region)
+
+    tree_benefits and summary_benefits return a tuple of (raw
+    benefits, error), where the raw benefits are in the units of the
+    eco service (see
+    treemap.ecobenefits._compute_currency_and_transform_units).
+    summary_benefits gets a queryset of trees that all have a species
+    and a diameter, and a region of None when the trees may span
+    several regions.
+
+    batch_tree_benefits gets a list of (key, region, species, diameter)
+    tuples and returns a dictionary of key to (raw benefits, error)
+    """
+    name = settings.ECO_BACKEND
+
+    if name not in _backends:
+        module_name, class_name = BACKENDS[name].rsplit('.', 1)
+        _backends[name] = getattr(import_module(module_name), class_name)()
 
-    return (rslt, None)
+    return _backends[name]
@@ -3,93 +3,94 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import hashlib
+import time
+
+from django.conf import settings
+from django.db.models import Count, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as trans
 from django.shortcuts import get_object_or_404
 from django.contrib.gis.geos.point import Point
 
-from treemap import ecobackend
+from treemap import ecobackend, ecosample
+from treemap.cache import get_search_cache, get_counters, _increment_counter
 from treemap.models import Tree
 from treemap.decorators import json_api_call
-from treemap.models import ITreeRegion
+from treemap.exceptions import EcoServiceUnavailable
+from treemap.models import ITreeCodeOverride, TreeBenefit
+from treemap.regions import instance_regions, region_for_point
+from treemap.species import get_itree_code
+from treemap.util import LRUCache
 
 
 WATTS_PER_BTU = 0.29307107
 GAL_PER_CUBIC_M = 264.172052
 LBS_PER_KG = 2.20462
 
+# Per-tree benefits only depend on the region, i-Tree code and
+# diameter, so they are kept both in process and in the shared cache
+TREE_BENEFITS_TIMEOUT = 60 * 60 * 24 * 7
+
+_tree_benefits_memo = LRUCache(max_size=10000)
 
-def _make_sql_from_query(query):
-    sql, params = query.sql_with_params()
-    quote = lambda s: "'%s'" % s if isinstance(s, basestring) else s
-    params = [quote(param) for param in params]
+# The i-Tree code of each region and species (with its otm_code), so
+# that memoized benefits can be found without querying for overrides.
+# Entries are keyed on a revision in the shared cache, which every
+# process bumps when it changes an override
+_itree_codes = LRUCache(max_size=10000)
 
-    return sql % tuple(params)
+ITREE_CODES_REV_KEY = 'treemap:eco:itree_codes:rev'
 
 
 def benefits_for_trees(trees, instance):
     # When calculating benefits we can skip region information
     # if there is only one intersecting region or if the
     # instance forces a region on us
-    region = None
+    regions = instance_regions(instance)
 
-    if instance.itree_region_default:
-        region = instance.itree_region_default
+    if len(regions) == 1:
+        region = regions[0]
     else:
-        regions = ITreeRegion.objects.filter(
-            geometry__intersects=instance.bounds)
-
-        if regions.length() == 1:
-            region = regions[0].code
-
-    # We want to do a values query that returns the info that
-    # we need for an eco calculation:
-    # diameter, species id and species code
-    #
-    # The species id is used to find potential overrides
-    values = ('diameter',
-              'species__pk',
-              'species__otm_code',)
-
-    # If there isn't a single region we need to
-    # include geometry information
-    if not region:
-        values += ('plot__geom',)
+        region = None
 
     # We use two extra instance filter to help out
     # the database a bit when doing the joins
-    treeValues = trees.filter(species__isnull=False)\
-                      .filter(diameter__isnull=False)\
-                      .filter(plot__instance=instance)\
-                      .filter(species__instance=instance)\
-                      .values_list(*values)
+    trees = trees.filter(species__isnull=False)\
+                 .filter(diameter__isnull=False)\
+                 .filter(plot__instance=instance)\
+                 .filter(species__instance=instance)
+
+    if settings.STORE_TREE_BENEFITS:
+        benefits = _stored_benefits(trees)
+    elif _should_sample(instance, trees):
+        return ecosample.sampled_benefits(
+            instance, trees, instance.eco_sample_size, instance.pk)
+    else:
+        benefits, err = ecobackend.get_backend().summary_benefits(
+            instance, trees, region)
 
-    query = _make_sql_from_query(treeValues.query)
+        if err:
+            raise Exception(err)
 
-    # We want to extract x and y coordinates but django
-    # doesn't make this easy since we need to force a join
-    # on plot/mapfeature. To make sure the djago machinery
-    # does that we use "plot__geom" above and then
-    # do this rather dubious string manipulation below
-    if not region:
-        targetGeomField = '"treemap_mapfeature"."the_geom_webmercator"'
-        xyGeomFields = 'ST_X(%s), ST_Y(%s)' % \
-                       (targetGeomField, targetGeomField)
+    return _compute_currency_and_transform_units(instance, benefits)
 
-        query = query.replace(targetGeomField, xyGeomFields, 1)
 
-    params = {'query': query,
-              'instance_id': instance.pk,
-              'region': region or ""}
+def _should_sample(instance, trees):
+    threshold = instance.eco_sample_threshold
+    return threshold is not None and trees.count() > threshold
 
-    rawb, err = ecobackend.json_benefits_call(
-        'eco_summary.json', params.iteritems(), post=True)
 
-    if err:
-        raise Exception(err)
+def _stored_benefits(trees):
+    sums = {factor: Sum(factor) for factor in ecobackend.FACTORS}
+    sums['n_trees'] = Count('tree')
 
-    benefits = rawb['Benefits']
+    benefits = TreeBenefit.objects\
+        .filter(tree__in=trees.values('pk'))\
+        .aggregate(**sums)
 
-    return _compute_currency_and_transform_units(instance, benefits)
+    return {k: v or 0 for k, v in benefits.iteritems()}
 
 
 def _compute_currency_and_transform_units(instance, benefits):
@@ -168,6 +169,287 @@ def _compute_currency_and_transform_units(instance, benefits):
     return (rslt, ntrees)
 
 
+def _quantize_diameter(instance, diameter):
+    quantum = instance.eco_diameter_quantum
+    if quantum:
+        return max(round(diameter / quantum), 1) * quantum
+    else:
+        return diameter
+
+
+@receiver(post_save, sender=ITreeCodeOverride)
+@receiver(post_delete, sender=ITreeCodeOverride)
+def _code_override_changed(*args, **kwargs):
+    _itree_codes.reset()
+    _bump_itree_codes_revision()
+
+
+def _bump_itree_codes_revision():
+    cache = get_search_cache()
+    try:
+        cache.incr(ITREE_CODES_REV_KEY)
+    except ValueError:
+        _itree_codes_revision()
+
+
+def _itree_codes_revision():
+    cache = get_search_cache()
+    revision = cache.get(ITREE_CODES_REV_KEY)
+    if revision is None:
+        # Start from the time rather than from 0, so that codes memoized
+        # under a revision that has since been evicted aren't used again
+        cache.add(ITREE_CODES_REV_KEY, int(time.time() * 1000),
+                  TREE_BENEFITS_TIMEOUT)
+        revision = cache.get(ITREE_CODES_REV_KEY)
+    return revision
+
+
+def _itree_code(region, species, revision=None):
+    if revision is None:
+        revision = _itree_codes_revision()
+
+    key = (revision, region, species.pk, species.otm_code)
+    itree_code = _itree_codes.get(key, False)
+    if itree_code is not False:
+        return itree_code
+
+    overrides = ITreeCodeOverride.objects\
+        .filter(instance_species=species, region__code=region)\
+        .values_list('itree_code', flat=True)
+
+    if overrides:
+        itree_code = overrides[0]
+    else:
+        itree_code = get_itree_code(region, species.otm_code)
+
+    return _itree_codes.put(key, itree_code)
+
+
+def _tree_benefits_key(region, itree_code, diameter):
+    return 'treemap:eco:tree:%s:%s:%s:%s' % (
+        settings.ECO_BACKEND, region, itree_code.replace(' ', '_'), diameter)
+
+
+def _backend_tree_benefits(instance, region, species, diameter):
+    try:
+        return ecobackend.get_backend().tree_benefits(
+            instance, region, species, diameter)
+    except EcoServiceUnavailable:
+        return (None, ecobackend.BENEFITS_UNAVAILABLE)
+
+
+def _raw_tree_benefits(instance, region, species, diameter):
+    """
+    The raw benefits of a single tree, from memory or the shared cache
+    if a tree with the same i-Tree code and (quantized) diameter has
+    been calculated before. Errors are never cached.
+    """
+    diameter = _quantize_diameter(instance, diameter)
+    itree_code = _itree_code(region, species)
+
+    if not itree_code:
+        # Let the backend report the problem
+        return _backend_tree_benefits(instance, region, species, diameter)
+
+    key = _tree_benefits_key(region, itree_code, diameter)
+
+    benefits = _tree_benefits_memo.get(key)
+    if benefits is not None:
+        _increment_counter('eco_local_hits')
+        return (dict(benefits), None)
+
+    cache = get_search_cache()
+    benefits = cache.get(key)
+    if benefits is not None:
+        _increment_counter('eco_shared_hits')
+    else:
+        _increment_counter('eco_misses')
+        benefits, err = _backend_tree_benefits(
+            instance, region, species, diameter)
+
+        if err:
+            return (None, err)
+
+        cache.set(key, benefits, TREE_BENEFITS_TIMEOUT)
+
+    _tree_benefits_memo.put(key, benefits)
+
+    # The caller converts units in place
+    return (dict(benefits), None)
+
+
+def _raw_batch_tree_benefits(instance, trees):
+    """
+    Like _raw_tree_benefits, for a list of (key, region, species,
+    diameter) tuples. All of the trees that aren't cached are sent to
+    the backend in a single call.
+
+    Returns a dictionary of key to (raw benefits, error)
+    """
+    results = {}
+    cache_keys = {}
+    requests = {}
+    itree_codes = {}
+    itree_codes_revision = _itree_codes_revision()
+
+    for key, region, species, diameter in trees:
+        diameter = _quantize_diameter(instance, diameter)
+
+        if (region, species.pk) not in itree_codes:
+            itree_codes[(region, species.pk)] = _itree_code(
+                region, species, itree_codes_revision)
+        itree_code = itree_codes[(region, species.pk)]
+
+        if not itree_code:
+            # Let the backend report the problem
+            requests['tree:%s' % key] = (region, species, diameter)
+            cache_keys[key] = 'tree:%s' % key
+            continue
+
+        cache_key = _tree_benefits_key(region, itree_code, diameter)
+        cache_keys[key] = cache_key
+
+        benefits = _tree_benefits_memo.get(cache_key)
+        if benefits is not None:
+            _increment_counter('eco_local_hits')
+            results[key] = (dict(benefits), None)
+        else:
+            # Trees that share a cache key only need to be sent once
+            requests[cache_key] = (region, species, diameter)
+
+    cache = get_search_cache()
+    shared = cache.get_many([k for k in requests if not k.startswith('tree:')])
+    for cache_key, benefits in shared.iteritems():
+        _tree_benefits_memo.put(cache_key, benefits)
+        del requests[cache_key]
+
+    computed = {}
+    if requests:
+        try:
+            computed = ecobackend.get_backend().batch_tree_benefits(
+                instance, [(request_key,) + request
+                           for request_key, request
+                           in requests.iteritems()])
+        except EcoServiceUnavailable:
+            computed = {k: (None, ecobackend.BENEFITS_UNAVAILABLE)
+                        for k in requests}
+
+        to_cache = {}
+        for cache_key, (benefits, err) in computed.iteritems():
+            if not err and not cache_key.startswith('tree:'):
+                _tree_benefits_memo.put(cache_key, benefits)
+                to_cache[cache_key] = benefits
+        cache.set_many(to_cache, TREE_BENEFITS_TIMEOUT)
+
+    for key, cache_key in cache_keys.iteritems():
+        if key in results:
+            continue
+        elif cache_key in shared:
+            _increment_counter('eco_shared_hits')
+            results[key] = (dict(shared[cache_key]), None)
+        else:
+            _increment_counter('eco_misses')
+            benefits, err = computed.get(cache_key, (None, 'MISSING_RESULT'))
+            if err:
+                results[key] = (None, err)
+            else:
+                results[key] = (dict(benefits), None)
+
+    return results
+
+
+def tree_benefits_cache_stats():
+    """
+    How often per-tree benefits were found in process, in the shared
+    cache, or had to be calculated
+    """
+    return get_counters(('eco_local_hits', 'eco_shared_hits', 'eco_misses'))
+
+
+def _region_for_tree(instance, tree):
+    if instance.itree_region_default:
+        return instance.itree_region_default
+    else:
+        return region_for_point(tree.plot.geom)
+
+
+def update_tree_benefits(trees):
+    """
+    Recalculate the stored benefits of a queryset of trees. Trees whose
+    benefits can't be calculated (e.g. no diameter or an unknown
+    species) have their stored benefits removed
+    """
+    for tree in trees.select_related('instance', 'species', 'plot'):
+        instance = tree.instance
+
+        if tree.diameter and tree.species:
+            region = _region_for_tree(instance, tree)
+        else:
+            region = None
+
+        if region:
+            rawb, err = _raw_tree_benefits(
+                instance, region, tree.species, tree.diameter)
+        else:
+            rawb, err = None, 'MISSING_REGION'
+
+        if err == ecobackend.BENEFITS_UNAVAILABLE:
+            # Keep what we had rather than losing it to an outage
+            continue
+        elif err:
+            TreeBenefit.objects.filter(tree=tree).delete()
+            continue
+
+        values = {factor: rawb.get(factor, 0)
+                  for factor in ecobackend.FACTORS}
+
+        updated = TreeBenefit.objects.filter(tree=tree)\
+                                     .update(region=region, **values)
+        if not updated:
+            TreeBenefit.objects.create(tree=tree, region=region, **values)
+
+
+def _missing_data_error(tree):
+    if not tree.diameter:
+        return 'MISSING_DBH'
+    elif not tree.species:
+        return 'MISSING_SPECIES'
+    else:
+        return None
+
+
+def batch_tree_benefits(instance, trees):
+    """
+    The result of tree_benefits for each of a list of trees, keyed by
+    tree id. Trees that aren't cached are calculated with a single call
+    to the eco backend rather than one call per tree
+    """
+    rslts = {}
+    pending = []
+
+    for tree in trees:
+        error = _missing_data_error(tree)
+        region = None if error else _region_for_tree(instance, tree)
+
+        if error:
+            rslts[tree.pk] = {'tree_benefits': {}, 'error': error}
+        elif not region:
+            rslts[tree.pk] = {'tree_benefits': {}, 'error': 'MISSING_REGION'}
+        else:
+            pending.append((tree.pk, region, tree.species, tree.diameter))
+
+    raw = _raw_batch_tree_benefits(instance, pending)
+    for tree_id, (rawb, err) in raw.iteritems():
+        if err:
+            rslts[tree_id] = {'error': err}
+        else:
+            benefits, _ = _compute_currency_and_transform_units(
+                instance, rawb)
+            rslts[tree_id] = {'tree_benefits': benefits}
+
+    return rslts
+
+
 def tree_benefits(instance, tree_or_tree_id):
     """Given a tree id, determine eco benefits via eco.py"""
 
@@ -177,37 +459,22 @@ def tree_benefits(instance, tree_or_tree_id):
     else:
         tree = tree_or_tree_id
 
-    if not tree.diameter:
-        rslt = {'tree_benefits': {}, 'error': 'MISSING_DBH'}
-    elif not tree.species:
-        rslt = {'tree_benefits': {}, 'error': 'MISSING_SPECIES'}
-    else:
-        if instance.itree_region_default:
-            region = instance.itree_region_default
-        else:
-            regions = ITreeRegion.objects\
-                                 .filter(geometry__contains=tree.plot.geom)
+    error = _missing_data_error(tree)
 
-            if len(regions) > 0:
-                region = regions[0].code
-            else:
-                region = None
+    if error:
+        rslt = {'tree_benefits': {}, 'error': error}
+    else:
+        region = _region_for_tree(instance, tree)
 
         if region:
-            params = {'otmcode': tree.species.otm_code,
-                      'diameter': tree.diameter,
-                      'region': region,
-                      'instanceid': instance.pk,
-                      'speciesid': tree.species.pk}
-
-            rawb, err = ecobackend.json_benefits_call(
-                'eco.json', params.iteritems())
+            rawb, err = _raw_tree_benefits(
+                instance, region, tree.species, tree.diameter)
 
             if err:
                 rslt = {'error': err}
             else:
                 benefits, _ = _compute_currency_and_transform_units(
-                    instance, rawb['Benefits'])
+                    instance, rawb)
 
                 rslt = {'tree_benefits': benefits}
         else:
@@ -220,9 +487,7 @@ def within_itree_regions(request):
     x = request.GET.get('x', None)
     y = request.GET.get('y', None)
     return (bool(x) and bool(y) and
-            ITreeRegion.objects
-            .filter(geometry__contains=Point(float(x),
-                                             float(y))).exists())
+            region_for_point(Point(float(x), float(y))) is not None)
 
 _benefit_labels = {
     # Translators: 'Energy' is the name of an eco benefit
@@ -243,3 +508,17 @@ def get_benefit_label(benefit_name):
 
 
 within_itree_regions_view = json_api_call(within_itree_regions)
+
+
+def benefits_variant(instance):
+    """
+    A key for everything besides the data and the filter that changes
+    an instance's summary benefits
+    """
+    conversions = sorted((instance.factor_conversions or {}).items())
+    variant = (conversions,
+               instance.itree_region_default,
+               instance.eco_diameter_quantum,
+               instance.eco_sample_threshold,
+               instance.eco_sample_size)
+    return hashlib.md5(repr(variant)).hexdigest()
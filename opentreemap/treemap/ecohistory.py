@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import datetime
+from itertools import groupby
+
+from django.db.models import Q
+from django.utils import timezone
+
+from treemap.audit import Audit
+from treemap.ecobackend import FACTORS, BENEFITS_UNAVAILABLE
+from treemap.ecobenefits import _raw_tree_benefits
+from treemap.exceptions import EcoServiceUnavailable
+from treemap.models import BenefitsHistory, Plot, Species
+from treemap.regions import instance_regions, region_for_point
+
+# Tree fields that the benefits depend on. 'id' marks an insert
+TRACKED_FIELDS = ('id', 'diameter', 'species', 'plot')
+
+SNAPSHOT_FIELDS = ('n_trees', 'n_trees_used') + FACTORS
+
+
+def _start_of_day(date):
+    return timezone.make_aware(
+        datetime.datetime.combine(date, datetime.time.min),
+        timezone.get_current_timezone())
+
+
+def _local_date(dt):
+    return timezone.localtime(dt).date()
+
+
+def _applied_tree_audits(instance):
+    """
+    The audits of changes that were actually made to an instance's
+    trees (not pending edits, unless they were approved), in the order
+    they were made
+    """
+    applied = (Q(requires_auth=False,
+                 action__in=(Audit.Type.Insert, Audit.Type.Update)) |
+               Q(action=Audit.Type.PendingApprove))
+
+    return Audit.objects\
+        .filter(instance=instance, model='Tree')\
+        .filter((applied & Q(field__in=TRACKED_FIELDS)) |
+                Q(action=Audit.Type.Delete))\
+        .order_by('created', 'id')
+
+
+def _apply_audit(states, audit):
+    """
+    Update states, a dictionary of tree id to the values of its
+    TRACKED_FIELDS (or None once it's been deleted), with an audit
+    """
+    if audit.action == Audit.Type.Delete:
+        states[audit.model_id] = None
+    else:
+        state = states.get(audit.model_id) or {}
+        state[audit.field] = audit.current_value
+        states[audit.model_id] = state
+
+
+class _BenefitCalculator(object):
+    """
+    Calculates the raw benefits of tree states, looking up the species
+    and plot locations they refer to in bulk
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        regions = instance_regions(instance)
+        self.region = regions[0] if len(regions) == 1 else None
+        self.species = {}
+        self.plot_regions = {}
+
+    def prefetch(self, states):
+        species_ids, plot_ids = set(), set()
+        for state in states:
+            if state:
+                if state.get('species'):
+                    species_ids.add(int(state['species']))
+                if state.get('plot') and not self.region:
+                    plot_ids.add(int(state['plot']))
+
+        species_ids -= set(self.species)
+        if species_ids:
+            self.species.update(Species.objects.in_bulk(species_ids))
+
+        plot_ids -= set(self.plot_regions)
+        if plot_ids:
+            geoms = dict(Plot.objects.filter(pk__in=plot_ids)
+                                     .values_list('pk', 'geom'))
+            for plot_id in plot_ids:
+                geom = geoms.get(plot_id)
+                self.plot_regions[plot_id] = (region_for_point(geom)
+                                              if geom else None)
+
+    def benefits(self, state):
+        """
+        The raw benefits of a tree in the given state, or None if they
+        can't be calculated
+        """
+        if not state or not state.get('diameter') or \
+           not state.get('species'):
+            return None
+
+        species = self.species.get(int(state['species']))
+        if self.region:
+            region = self.region
+        elif state.get('plot'):
+            region = self.plot_regions.get(int(state['plot']))
+        else:
+            region = None
+
+        if not species or not region:
+            return None
+
+        rawb, err = _raw_tree_benefits(self.instance, region, species,
+                                       float(state['diameter']))
+
+        if err == BENEFITS_UNAVAILABLE:
+            # Skipping the tree would throw off every later snapshot
+            raise EcoServiceUnavailable()
+
+        return None if err else rawb
+
+
+class _Totals(object):
+    def __init__(self, snapshot=None):
+        self.values = {field: getattr(snapshot, field, 0)
+                       for field in SNAPSHOT_FIELDS}
+
+    def add(self, state, benefits, sign):
+        if state:
+            self.values['n_trees'] += sign
+        if benefits:
+            self.values['n_trees_used'] += sign
+            for factor in FACTORS:
+                self.values[factor] += sign * benefits.get(factor, 0)
+
+    def save(self, instance, date):
+        updated = BenefitsHistory.objects\
+            .filter(instance=instance, date=date)\
+            .update(**self.values)
+        if not updated:
+            BenefitsHistory.objects.create(instance=instance, date=date,
+                                           **self.values)
+
+
+def _apply_period(states, audits, totals, calculator):
+    """
+    Apply the audits of a period to states, updating totals with the
+    change in the benefits of the trees they touched
+    """
+    touched = {audit.model_id for audit in audits}
+
+    before = [states.get(tree_id) for tree_id in touched]
+    calculator.prefetch(before)
+    for state in before:
+        totals.add(state, calculator.benefits(state), -1)
+
+    for audit in audits:
+        _apply_audit(states, audit)
+
+    after = [states.get(tree_id) for tree_id in touched]
+    calculator.prefetch(after)
+    for state in after:
+        totals.add(state, calculator.benefits(state), 1)
+
+
+def _apply_days(instance, states, audits, totals, calculator, last_date):
+    """
+    Apply audits, in order, a day at a time, saving the totals at the
+    end of each day. Days without any changes between last_date (the
+    day of the totals that were passed in) and the day of the first
+    audit have the same totals as the day before.
+
+    Returns the date of the last day saved
+    """
+    for date, day_audits in groupby(audits,
+                                    lambda a: _local_date(a.created)):
+        if last_date:
+            _save_unchanged_days(instance, totals, last_date, date)
+
+        _apply_period(states, list(day_audits), totals, calculator)
+        totals.save(instance, date)
+        last_date = date
+
+    return last_date
+
+
+def _save_unchanged_days(instance, totals, last_date, until):
+    """
+    Save totals for each day after last_date and before until
+    """
+    for n in range(1, (until - last_date).days):
+        totals.save(instance, last_date + datetime.timedelta(n))
+
+
+def update_benefits_history(instance, date):
+    """
+    Save the snapshots of an instance's benefits at the end of each day
+    after the latest snapshot before date, up to and including date,
+    only recalculating the trees that have changed since. Does a full
+    backfill if there are no earlier snapshots.
+    """
+    previous = BenefitsHistory.objects\
+        .filter(instance=instance, date__lt=date)\
+        .order_by('-date')[:1]
+
+    if not previous:
+        backfill_benefits_history(instance, date + datetime.timedelta(1))
+        return
+
+    previous = previous[0]
+    start = _start_of_day(previous.date + datetime.timedelta(1))
+    end = _start_of_day(date + datetime.timedelta(1))
+
+    audits = _applied_tree_audits(instance)
+    period = list(audits.filter(created__gte=start, created__lt=end))
+
+    # The state of each changed tree at the time of the last snapshot
+    states = {}
+    touched = {audit.model_id for audit in period}
+    for audit in audits.filter(model_id__in=touched, created__lt=start):
+        _apply_audit(states, audit)
+
+    totals = _Totals(previous)
+    last_date = _apply_days(instance, states, period, totals,
+                            _BenefitCalculator(instance), previous.date)
+
+    _save_unchanged_days(instance, totals, last_date,
+                         date + datetime.timedelta(1))
+
+
+def backfill_benefits_history(instance, until=None):
+    """
+    Rebuild an instance's benefits history, with a snapshot for every
+    day from its first tree audit up to (but not including) until,
+    which defaults to today. Walks the audits once, in order.
+    """
+    until = until or _local_date(timezone.now())
+
+    BenefitsHistory.objects.filter(instance=instance).delete()
+
+    audits = _applied_tree_audits(instance)\
+        .filter(created__lt=_start_of_day(until))
+
+    totals = _Totals()
+    last_date = _apply_days(instance, {}, audits.iterator(), totals,
+                            _BenefitCalculator(instance), None)
+
+    if last_date:
+        _save_unchanged_days(instance, totals, last_date, until)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import csv
+import os
+import threading
+
+import numpy as np
+
+from django.conf import settings
+
+from treemap.ecobackend import BAD_CODE_PAIR, FACTORS
+from treemap.models import ITreeRegion, ITreeCodeOverride
+from treemap.regions import instance_regions
+from treemap.species import get_itree_code
+
+CM_PER_INCH = 2.54
+
+
+class RegionCoefficients(object):
+    """
+    The i-Tree benefit curves of a single region.
+
+    They are read from <settings.ECO_COEFFICIENTS_DIR>/<region>.csv,
+    which has a header row of:
+
+    factor,itree_code,<dbh 1>,<dbh 2>,...
+
+    where the diameters are breakpoints in centimeters, followed by one
+    row per factor and i-Tree code giving the value of the factor at
+    each breakpoint. Benefits between breakpoints are interpolated
+    linearly, and held at the end values outside of them.
+    """
+
+    def __init__(self, rows):
+        header = next(rows)
+        self.breakpoints = np.array([float(b) for b in header[2:]])
+
+        self.codes = {}
+        values = {}
+        for row in rows:
+            if not row:
+                continue
+
+            factor, code = row[0], row[1]
+            if factor not in FACTORS:
+                continue
+
+            self.codes.setdefault(code, len(self.codes))
+            values[(factor, code)] = [float(v or 0) for v in row[2:]]
+
+        # values[factor index, code index, breakpoint index]. Factors
+        # missing from the file are left as 0
+        self.values = np.zeros((len(FACTORS), len(self.codes),
+                                len(self.breakpoints)))
+        for (factor, code), curve in values.iteritems():
+            self.values[FACTORS.index(factor), self.codes[code]] = curve
+
+    @classmethod
+    def load(cls, region):
+        path = os.path.join(settings.ECO_COEFFICIENTS_DIR, '%s.csv' % region)
+        with open(path, 'rb') as f:
+            return cls(csv.reader(f))
+
+    def code_index(self, itree_code):
+        return self.codes.get(itree_code, -1)
+
+    def tree_benefits(self, diameters, code_indexes):
+        """
+        The value of each factor for each of a set of trees, given
+        their diameters (in inches) and the index of their i-Tree code.
+        All of the code indexes must be valid.
+
+        Returns a dictionary of factor to an array of values
+        """
+        diameters = np.asarray(diameters, dtype=float) * CM_PER_INCH
+        code_indexes = np.asarray(code_indexes, dtype=int)
+
+        # np.interp only handles a single curve, but every curve shares
+        # its breakpoints, so the interpolation weights can be found
+        # once for all of the trees
+        bp = self.breakpoints
+        diameters = np.clip(diameters, bp[0], bp[-1])
+        upper = np.clip(np.searchsorted(bp, diameters), 1, len(bp) - 1)
+        lower = upper - 1
+        weight = (diameters - bp[lower]) / (bp[upper] - bp[lower])
+
+        values = {}
+        for i, factor in enumerate(FACTORS):
+            curves = self.values[i]
+            values[factor] = (curves[code_indexes, lower] * (1 - weight) +
+                              curves[code_indexes, upper] * weight)
+
+        return values
+
+    def benefits(self, diameters, code_indexes):
+        """
+        Sum each factor over a set of trees, given their diameters (in
+        inches) and the index of their i-Tree code. Trees with a code
+        index of -1 are skipped.
+
+        Returns a tuple of (factor totals, number of trees)
+        """
+        diameters = np.asarray(diameters, dtype=float)
+        code_indexes = np.asarray(code_indexes, dtype=int)
+
+        known = code_indexes >= 0
+        values = self.tree_benefits(diameters[known], code_indexes[known])
+
+        totals = {factor: float(v.sum()) for factor, v in values.iteritems()}
+
+        return totals, int(known.sum())
+
+
+_coefficients = {}
+_coefficients_lock = threading.Lock()
+
+
+def get_region_coefficients(region):
+    with _coefficients_lock:
+        if region not in _coefficients:
+            _coefficients[region] = RegionCoefficients.load(region)
+        return _coefficients[region]
+
+
+def _code_overrides(instance, region):
+    """
+    A dictionary of species id to the i-Tree code that the instance
+    uses for it in a region, for species whose code is overridden
+    """
+    overrides = ITreeCodeOverride.objects\
+        .filter(instance_species__instance=instance)\
+        .filter(region__code=region)\
+        .values_list('instance_species', 'itree_code')
+
+    return dict(overrides)
+
+
+class LocalBackend(object):
+    """
+    Computes benefits in process from i-Tree coefficient tables, rather
+    than calling out to the eco service
+    """
+
+    def _itree_code(self, region, species_id, otm_code, overrides):
+        return overrides.get(species_id) or get_itree_code(region, otm_code)
+
+    def tree_benefits(self, instance, region, species, diameter):
+        coefficients = get_region_coefficients(region)
+        overrides = _code_overrides(instance, region)
+
+        itree_code = self._itree_code(region, species.pk, species.otm_code,
+                                      overrides)
+        code_index = coefficients.code_index(itree_code)
+
+        if code_index < 0:
+            return (None, BAD_CODE_PAIR)
+
+        benefits, _ = coefficients.benefits([diameter], [code_index])
+
+        return (benefits, None)
+
+    def batch_tree_benefits(self, instance, trees):
+        by_region = {}
+        for key, region, species, diameter in trees:
+            by_region.setdefault(region, []).append((key, species, diameter))
+
+        results = {}
+        for region, region_trees in by_region.iteritems():
+            coefficients = get_region_coefficients(region)
+            overrides = _code_overrides(instance, region)
+
+            keys, diameters, code_indexes = [], [], []
+            for key, species, diameter in region_trees:
+                code_index = coefficients.code_index(self._itree_code(
+                    region, species.pk, species.otm_code, overrides))
+
+                if code_index < 0:
+                    results[key] = (None, BAD_CODE_PAIR)
+                else:
+                    keys.append(key)
+                    diameters.append(diameter)
+                    code_indexes.append(code_index)
+
+            if keys:
+                values = coefficients.tree_benefits(diameters, code_indexes)
+                for i, key in enumerate(keys):
+                    benefits = {factor: float(v[i])
+                                for factor, v in values.iteritems()}
+                    results[key] = (benefits, None)
+
+        return results
+
+    def _region_benefits(self, instance, trees, region):
+        coefficients = get_region_coefficients(region)
+        overrides = _code_overrides(instance, region)
+
+        rows = trees.values_list('diameter', 'species',
+                                 'species__otm_code')
+
+        # Look up each species once, rather than once per tree
+        code_indexes = {}
+        diameters = []
+        tree_codes = []
+        for diameter, species_id, otm_code in rows.iterator():
+            if species_id not in code_indexes:
+                code_indexes[species_id] = coefficients.code_index(
+                    self._itree_code(region, species_id, otm_code,
+                                     overrides))
+
+            diameters.append(diameter)
+            tree_codes.append(code_indexes[species_id])
+
+        return coefficients.benefits(diameters, tree_codes)
+
+    def summary_benefits(self, instance, trees, region):
+        if region:
+            trees_by_region = [(region, trees)]
+        else:
+            regions = ITreeRegion.objects\
+                .filter(code__in=instance_regions(instance))
+            trees_by_region = [
+                (r.code, trees.filter(plot__geom__within=r.geometry))
+                for r in regions]
+
+        summary = dict.fromkeys(FACTORS, 0.0)
+        summary['n_trees'] = 0
+
+        for code, region_trees in trees_by_region:
+            benefits, n_trees = self._region_benefits(
+                instance, region_trees, code)
+
+            for factor, value in benefits.iteritems():
+                summary[factor] += value
+            summary['n_trees'] += n_trees
+
+        return (summary, None)
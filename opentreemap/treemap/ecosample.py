@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import hashlib
+import math
+
+from bisect import bisect_right
+
+from treemap.ecobackend import BENEFITS_UNAVAILABLE, FACTORS
+from treemap.exceptions import EcoServiceUnavailable
+from treemap.models import Tree
+
+# Upper bounds (in inches) of the diameter classes that trees are
+# stratified by, along with their species
+DIAMETER_CLASSES = (3, 6, 12, 18, 24, 30, 36)
+
+# Every stratum gets at least this many samples (or all of its trees)
+# so that its variance can be estimated
+MIN_STRATUM_SAMPLES = 2
+
+# z-score of the reported confidence interval
+CONFIDENCE = 0.95
+Z_SCORE = 1.96
+
+
+def diameter_class(diameter):
+    return bisect_right(DIAMETER_CLASSES, diameter)
+
+
+def sample_rank(seed, tree_id):
+    """
+    A pseudo-random ordering of trees that only depends on the seed and
+    the tree, so that the same trees are sampled on every request and
+    adding a tree only changes the sample of its own stratum
+    """
+    return hashlib.md5('%s:%s' % (seed, tree_id)).hexdigest()
+
+
+def allocate(stratum_sizes, sample_size):
+    """
+    Split sample_size between strata in proportion to their size, with
+    at least MIN_STRATUM_SAMPLES (or all of its trees) in each.
+
+    The total is capped at sample_size, unless the minimums alone add up
+    to more, which stratified_sample avoids by merging strata.
+
+    Returns a dictionary of stratum to number of samples
+    """
+    population = sum(stratum_sizes.itervalues())
+
+    allocation = {stratum: min(size, max(MIN_STRATUM_SAMPLES, int(round(
+        sample_size * size / population))))
+        for stratum, size in stratum_sizes.iteritems()}
+
+    # Rounding and the minimums can take the total over sample_size, so
+    # the excess comes out of the strata with the most samples
+    excess = sum(allocation.itervalues()) - sample_size
+    for stratum in sorted(allocation,
+                          key=lambda stratum: (-allocation[stratum], stratum)):
+        if excess <= 0:
+            break
+        trim = min(excess, max(allocation[stratum] - MIN_STRATUM_SAMPLES, 0))
+        allocation[stratum] -= trim
+        excess -= trim
+
+    return allocation
+
+
+def merge_strata(strata, max_strata):
+    """
+    Merge a dictionary of (species id, diameter class) to tree ids into
+    at most max_strata strata. The diameter classes of the species with
+    the fewest trees are merged first, and if that isn't enough the
+    smallest species are merged into a single stratum.
+    """
+    by_species = {}
+    for stratum, ids in strata.iteritems():
+        by_species.setdefault(stratum[0], []).append(stratum)
+
+    def species_size(species_id):
+        return (sum(len(strata[s]) for s in by_species[species_id]),
+                species_id)
+
+    species_ids = sorted(by_species, key=species_size)
+
+    merged = dict(strata)
+    for species_id in species_ids:
+        merged[(species_id, None)] = [tree_id
+                                      for stratum in by_species[species_id]
+                                      for tree_id in merged.pop(stratum)]
+        if len(merged) <= max_strata:
+            return merged
+
+    # Every species is now a single stratum
+    n_other = len(merged) - max_strata + 1
+    merged[None] = [tree_id for species_id in species_ids[:n_other]
+                    for tree_id in merged.pop((species_id, None))]
+
+    return merged
+
+
+def stratified_sample(rows, sample_size, seed):
+    """
+    Draw a stratified sample of (id, species id, diameter) rows. If
+    there are too many strata for each to get MIN_STRATUM_SAMPLES, they
+    are merged (see merge_strata) so that the sample stays within
+    sample_size.
+
+    Returns a dictionary of stratum to a tuple of (number of rows in the
+    stratum, ids of the sampled rows)
+    """
+    strata = {}
+    for tree_id, species_id, diameter in rows:
+        stratum = (species_id, diameter_class(diameter))
+        strata.setdefault(stratum, []).append(tree_id)
+
+    max_strata = max(sample_size // MIN_STRATUM_SAMPLES, 1)
+    if len(strata) > max_strata:
+        strata = merge_strata(strata, max_strata)
+
+    allocation = allocate({k: len(v) for k, v in strata.iteritems()},
+                          sample_size)
+
+    sample = {}
+    for stratum, ids in strata.iteritems():
+        ids.sort(key=lambda tree_id: sample_rank(seed, tree_id))
+        sample[stratum] = (len(ids), ids[:allocation[stratum]])
+
+    return sample
+
+
+def estimate_total(strata):
+    """
+    The stratified estimate of a population total, given a list of
+    (stratum size, sampled values) pairs.
+
+    Returns a tuple of (total, margin of error at CONFIDENCE)
+    """
+    total = variance = 0.0
+
+    for size, values in strata:
+        n = len(values)
+        if n == 0:
+            continue
+
+        mean = sum(values) / n
+        total += size * mean
+
+        if 1 < n < size:
+            s2 = sum((v - mean) ** 2 for v in values) / (n - 1)
+            variance += size * size * (1 - n / size) * s2 / n
+
+    return total, Z_SCORE * math.sqrt(variance)
+
+
+def sampled_benefits(instance, trees, sample_size, seed):
+    """
+    Estimate the summary benefits of trees from a stratified sample of
+    them, in the same form as benefits_for_trees. Each group also gets
+    a 'margin' and 'currency_margin' giving the half-width of its
+    confidence interval, and the number of trees is estimated in the
+    same way as the benefits.
+
+    Returns a tuple of (benefits, estimated number of trees with
+    benefits)
+    """
+    # Imported here since ecobenefits decides when to sample
+    from treemap.ecobenefits import (batch_tree_benefits,
+                                     _compute_currency_and_transform_units)
+
+    sample = stratified_sample(
+        trees.values_list('pk', 'species', 'diameter').iterator(),
+        sample_size, seed)
+
+    sample_ids = [tree_id for __, ids in sample.itervalues()
+                  for tree_id in ids]
+
+    sampled_trees = Tree.objects.filter(pk__in=sample_ids)\
+                                .select_related('species', 'plot')
+    tree_rslts = batch_tree_benefits(instance, sampled_trees)
+
+    # Report every group, as the exact calculation does, even when none
+    # of the sampled trees have benefits
+    zeros, __ = _compute_currency_and_transform_units(
+        instance, {factor: 0 for factor in FACTORS})
+    units = {group: benefit['unit'] for group, benefit in zeros.iteritems()}
+
+    strata = []
+    for size, ids in sample.itervalues():
+        values = []
+        for tree_id in ids:
+            rslt = tree_rslts.get(tree_id, {})
+            error = rslt.get('error')
+
+            if error == BENEFITS_UNAVAILABLE:
+                # An estimate missing some trees would be biased
+                raise EcoServiceUnavailable()
+            elif error:
+                values.append(None)
+            else:
+                values.append(rslt['tree_benefits'])
+        strata.append((size, values))
+
+    def estimate(value_fn):
+        return estimate_total([(size, [value_fn(v) for v in values])
+                               for size, values in strata])
+
+    ntrees, __ = estimate(lambda b: 0 if b is None else 1)
+
+    benefits = {}
+    for group, unit in units.iteritems():
+        value, margin = estimate(
+            lambda b: 0 if b is None else b[group]['value'])
+        currency, currency_margin = estimate(
+            lambda b: 0 if b is None else b[group]['currency'] or 0)
+
+        benefits[group] = {'value': value,
+                           'margin': margin,
+                           'currency': currency or None,
+                           'currency_margin': currency_margin,
+                           'unit': unit}
+
+    return benefits, int(round(ntrees))
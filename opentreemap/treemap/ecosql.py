@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.db import connection, transaction
+
+from treemap.ecobackend import FACTORS
+from treemap.ecolocal import (LocalBackend, RegionCoefficients,
+                              CM_PER_INCH)
+from treemap.regions import instance_regions
+from treemap.species import itree_codes_for_region
+
+# Each row of treemap_itree_coefficient covers the diameters (in cm)
+# from dbh_min up to dbh_max of one i-Tree code, over which each factor
+# is <factor>_a + <factor>_b * dbh. Diameters outside of the
+# breakpoints get the value at the nearest one, as in ecolocal.
+COEFFICIENT_COLUMNS = (('region', 'itree_code', 'dbh_min', 'dbh_max') +
+                       tuple(column for factor in FACTORS
+                             for column in (factor + '_a', factor + '_b')))
+
+_SUMMARY_SQL = """
+WITH trees (diameter, species_id, otm_code{geom_column}) AS ({trees}),
+coded AS (
+    SELECT trees.diameter * {cm_per_inch} AS dbh,
+           r.code AS region,
+           COALESCE(o.itree_code, s.itree_code) AS itree_code
+    FROM trees
+    JOIN treemap_itreeregion r ON {region_join}
+    LEFT JOIN treemap_itreecodeoverride o
+           ON o.instance_species_id = trees.species_id
+          AND o.region_id = r.id
+    LEFT JOIN treemap_itree_species_code s
+           ON s.region = r.code
+          AND s.otm_code = trees.otm_code
+)
+SELECT COUNT(*){sums}
+FROM coded
+JOIN treemap_itree_coefficient c
+  ON c.region = coded.region
+ AND c.itree_code = coded.itree_code
+ AND coded.dbh >= c.dbh_min
+ AND coded.dbh < c.dbh_max
+"""
+
+
+def coefficient_rows(region, coefficients):
+    """
+    The rows of treemap_itree_coefficient for a RegionCoefficients
+    """
+    breakpoints = list(coefficients.breakpoints)
+    inf = float('inf')
+
+    for itree_code, code_index in coefficients.codes.iteritems():
+        curves = coefficients.values[:, code_index]
+
+        # (dbh_min, dbh_max, [(a, b) for each factor])
+        segments = [(-inf, breakpoints[0],
+                     [(curve[0], 0.0) for curve in curves])]
+
+        for i in range(len(breakpoints) - 1):
+            lo, hi = breakpoints[i], breakpoints[i + 1]
+            segment = []
+            for curve in curves:
+                b = (curve[i + 1] - curve[i]) / (hi - lo)
+                segment.append((curve[i] - b * lo, b))
+            segments.append((lo, hi, segment))
+
+        segments.append((breakpoints[-1], inf,
+                         [(curve[-1], 0.0) for curve in curves]))
+
+        for dbh_min, dbh_max, segment in segments:
+            yield ((region, itree_code, dbh_min, dbh_max) +
+                   tuple(float(v) for ab in segment for v in ab))
+
+
+def load_region(region, coefficients):
+    """
+    Replace the coefficients and species codes of a region in the
+    lookup tables used by SqlBackend
+    """
+    cursor = connection.cursor()
+
+    cursor.execute('DELETE FROM treemap_itree_coefficient '
+                   'WHERE region = %s', [region])
+    cursor.executemany(
+        'INSERT INTO treemap_itree_coefficient (%s) VALUES (%s)'
+        % (', '.join(COEFFICIENT_COLUMNS),
+           ', '.join(['%s'] * len(COEFFICIENT_COLUMNS))),
+        list(coefficient_rows(region, coefficients)))
+
+    cursor.execute('DELETE FROM treemap_itree_species_code '
+                   'WHERE region = %s', [region])
+    cursor.executemany(
+        'INSERT INTO treemap_itree_species_code '
+        '(region, otm_code, itree_code) VALUES (%s, %s, %s)',
+        [(region, otm_code, itree_code) for otm_code, itree_code
+         in itree_codes_for_region(region).iteritems()])
+
+    transaction.commit_unless_managed()
+
+
+def load_regions(regions):
+    for region in regions:
+        load_region(region, RegionCoefficients.load(region))
+
+
+class SqlBackend(LocalBackend):
+    """
+    Calculates summary benefits in the database, with a single query
+    joining the trees to i-Tree coefficient tables loaded by the
+    load_itree_coefficients command. Per-tree benefits are calculated
+    in process, from the same files as LocalBackend.
+    """
+
+    def summary_benefits(self, instance, trees, region):
+        values = ('diameter', 'species', 'species__otm_code')
+
+        if region:
+            region_join = 'r.code = %s'
+            region_params = [region]
+        else:
+            regions = instance_regions(instance)
+            if not regions:
+                summary = dict.fromkeys(FACTORS, 0.0)
+                summary['n_trees'] = 0
+                return (summary, None)
+
+            values += ('plot__geom',)
+            region_join = ('r.code IN %s '
+                           'AND ST_Contains(r.geometry, trees.geom)')
+            region_params = [tuple(regions)]
+
+        trees_sql, trees_params = trees.values_list(*values)\
+                                       .query.sql_with_params()
+
+        sums = ''.join(
+            ',\n       COALESCE(SUM(c.{0}_a + c.{0}_b * coded.dbh), 0)'
+            .format(factor) for factor in FACTORS)
+
+        sql = _SUMMARY_SQL.format(
+            geom_column='' if region else ', geom',
+            trees=trees_sql,
+            cm_per_inch=CM_PER_INCH,
+            region_join=region_join,
+            sums=sums)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, list(trees_params) + region_params)
+        row = cursor.fetchone()
+
+        summary = dict(zip(FACTORS, row[1:]))
+        summary['n_trees'] = row[0]
+
+        return (summary, None)
@@ -14,3 +14,7 @@ class InvalidInstanceException(Exception):
 
 class FeatureNotEnabledException(Exception):
     pass
+
+
+class EcoServiceUnavailable(Exception):
+    pass
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import DateField, DateTimeField, FloatField, IntegerField
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.translation import ugettext as trans
+
+from treemap.models import MapFeature, Plot, Tree, Species
+from treemap.search import subquery_sql
+
+# Width of histogram buckets for numeric RANGE fields. Date fields
+# are always bucketed by year.
+DEFAULT_BUCKET_SIZE = 5
+
+# Table aliases used in the facet query
+_ALIASES = {
+    MapFeature: 'f',
+    Plot: 'pl',
+    Tree: 't',
+    Species: 's',
+}
+
+_MODELS = {
+    'plot': Plot,
+    'mapFeature': MapFeature,
+    'tree': Tree,
+    'species': Species,
+}
+
+
+def _column(identifier):
+    """
+    SQL for the column behind a search identifier like 'tree.diameter',
+    along with the django field. Returns (None, None) for identifiers
+    that can't be faceted (e.g. udfs)
+    """
+    model_name, field_name = identifier.split('.', 1)
+    model = _MODELS.get(model_name)
+
+    if model is None or field_name.startswith('udf:'):
+        return None, None
+
+    try:
+        field, field_model, _, _ = model._meta.get_field_by_name(field_name)
+    except FieldDoesNotExist:
+        raise ValidationError(
+            trans('Unknown search field: %s') % identifier)
+    table_model = field_model or model
+
+    return '%s.%s' % (_ALIASES[table_model], field.column), field
+
+
+def _isnull_sql(identifier):
+    if identifier == 'treePhoto.id':
+        # Checked with a subquery so that trees with several photos
+        # don't multiply the rows being counted
+        return ('NOT EXISTS (SELECT 1 FROM treemap_treephoto ph '
+                'WHERE ph.tree_id = t.id)')
+
+    column, _ = _column(identifier)
+    if column:
+        return '%s IS NULL' % column
+    else:
+        return None
+
+
+def _histogram_sql(identifier):
+    column, field = _column(identifier)
+
+    if isinstance(field, (DateField, DateTimeField)):
+        return 'EXTRACT(YEAR FROM %s)' % column, 1
+    elif isinstance(field, (FloatField, IntegerField)):
+        return ('FLOOR(%s / %s) * %s' % (column, DEFAULT_BUCKET_SIZE,
+                                         DEFAULT_BUCKET_SIZE),
+                DEFAULT_BUCKET_SIZE)
+    else:
+        return None, None
+
+
+def _facet_columns(instance):
+    """
+    The facets to compute for an instance, as a list of
+    (kind, field, sql) tuples. Kind is either 'histogram' or 'isnull'.
+    """
+    facets = []
+    for fields in instance.advanced_search_fields.itervalues():
+        for field in fields:
+            identifier = field.get('identifier')
+            search_type = field.get('search_type')
+
+            if not identifier:
+                continue
+            elif search_type == 'RANGE':
+                sql, bucket_size = _histogram_sql(identifier)
+                if sql:
+                    field = dict(field, bucket_size=bucket_size)
+                    facets.append(('histogram', field, sql))
+            elif search_type == 'ISNULL':
+                sql = _isnull_sql(identifier)
+                if sql:
+                    facets.append(('isnull', field, sql))
+
+    return facets
+
+
+def search_facets(instance, plots):
+    """
+    Compute the species breakdown, along with a histogram for each
+    RANGE field and a count for each ISNULL field of the instance's
+    advanced search fields, for the given plot queryset.
+
+    The matching rows are gathered once (in a CTE), and each facet is
+    then grouped or counted on its own and the results stacked with
+    UNION ALL, so the number of rows returned is the sum of the facet
+    sizes rather than their product.
+    """
+    facets = _facet_columns(instance)
+
+    plot_sql, params = subquery_sql(plots)
+
+    columns = ['s.id AS species_id', 's.common_name']
+    selects = ["SELECT 'total'::text, NULL::double precision, NULL::text, "
+               "COUNT(*) FROM facet_rows",
+               "SELECT 'species', species_id, common_name, COUNT(*) "
+               "FROM facet_rows WHERE species_id IS NOT NULL "
+               "GROUP BY species_id, common_name"]
+
+    for i, (kind, field, sql) in enumerate(facets):
+        if kind == 'histogram':
+            columns.append('(%s)::double precision AS facet_%s' % (sql, i))
+            selects.append("SELECT '%s', facet_%s, NULL, COUNT(*) "
+                           "FROM facet_rows WHERE facet_%s IS NOT NULL "
+                           "GROUP BY facet_%s" % (i, i, i, i))
+        else:
+            wants_null = unicode(field.get('value', 'true')).lower() \
+                == 'true'
+            columns.append('(%s) AS facet_%s' % (sql, i))
+            selects.append("SELECT '%s', NULL, NULL, COUNT(*) "
+                           "FROM facet_rows WHERE %sfacet_%s"
+                           % (i, '' if wants_null else 'NOT ', i))
+
+    sql = ('WITH facet_rows AS ('
+           '  SELECT %s '
+           '  FROM treemap_mapfeature f '
+           '  JOIN treemap_plot pl ON pl.mapfeature_ptr_id = f.id '
+           '  LEFT JOIN treemap_tree t ON t.plot_id = f.id '
+           '  LEFT JOIN treemap_species s ON s.id = t.species_id '
+           '  WHERE f.id IN (%s)'
+           ') %s' % (', '.join(columns), plot_sql,
+                     ' UNION ALL '.join(selects)))
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+
+    total = 0
+    species = []
+    histograms = defaultdict(list)
+    counts = {}
+
+    for facet, value, label, count in cursor.fetchall():
+        if facet == 'total':
+            total = count
+        elif facet == 'species':
+            species.append({'id': int(value),
+                            'common_name': label,
+                            'count': count})
+        elif facets[int(facet)][0] == 'histogram':
+            histograms[int(facet)].append((value, count))
+        else:
+            counts[int(facet)] = count
+
+    result = {
+        'total': total,
+        'species': sorted(species, key=lambda s: -s['count']),
+        'histograms': {},
+        'counts': {}
+    }
+
+    for i, (kind, field, _) in enumerate(facets):
+        if kind == 'histogram':
+            size = field['bucket_size']
+            result['histograms'][field['id']] = {
+                'identifier': field['identifier'],
+                'buckets': [{'min': int(start),
+                             'max': int(start) + size,
+                             'count': n}
+                            for start, n in sorted(histograms[i])]
+            }
+        else:
+            result['counts'][field['id']] = {
+                'identifier': field['identifier'],
+                'label': field.get('label'),
+                'count': counts.get(i, 0)
+            }
+
+    return result
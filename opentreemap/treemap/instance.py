@@ -75,6 +75,18 @@ class Instance(models.Model):
     """
     geo_rev = models.IntegerField(default=1)
 
+    """
+    The revision of the instance's searchable data
+
+    Cached search counts and summaries are keyed on it. It is advanced
+    by treemap.cache.bump_revision whenever an audit that might change
+    search results is written, and kept here rather than in the cache
+    so that every process sees the same revision.
+
+    You should *not* edit this field.
+    """
+    search_rev = models.IntegerField(default=1)
+
     eco_benefits_conversion = models.ForeignKey(
         'BenefitCurrencyConversion', null=True, blank=True)
 
@@ -138,6 +150,17 @@ class Instance(models.Model):
 
     map_feature_types = _make_config_property('map_feature_types', ['Plot'])
 
+    # Diameters are rounded to a multiple of this many inches before
+    # calculating per-tree benefits, so that more trees share a cached
+    # result. None uses the exact diameter
+    eco_diameter_quantum = _make_config_property('eco_diameter_quantum')
+
+    # Summary benefits of more than this many trees are estimated from a
+    # sample of eco_sample_size trees. None always calculates every tree
+    eco_sample_threshold = _make_config_property('eco_sample_threshold')
+
+    eco_sample_size = _make_config_property('eco_sample_size', 2000)
+
     @property
     def advanced_search_fields(self):
         from treemap.models import MapFeature  # prevent circular import
@@ -257,12 +280,9 @@ class Instance(models.Model):
         return names
 
     def has_itree_region(self):
-        from treemap.models import ITreeRegion  # prevent circular import
-        intersecting_regions = (ITreeRegion
-                                .objects
-                                .filter(geometry__intersects=self.bounds))
+        from treemap.regions import instance_regions  # prevent circular import
 
-        return bool(self.itree_region_default) or intersecting_regions.exists()
+        return bool(instance_regions(self))
 
     def is_accessible_by(self, user):
         try:
@@ -291,8 +311,21 @@ class Instance(models.Model):
         return feature_enabled(self, feature)
 
     def save(self, *args, **kwargs):
+        # prevent circular import
+        from treemap.models import TreeBenefit
+        from treemap.util import save_kwargs_without_counter
+
         self.full_clean()
 
         self.url_name = self.url_name.lower()
 
-        super(Instance, self).save(*args, **kwargs)
+        region_changed = self.pk is not None and Instance.objects\
+            .filter(pk=self.pk)\
+            .exclude(itree_region_default=self.itree_region_default)\
+            .exists()
+
+        kwargs = save_kwargs_without_counter(self, 'search_rev', args, kwargs)
+        super(Instance, self).save(**kwargs)
+
+        if region_changed:
+            TreeBenefit.schedule_update(instance=self.pk)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from treemap.auditarchive import archive_audits, archive_cutoff
+
+
+class Command(BaseCommand):
+    """
+    Move audits older than AUDIT_ARCHIVE_MONTHS (or --months) months out
+    of treemap_audit and into archive tables split by instance id range
+    and month. Run it once to partition the existing audits, after which
+    the monthly celery beat task keeps archiving them.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-m', '--months',
+                    action='store',
+                    type='int',
+                    dest='months',
+                    default=None,
+                    help='Archive audits older than this many months'),
+        make_option('-p', '--instances-per-partition',
+                    action='store',
+                    type='int',
+                    dest='instances_per_partition',
+                    default=None,
+                    help='Number of instance ids in each archive table'))
+
+    def handle(self, *args, **options):
+        cutoff = archive_cutoff(options['months'])
+        if cutoff is None:
+            raise CommandError('Set AUDIT_ARCHIVE_MONTHS or pass --months')
+
+        moved = archive_audits(cutoff, options['instances_per_partition'])
+
+        for name, count in sorted(moved.iteritems()):
+            print('%10d  %s' % (count, name))
+
+        print('Archived %s audits created before %s' % (
+            sum(moved.itervalues()), cutoff.date()))
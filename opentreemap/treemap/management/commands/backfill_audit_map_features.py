@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from treemap.models import MapFeature
+from treemap.util import leaf_subclasses
+
+# The latest plot of every tree that has one in the audits
+TREE_PLOTS_SQL = """
+tree_plots AS (
+    SELECT DISTINCT ON (model_id) model_id AS tree_id, map_feature_id
+    FROM treemap_audit
+    WHERE model = 'Tree' AND map_feature_id IS NOT NULL
+    ORDER BY model_id, created DESC, id DESC
+)"""
+
+# The latest value of an id field of each object of a model, e.g. the
+# tree of each tree photo. Applied values win over pending ones.
+LATEST_ID_SQL = """
+    SELECT DISTINCT ON (model, model_id)
+           model, model_id, current_value::integer AS value_id
+    FROM treemap_audit
+    WHERE {where} AND current_value ~ '^[0-9]+$'
+    ORDER BY model, model_id, requires_auth, created DESC, id DESC
+"""
+
+TREE_PLOT_IDS_SQL = LATEST_ID_SQL.format(
+    where="model = 'Tree' AND field = 'plot'")
+
+PHOTO_TREE_IDS_SQL = LATEST_ID_SQL.format(
+    where="model = 'TreePhoto' AND field = 'tree'")
+
+COLLECTION_MODEL_IDS_SQL = LATEST_ID_SQL.format(
+    where="model LIKE 'udf:%%' AND field = 'model_id'")
+
+# Each statement only fills in audits without a map feature, so later
+# ones can fall back on what earlier ones found. Audits of objects that
+# still exist are matched through their tables, and audits of deleted
+# ones through the audits of their id fields.
+STATEMENTS = (
+    ('map features', """
+UPDATE treemap_audit SET map_feature_id = model_id
+WHERE map_feature_id IS NULL AND model IN %(map_feature_models)s
+"""),
+    ('trees', """
+UPDATE treemap_audit a SET map_feature_id = t.plot_id
+FROM treemap_tree t
+WHERE a.map_feature_id IS NULL AND a.model = 'Tree' AND a.model_id = t.id
+"""),
+    ('deleted trees', """
+UPDATE treemap_audit a SET map_feature_id = p.value_id
+FROM (""" + TREE_PLOT_IDS_SQL + """) p
+WHERE a.map_feature_id IS NULL AND a.model = 'Tree'
+  AND a.model_id = p.model_id
+"""),
+    ('tree photos', """
+UPDATE treemap_audit a SET map_feature_id = t.plot_id
+FROM treemap_treephoto ph JOIN treemap_tree t ON t.id = ph.tree_id
+WHERE a.map_feature_id IS NULL AND a.model = 'TreePhoto'
+  AND a.model_id = ph.id
+"""),
+    ('deleted tree photos', """
+WITH""" + TREE_PLOTS_SQL + """
+UPDATE treemap_audit a SET map_feature_id = tp.map_feature_id
+FROM (""" + PHOTO_TREE_IDS_SQL + """) ph
+JOIN tree_plots tp ON tp.tree_id = ph.value_id
+WHERE a.map_feature_id IS NULL AND a.model = 'TreePhoto'
+  AND a.model_id = ph.model_id
+"""),
+    ('collection udfs', """
+WITH""" + TREE_PLOTS_SQL + """
+UPDATE treemap_audit a
+SET map_feature_id = CASE WHEN d.model_type = 'Tree'
+                          THEN tp.map_feature_id
+                          ELSE c.value_id END
+FROM (""" + COLLECTION_MODEL_IDS_SQL + """) c
+JOIN treemap_userdefinedfielddefinition d ON c.model = 'udf:' || d.id
+LEFT JOIN tree_plots tp ON tp.tree_id = c.value_id
+WHERE a.map_feature_id IS NULL AND a.model = c.model
+  AND a.model_id = c.model_id
+  AND d.model_type IN %(udf_models)s
+"""))
+
+
+class Command(BaseCommand):
+    """
+    Fill in the map feature of the audits of map features, trees, tree
+    photos and collection UDFs that were written before audits had one
+    """
+
+    def handle(self, *args, **options):
+        map_feature_models = tuple(
+            c.__name__ for c in leaf_subclasses(MapFeature))
+
+        params = {'map_feature_models': map_feature_models,
+                  'udf_models': map_feature_models + ('Tree',)}
+
+        cursor = connection.cursor()
+        for name, sql in STATEMENTS:
+            cursor.execute(sql, params)
+            print('Updated %s audits of %s' % (cursor.rowcount, name))
+            transaction.commit_unless_managed()
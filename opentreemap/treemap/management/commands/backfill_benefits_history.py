@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from treemap.ecohistory import backfill_benefits_history
+from treemap.models import Instance
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the daily eco benefits history of every instance (or of
+    one instance) from its tree audits, up to yesterday
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    default=None,
+                    help='Only rebuild the history of this instance id'),)
+
+    def handle(self, *args, **options):
+        instances = Instance.objects.order_by('pk')
+        if options['instance']:
+            instances = instances.filter(pk=options['instance'])
+
+        for instance in instances:
+            if not instance.has_itree_region():
+                continue
+
+            with transaction.commit_on_success():
+                backfill_benefits_history(instance)
+
+            print('Rebuilt the benefits history of %s' % instance.url_name)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from treemap.ecobenefits import update_tree_benefits
+from treemap.models import Tree
+
+
+class Command(BaseCommand):
+    """
+    Calculate the stored benefits of every tree (or the trees of one
+    instance)
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--instance',
+                    action='store',
+                    type='int',
+                    dest='instance',
+                    default=None,
+                    help='Only update trees of this instance id'),
+        make_option('-b', '--batch-size',
+                    action='store',
+                    type='int',
+                    dest='batch_size',
+                    default=1000,
+                    help='Number of trees to update per transaction'))
+
+    def handle(self, *args, **options):
+        trees = Tree.objects.order_by('pk')
+        if options['instance']:
+            trees = trees.filter(instance_id=options['instance'])
+
+        batch_size = options['batch_size']
+        ids = list(trees.values_list('pk', flat=True))
+
+        for start in xrange(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+
+            with transaction.commit_on_success():
+                update_tree_benefits(Tree.objects.filter(pk__in=batch))
+
+            self.stdout.write('Updated %s of %s trees'
+                              % (start + len(batch), len(ids)))
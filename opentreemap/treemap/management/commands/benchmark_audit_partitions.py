@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from treemap.auditarchive import archive_audits, archive_cutoff
+
+AUDIT_COLUMNS = ('id serial, model varchar(255), model_id integer, '
+                 'instance_id integer, field varchar(255), '
+                 'user_id integer, action integer, requires_auth boolean, '
+                 'map_feature_id integer, ref_id integer, '
+                 'created timestamp with time zone, '
+                 'updated timestamp with time zone')
+
+# Name, SQL with {table}, parameters (with 'instance' and 'cutoff'
+# standing in for their values)
+QUERIES = (
+    # What _get_audits runs for /edits with its default parameters
+    ('default edits feed',
+     "SELECT id FROM {table} WHERE (model IN ('Plot', 'Tree') "
+     "  OR (model = 'TreePhoto' AND field = 'image')) "
+     'AND instance_id = %s AND created >= %s '
+     'ORDER BY created DESC, id DESC LIMIT 21',
+     ('instance', 'cutoff')),
+    ('instance feed',
+     'SELECT id FROM {table} WHERE instance_id = %s AND created >= %s '
+     'ORDER BY created DESC, id LIMIT 20',
+     ('instance', 'cutoff')),
+    ('instance count',
+     'SELECT COUNT(*) FROM {table} WHERE instance_id = %s '
+     'AND created >= %s',
+     ('instance', 'cutoff')),
+    ('model feed',
+     "SELECT id FROM {table} WHERE model = 'Tree' AND created >= %s "
+     'ORDER BY created DESC, id LIMIT 20',
+     ('cutoff',)),
+    ('instance count, archived',
+     'SELECT COUNT(*) FROM {table} WHERE instance_id = %s',
+     ('instance',)))
+
+
+class Command(BaseCommand):
+    """
+    Compare the edit feed queries on a synthetic audit table, with all
+    of the audits in one table and with the older ones archived into
+    tables by instance range and month. The tables are temporary, so
+    no real data is touched.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--number-of-rows',
+                    action='store',
+                    type='int',
+                    dest='n',
+                    default=5000000,
+                    help='Number of audits to generate'),
+        make_option('-i', '--instances',
+                    action='store',
+                    type='int',
+                    dest='instances',
+                    default=500,
+                    help='Number of instances the audits are spread over'),
+        make_option('-s', '--span',
+                    action='store',
+                    type='int',
+                    dest='span',
+                    default=36,
+                    help='Number of months the audits are spread over'),
+        make_option('-m', '--months',
+                    action='store',
+                    type='int',
+                    dest='months',
+                    default=6,
+                    help='Archive audits older than this many months'),
+        make_option('-p', '--instances-per-partition',
+                    action='store',
+                    type='int',
+                    dest='instances_per_partition',
+                    default=100,
+                    help='Number of instance ids in each archive table'),
+        make_option('-r', '--repeat',
+                    action='store',
+                    type='int',
+                    dest='repeat',
+                    default=5,
+                    help='Number of times to run each query'))
+
+    def _create_table(self, cursor, table):
+        cursor.execute('CREATE TEMPORARY TABLE %s (%s)'
+                       % (table, AUDIT_COLUMNS))
+        cursor.execute('CREATE INDEX %s_instance_created ON %s '
+                       '(instance_id, created)' % (table, table))
+        cursor.execute('CREATE INDEX %s_model_model_id ON %s '
+                       '(model, model_id)' % (table, table))
+
+    def _time(self, cursor, sql, params, repeat):
+        timings = []
+        for __ in range(repeat):
+            start = time.time()
+            cursor.execute(sql, params)
+            rows = len(cursor.fetchall())
+            timings.append(time.time() - start)
+
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = [row[0] for row in cursor.fetchall()]
+        tables = len([line for line in plan if ' on bench_audit' in line])
+
+        return rows, min(timings) * 1000, tables
+
+    def _run_queries(self, cursor, label, table, values, repeat):
+        print(label)
+        for name, sql, param_names in QUERIES:
+            params = [values[p] for p in param_names]
+            rows, ms, tables = self._time(
+                cursor, sql.format(table=table), params, repeat)
+            print('  %-26s %4d rows %10.2f ms  %4d tables scanned' % (
+                name, rows, ms, tables))
+
+    def handle(self, *args, **options):
+        n = options['n']
+        span_seconds = options['span'] * 30 * 24 * 60 * 60
+
+        cursor = connection.cursor()
+        self._create_table(cursor, 'bench_audit')
+        self._create_table(cursor, 'bench_audit_parted')
+
+        # One audit in 50 is an unreviewed pending edit, which stays in
+        # the main table when the others are archived
+        cursor.execute(
+            'INSERT INTO bench_audit (model, model_id, instance_id, '
+            '    field, user_id, action, requires_auth, created, updated) '
+            "SELECT (ARRAY['Plot', 'Tree', 'TreePhoto'])[1 + mod(i, 3)], "
+            '       mod(i::bigint * 7919, %s), '
+            '       1 + mod(i::bigint * 31, %s), '
+            "       'diameter', 1 + mod(i, 97), 1, mod(i, 50) = 0, "
+            "       t, t "
+            'FROM (SELECT i, now() - interval \'1 second\' '
+            '                * mod(i::bigint * 104729, %s) AS t '
+            '      FROM generate_series(1, %s) AS i) AS g',
+            [max(n // 3, 1), options['instances'], span_seconds, n])
+        cursor.execute('INSERT INTO bench_audit_parted '
+                       'SELECT * FROM bench_audit')
+        cursor.execute('ANALYZE bench_audit')
+
+        print('Generated %s audits' % n)
+
+        cutoff = archive_cutoff(options['months'])
+
+        start = time.time()
+        moved = archive_audits(cutoff, options['instances_per_partition'],
+                               table='bench_audit_parted',
+                               temporary=True)
+        cursor.execute('ANALYZE bench_audit_parted')
+        for name in moved:
+            cursor.execute('ANALYZE %s' % name)
+        print('Archived %s audits into %s tables in %.2f s' % (
+            sum(moved.itervalues()), len(moved), time.time() - start))
+
+        values = {'instance': options['instances'] // 2,
+                  'cutoff': cutoff}
+
+        self._run_queries(cursor, 'One table', 'bench_audit',
+                          values, options['repeat'])
+        self._run_queries(cursor, 'Archived by instance and month',
+                          'bench_audit_parted', values,
+                          options['repeat'])
+
+        for name in moved:
+            cursor.execute('DROP TABLE %s' % name)
+        cursor.execute('DROP TABLE bench_audit_parted')
+        cursor.execute('DROP TABLE bench_audit')
+        transaction.commit_unless_managed()
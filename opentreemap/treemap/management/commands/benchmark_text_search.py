@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from treemap.textsearch import trigram_index_sql
+
+STREET_NAMES = ('Main', 'Oak', 'Maple', 'Chestnut', 'Walnut', 'Spruce',
+                'Pine', 'Market', 'Arch', 'Race', 'Vine', 'Locust',
+                'Broad', 'Cedar', 'Elm', 'Willow', 'Poplar', 'Cherry')
+
+STREET_TYPES = ('St', 'Ave', 'Rd', 'Blvd', 'Ln', 'Way')
+
+
+class Command(BaseCommand):
+    """
+    Compare 'LIKE' search on a synthetic table of street addresses with
+    and without a trigram index. The table is temporary, so no real
+    data is touched.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--number-of-rows',
+                    action='store',
+                    type='int',
+                    dest='n',
+                    default=500000,
+                    help='Number of addresses to generate'),
+        make_option('-q', '--query',
+                    action='append',
+                    dest='queries',
+                    default=None,
+                    help='Search text (may be given more than once)'),
+        make_option('-r', '--repeat',
+                    action='store',
+                    type='int',
+                    dest='repeat',
+                    default=5,
+                    help='Number of times to run each query'))
+
+    def _time(self, cursor, value, repeat):
+        # Same SQL that icontains generates
+        sql = ('SELECT COUNT(*) FROM benchmark_address '
+               'WHERE UPPER(address_street::text) LIKE UPPER(%s)')
+        params = ['%' + value + '%']
+
+        timings = []
+        for __ in range(repeat):
+            start = time.time()
+            cursor.execute(sql, params)
+            count = cursor.fetchone()[0]
+            timings.append(time.time() - start)
+
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = cursor.fetchone()[0]
+
+        return count, min(timings) * 1000, plan
+
+    def _run_queries(self, cursor, label, queries, repeat):
+        print(label)
+        for value in queries:
+            count, ms, plan = self._time(cursor, value, repeat)
+            print('  %-16s %8d rows %10.2f ms  %s' % (
+                value, count, ms, plan))
+
+    def handle(self, *args, **options):
+        n = options['n']
+        queries = options['queries'] or ['main', 'ut st', '12 che', 'zzz']
+
+        cursor = connection.cursor()
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        cursor.execute('CREATE TEMPORARY TABLE benchmark_address '
+                       '(id serial PRIMARY KEY, address_street varchar(255))')
+
+        streets = ', '.join("'%s'" % s for s in STREET_NAMES)
+        types = ', '.join("'%s'" % t for t in STREET_TYPES)
+        cursor.execute(
+            'INSERT INTO benchmark_address (address_street) '
+            'SELECT (1 + mod(i * 7919, 9999)) || \' \' '
+            '    || (ARRAY[%s])[1 + mod(i * 31, %s)] || \' \' '
+            '    || (ARRAY[%s])[1 + mod(i * 17, %s)] '
+            'FROM generate_series(1, %%s) AS i'
+            % (streets, len(STREET_NAMES), types, len(STREET_TYPES)), [n])
+        cursor.execute('ANALYZE benchmark_address')
+
+        print('Generated %s addresses' % n)
+
+        self._run_queries(cursor, 'Without index', queries,
+                          options['repeat'])
+
+        start = time.time()
+        cursor.execute(trigram_index_sql(
+            'benchmark_address_street_trgm', 'benchmark_address',
+            'UPPER(address_street::text)'))
+        cursor.execute('ANALYZE benchmark_address')
+        print('Built trigram index in %.2f s' % (time.time() - start))
+
+        self._run_queries(cursor, 'With trigram index', queries,
+                          options['repeat'])
+
+        cursor.execute('DROP TABLE benchmark_address')
+        transaction.commit_unless_managed()
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.core.management.base import BaseCommand
+
+from treemap.textsearch import create_udf_trigram_indexes
+
+
+class Command(BaseCommand):
+    """
+    Create trigram indexes for text udfs, so that 'LIKE' searches on
+    them don't have to scan every row. Run after adding udfs.
+    """
+
+    def handle(self, *args, **options):
+        created = create_udf_trigram_indexes()
+
+        for name in created:
+            print('Created %s' % name)
+
+        print('Created %s trigram index(es)' % len(created))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from treemap.ecosql import load_regions
+
+
+class Command(BaseCommand):
+    """
+    Load the i-Tree coefficient tables in ECO_COEFFICIENTS_DIR into the
+    database, for the 'sql' eco backend. Takes a list of region codes,
+    or loads every region that has a table. Rerun after changing the
+    tables.
+    """
+    args = '[region code ...]'
+
+    def handle(self, *args, **options):
+        if not settings.ECO_COEFFICIENTS_DIR:
+            raise CommandError('ECO_COEFFICIENTS_DIR is not set')
+
+        if args:
+            regions = args
+        else:
+            regions = sorted(
+                name[:-len('.csv')]
+                for name in os.listdir(settings.ECO_COEFFICIENTS_DIR)
+                if name.endswith('.csv'))
+
+        load_regions(regions)
+
+        for region in regions:
+            print('Loaded %s' % region)
@@ -13,7 +13,10 @@ from django.core.exceptions import ValidationError, MultipleObjectsReturned
 from django.core import validators
 from django.contrib.gis.db import models
 from django.contrib.gis.measure import D
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as trans
 
@@ -25,11 +28,12 @@ from treemap.species import ITREE_REGIONS
 from treemap.audit import (Auditable, Authorizable, FieldPermission, Role,
                            Dictable, Audit, AuthorizableQuerySet,
                            AuthorizableManager)
-from treemap.util import leaf_subclasses
+from treemap.util import leaf_subclasses, save_kwargs_without_counter
 from treemap.images import save_uploaded_image
 from treemap.units import Convertible
 from treemap.udf import UDFModel, GeoHStoreUDFManager, GeoHStoreUDFQuerySet
 from treemap.instance import Instance
+from treemap.cache import bump_revision
 
 
 def _action_format_string_for_location(action):
@@ -458,6 +462,14 @@ class Species(UDFModel, Authorizable, Auditable):
 
     objects = AuthorizableGeoHStoreUDFManager()
 
+    def save_with_user(self, user, *args, **kwargs):
+        code_changed = 'otm_code' in self._updated_fields()
+
+        super(Species, self).save_with_user(user, *args, **kwargs)
+
+        if code_changed and not self.is_pending_insert:
+            TreeBenefit.schedule_update(species=self.pk)
+
     @property
     def display_name(self):
         return "%s [%s]" % (self.common_name, self.scientific_name)
@@ -537,6 +549,10 @@ class MapFeature(Convertible, UDFModel, Authorizable, Auditable):
 
     readonly = models.BooleanField(default=False)
 
+    # Incremented by every write to the feature or its trees, and used
+    # for its hash
+    revision = models.IntegerField(default=0)
+
     objects = AuthorizableGeoHStoreUDFManager()
 
     # When querying MapFeatures (as opposed to querying a subclass like Plot),
@@ -551,6 +567,7 @@ class MapFeature(Convertible, UDFModel, Authorizable, Auditable):
             self.feature_type = self.map_feature_type
         self._do_not_track.add('feature_type')
         self._do_not_track.add('mapfeature_ptr')
+        self._do_not_track.add('revision')
         self.populate_previous_state()
 
     @property
@@ -561,13 +578,35 @@ class MapFeature(Convertible, UDFModel, Authorizable, Auditable):
     def is_plot(self):
         return isinstance(self, Plot)
 
+    @property
+    def audit_map_feature_id(self):
+        return self.pk
+
     def save_with_user(self, user, *args, **kwargs):
         self.full_clean_with_user(user)
 
         if self._is_generic:
             raise Exception(
                 'Never save a MapFeature -- only save a MapFeature subclass')
-        super(MapFeature, self).save_with_user(user, *args, **kwargs)
+
+        geom_changed = self.pk is None or 'geom' in self._updated_fields()
+
+        kwargs = save_kwargs_without_counter(self, 'revision', args, kwargs)
+        super(MapFeature, self).save_with_user(user, **kwargs)
+
+        if not self.is_pending_insert:
+            self.revision = MapFeature.increment_revision(self.pk)
+
+        if geom_changed and not self.is_pending_insert:
+            self._geom_saved()
+
+    def approved_changes_saved(self, fields):
+        if fields is None or 'geom' in fields:
+            self._geom_saved()
+
+    def _geom_saved(self):
+        MapFeatureBoundary.update_for_map_feature(self)
+        TreeBenefit.schedule_update(plot=self.pk)
 
     @property
     def map_feature_type(self):
@@ -627,14 +666,23 @@ class MapFeature(Convertible, UDFModel, Authorizable, Auditable):
         else:
             return super(MapFeature, clz).action_format_string_for_audit(audit)
 
+    @classmethod
+    def increment_revision(cls, pk):
+        """
+        Returns the new revision, or None if the feature doesn't exist
+        (e.g. it was a pending insert that has been rejected)
+        """
+        features = MapFeature.objects.filter(pk=pk)
+        features.update(revision=F('revision') + 1)
+
+        revisions = features.values_list('revision', flat=True)
+        return revisions[0] if revisions else None
+
     @property
     def hash(self):
-        string_to_hash = super(MapFeature, self).hash
-
-        if self.is_plot:
-            # The hash for a plot includes the hash for its trees
-            tree_hashes = [t.hash for t in self.tree_set.all()]
-            string_to_hash += "," + ",".join(tree_hashes)
+        # Changes to a plot's trees (and their photos) also increment
+        # its revision, so they are included without looking them up
+        string_to_hash = 'MapFeature:%s:%s' % (self.pk, self.revision)
 
         return hashlib.md5(string_to_hash).hexdigest()
 
@@ -727,8 +775,17 @@ class Tree(Convertible, UDFModel, Authorizable, Auditable):
     date_removed = models.DateField(null=True, blank=True,
                                     help_text=trans("Date Removed"))
 
+    # Incremented by every write to the tree or its photos, and used
+    # for its hash
+    revision = models.IntegerField(default=0)
+
     objects = AuthorizableGeoHStoreUDFManager()
 
+    def __init__(self, *args, **kwargs):
+        super(Tree, self).__init__(*args, **kwargs)
+        self._do_not_track.add('revision')
+        self.populate_previous_state()
+
     def __unicode__(self):
         diameter_chunk = ("Diameter: %s, " % self.diameter
                           if self.diameter else "")
@@ -745,6 +802,10 @@ class Tree(Convertible, UDFModel, Authorizable, Auditable):
     def photos(self):
         return self.treephoto_set.order_by('-created_at')
 
+    @property
+    def audit_map_feature_id(self):
+        return self.plot_id
+
     ##########################
     # tree validation
     ##########################
@@ -756,15 +817,49 @@ class Tree(Convertible, UDFModel, Authorizable, Auditable):
 
     def save_with_user(self, user, *args, **kwargs):
         self.full_clean_with_user(user)
-        super(Tree, self).save_with_user(user, *args, **kwargs)
+
+        benefits_changed = self.pk is None or bool(
+            TreeBenefit.DEPENDS_ON & set(self._updated_fields()))
+
+        previous_plot_id = self._previous_state.get('plot')
+
+        kwargs = save_kwargs_without_counter(self, 'revision', args, kwargs)
+        super(Tree, self).save_with_user(user, **kwargs)
+
+        if not self.is_pending_insert:
+            trees = Tree.objects.filter(pk=self.pk)
+            trees.update(revision=F('revision') + 1)
+            self.revision = trees.values_list('revision', flat=True)[0]
+
+            self._plot_changed(self.plot_id)
+            if previous_plot_id and previous_plot_id != self.plot_id:
+                self._plot_changed(previous_plot_id)
+
+        if benefits_changed and not self.is_pending_insert:
+            TreeBenefit.schedule_update(pk=self.pk)
+
+    def approved_changes_saved(self, fields):
+        if fields is None or TreeBenefit.DEPENDS_ON & set(fields):
+            TreeBenefit.schedule_update(pk=self.pk)
+
+    def _plot_changed(self, plot_id):
+        revision = MapFeature.increment_revision(plot_id)
+
+        # Keep the plot we were saved with in step with the database
+        plot = getattr(self, '_plot_cache', None)
+        if plot is not None and plot.pk == plot_id:
+            plot.revision = revision
+
+    @classmethod
+    def increment_revision(cls, pk):
+        Tree.objects.filter(pk=pk).update(revision=F('revision') + 1)
+        MapFeature.objects.filter(plot__tree=pk)\
+                          .update(revision=F('revision') + 1)
 
     @property
     def hash(self):
-        string_to_hash = super(Tree, self).hash
-
-        # We need to include tree photos in this hash as well
-        photos = [str(photo.pk) for photo in self.treephoto_set.all()]
-        string_to_hash += ":" + ",".join(photos)
+        # Photo changes also increment the revision
+        string_to_hash = 'Tree:%s:%s' % (self.pk, self.revision)
 
         return hashlib.md5(string_to_hash).hexdigest()
 
@@ -796,6 +891,8 @@ class Tree(Convertible, UDFModel, Authorizable, Auditable):
             photo.delete_with_user(user)
         super(Tree, self).delete_with_user(user, *args, **kwargs)
 
+        self._plot_changed(self.plot_id)
+
 
 class TreePhoto(models.Model, Authorizable, Auditable):
     tree = models.ForeignKey(Tree)
@@ -837,6 +934,10 @@ class TreePhoto(models.Model, Authorizable, Auditable):
 
         return data
 
+    @property
+    def audit_map_feature_id(self):
+        return self.tree.plot_id if self.tree_id else None
+
     def set_image(self, image_data):
         name_prefix = "%s-%s" % (self.tree.plot.pk, self.tree.pk)
         self.image, self.thumbnail = save_uploaded_image(
@@ -854,15 +955,40 @@ class TreePhoto(models.Model, Authorizable, Auditable):
 
         super(TreePhoto, self).save_with_user(*args, **kwargs)
 
+        if not self.is_pending_insert:
+            self._tree_changed()
+
     def delete_with_user(self, *args, **kwargs):
         thumb = self.thumbnail
         image = self.image
 
         super(TreePhoto, self).delete_with_user(*args, **kwargs)
 
+        self._tree_changed()
+
         thumb.delete(False)
         image.delete(False)
 
+    @classmethod
+    def increment_revision(cls, pk):
+        tree_ids = TreePhoto.objects.filter(pk=pk)\
+                                    .values_list('tree_id', flat=True)
+        if not tree_ids:
+            # A pending photo only exists in its audits until it's approved
+            tree_ids = Audit.objects.filter(model='TreePhoto', model_id=pk,
+                                            field='tree')\
+                                    .values_list('current_value', flat=True)
+
+        for tree_id in set(tree_ids):
+            Tree.increment_revision(int(tree_id))
+
+    def _tree_changed(self):
+        Tree.increment_revision(self.tree_id)
+
+        tree = getattr(self, '_tree_cache', None)
+        if tree is not None:
+            tree.revision += 1
+
 
 class Boundary(models.Model):
     """
@@ -886,10 +1012,141 @@ class Boundary(models.Model):
 
     objects = models.GeoManager()
 
+    def save(self, *args, **kwargs):
+        super(Boundary, self).save(*args, **kwargs)
+        MapFeatureBoundary.update_for_boundary(self)
+
     def __unicode__(self):
         return self.name
 
 
+class MapFeatureBoundary(models.Model):
+    """
+    The boundaries containing each map feature. Rows are rebuilt whenever
+    a map feature moves or a boundary is saved, so that boundary
+    searches can use a simple join instead of a spatial test against
+    a (potentially very large) boundary polygon.
+
+    As with the '__contained' geometry lookup, a feature is in a
+    boundary when its bounding box is inside the boundary's.
+    """
+    map_feature = models.ForeignKey(MapFeature)
+    boundary = models.ForeignKey(Boundary)
+
+    class Meta:
+        unique_together = ('map_feature', 'boundary')
+
+    @classmethod
+    def _rebuild(cls, column, pk):
+        """
+        Replace the rows where column (either 'map_feature_id' or
+        'boundary_id') is pk with freshly computed ones
+        """
+        table = cls._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute(
+            'DELETE FROM %s WHERE %s = %%s' % (table, column), [pk])
+        cursor.execute(
+            'INSERT INTO %s (map_feature_id, boundary_id) '
+            'SELECT * FROM ('
+            '  SELECT f.id AS map_feature_id, b.id AS boundary_id'
+            '  FROM treemap_mapfeature f'
+            '  JOIN treemap_boundary b'
+            '    ON f.the_geom_webmercator @ b.the_geom_webmercator'
+            ') covered WHERE %s = %%s' % (table, column), [pk])
+        transaction.commit_unless_managed()
+
+    @classmethod
+    def update_for_map_feature(cls, map_feature):
+        cls._rebuild('map_feature_id', map_feature.pk)
+
+    @classmethod
+    def update_for_boundary(cls, boundary):
+        cls._rebuild('boundary_id', boundary.pk)
+
+
+class TreeBenefit(models.Model):
+    """
+    The raw eco benefits of a single tree, in the units returned by
+    the eco backends. Rows are recalculated whenever something that
+    affects them changes, so that summaries can be a single SUM rather
+    than a calculation over every tree.
+
+    Only maintained when settings.STORE_TREE_BENEFITS is set
+    """
+    # Tree fields that the benefits depend on
+    DEPENDS_ON = {'diameter', 'species', 'plot'}
+
+    tree = models.OneToOneField(Tree, primary_key=True,
+                                related_name='benefit')
+    region = models.CharField(max_length=40)
+
+    aq_nox_avoided = models.FloatField(default=0)
+    aq_nox_dep = models.FloatField(default=0)
+    aq_ozone_dep = models.FloatField(default=0)
+    aq_pm10_avoided = models.FloatField(default=0)
+    aq_pm10_dep = models.FloatField(default=0)
+    aq_sox_avoided = models.FloatField(default=0)
+    aq_sox_dep = models.FloatField(default=0)
+    aq_voc_avoided = models.FloatField(default=0)
+    bvoc = models.FloatField(default=0)
+    co2_avoided = models.FloatField(default=0)
+    co2_sequestered = models.FloatField(default=0)
+    co2_storage = models.FloatField(default=0)
+    electricity = models.FloatField(default=0)
+    hydro_interception = models.FloatField(default=0)
+    natural_gas = models.FloatField(default=0)
+
+    @classmethod
+    def schedule_update(cls, **tree_filter):
+        """
+        Recalculate the benefits of the trees matching tree_filter,
+        in a celery task if settings.STORE_TREE_BENEFITS_ASYNC is set
+        """
+        if not settings.STORE_TREE_BENEFITS:
+            return
+
+        from treemap.tasks import update_tree_benefits, \
+            async_update_tree_benefits  # prevent circular import
+
+        if settings.STORE_TREE_BENEFITS_ASYNC:
+            async_update_tree_benefits.delay(tree_filter)
+        else:
+            update_tree_benefits(tree_filter)
+
+
+class BenefitsHistory(models.Model):
+    """
+    The raw eco benefits of all of an instance's trees at the end of a
+    day, along with the number of trees and how many of them had
+    benefits. Built from the Tree audits by treemap.ecohistory.
+    """
+    instance = models.ForeignKey(Instance)
+    date = models.DateField()
+
+    n_trees = models.IntegerField(default=0)
+    n_trees_used = models.IntegerField(default=0)
+
+    aq_nox_avoided = models.FloatField(default=0)
+    aq_nox_dep = models.FloatField(default=0)
+    aq_ozone_dep = models.FloatField(default=0)
+    aq_pm10_avoided = models.FloatField(default=0)
+    aq_pm10_dep = models.FloatField(default=0)
+    aq_sox_avoided = models.FloatField(default=0)
+    aq_sox_dep = models.FloatField(default=0)
+    aq_voc_avoided = models.FloatField(default=0)
+    bvoc = models.FloatField(default=0)
+    co2_avoided = models.FloatField(default=0)
+    co2_sequestered = models.FloatField(default=0)
+    co2_storage = models.FloatField(default=0)
+    electricity = models.FloatField(default=0)
+    hydro_interception = models.FloatField(default=0)
+    natural_gas = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ('instance', 'date')
+
+
 class ITreeRegion(models.Model):
     code = models.CharField(max_length=40, unique=True)
     geometry = models.MultiPolygonField(srid=3857)
@@ -904,3 +1161,12 @@ class ITreeCodeOverride(models.Model, Auditable):
 
     class Meta:
         unique_together = ('instance_species', 'region',)
+
+
+@receiver(post_save, sender=ITreeCodeOverride)
+@receiver(post_delete, sender=ITreeCodeOverride)
+def update_overridden_tree_benefits(sender, instance, **kwargs):
+    TreeBenefit.schedule_update(species=instance.instance_species_id)
+
+    # Cached summary benefits were calculated with the old code
+    bump_revision(instance.instance_species.instance_id)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import hashlib
+import threading
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from treemap.models import ITreeRegion
+from treemap.util import LRUCache
+
+
+class RegionIndex(object):
+    """
+    All of the i-Tree regions, held in memory as prepared geometries.
+    There are only a handful of regions, so candidates are found by
+    checking their extents in turn before running the (much more
+    expensive) exact test.
+    """
+
+    def __init__(self, regions):
+        self.regions = [(region.code, region.geometry.extent,
+                         region.geometry.prepared)
+                        for region in regions]
+
+    def _candidates(self, geom):
+        xmin, ymin, xmax, ymax = geom.extent
+        for code, (rxmin, rymin, rxmax, rymax), prepared in self.regions:
+            if xmin <= rxmax and xmax >= rxmin and \
+               ymin <= rymax and ymax >= rymin:
+                yield code, prepared
+
+    def region_containing(self, point):
+        for code, prepared in self._candidates(point):
+            if prepared.contains(point):
+                return code
+
+        return None
+
+    def regions_intersecting(self, geom):
+        return tuple(code for code, prepared in self._candidates(geom)
+                     if prepared.intersects(geom))
+
+
+_index = None
+_index_lock = threading.Lock()
+
+# Region codes intersecting each instance, keyed on everything that
+# determines them so that an edited instance gets a fresh entry
+_instance_regions = LRUCache(max_size=1000)
+
+
+def get_region_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = RegionIndex(ITreeRegion.objects.all())
+        return _index
+
+
+def reset_region_index():
+    global _index
+    with _index_lock:
+        _index = None
+    _instance_regions.reset()
+
+
+@receiver(post_save, sender=ITreeRegion)
+@receiver(post_delete, sender=ITreeRegion)
+def _region_changed(*args, **kwargs):
+    reset_region_index()
+
+
+def region_for_point(point):
+    """
+    The code of the i-Tree region containing point, or None
+    """
+    return get_region_index().region_containing(point)
+
+
+def instance_regions(instance):
+    """
+    The codes of the i-Tree regions that apply to an instance: the
+    instance's default region if it has one, otherwise every region
+    that intersects its bounds
+    """
+    if instance.itree_region_default:
+        return (instance.itree_region_default,)
+
+    key = (instance.pk, hashlib.md5(instance.bounds.ewkb).hexdigest())
+
+    regions = _instance_regions.get(key)
+    if regions is None:
+        regions = _instance_regions.put(
+            key, get_region_index().regions_intersecting(instance.bounds))
+
+    return regions
@@ -3,16 +3,22 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
-from json import loads
+import copy
+import hashlib
+
+from json import loads, dumps
 from datetime import datetime
 
+from django.db import connection
 from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
 
 from django.contrib.gis.measure import Distance
-from django.contrib.gis.geos import Point
+from django.contrib.gis.geos import Point, Polygon
 
-from treemap.models import Plot, Boundary, Tree
+from treemap.models import Plot, Tree, TreePhoto, MapFeatureBoundary
 from treemap.udf import DATETIME_FORMAT
+from treemap.util import LRUCache
 
 
 class ParseException (Exception):
@@ -33,6 +39,26 @@ TREE_MAPPING = {'plot': 'plot__',
                 'treePhoto': 'treephoto__',
                 'mapFeature': 'plot__'}
 
+# Relations that can match several rows for a single search result,
+# keyed on their prefix in a mapping. Predicates on these are compiled
+# to subqueries on the related model (which the database runs as
+# semi/anti joins) rather than joins that multiply the result rows.
+# Values are the related model and the path from it back to the
+# searched model's primary key.
+TO_MANY_PREFIXES = {'tree__treephoto__': (TreePhoto, 'tree__plot'),
+                    'treephoto__': (TreePhoto, 'tree')}
+
+COMBINATORS = ('AND', 'OR')
+
+# Compiled Q objects keyed on (filter hash, base_is_plot). Q objects
+# hold no reference to an instance, so a single entry serves every
+# instance that searches with an equivalent filter.
+_compiled_filters = LRUCache(max_size=1000)
+
+# Maps a raw filter string to its hash so that repeated requests
+# for the exact same string skip canonicalization altogether
+_filter_hashes = LRUCache(max_size=1000)
+
 
 def create_filter(filterstr, base_is_plot=True):
     """
@@ -47,6 +73,7 @@ def create_filter(filterstr, base_is_plot=True):
                    | 'IS'
                    | 'WITHIN_RADIUS'
                    | 'IN_BOUNDARY'
+                   | 'IN_BBOX'
                    | 'LIKE'
                    | 'ISNULL'
     combinator     = 'AND' | 'OR'
@@ -65,13 +92,237 @@ def create_filter(filterstr, base_is_plot=True):
         mapping = TREE_MAPPING
 
     if filterstr is not None and filterstr != '':
-        query = loads(filterstr)
-        q = _parse_filter(query, mapping)
+        q = _compile_filter(filterstr, base_is_plot, mapping)
         return base.objects.filter(q)
     else:
         return base.objects.all()
 
 
+def _compile_filter(filterstr, base_is_plot, mapping):
+    key = _filter_hashes.get(filterstr)
+    if key is None:
+        key = _filter_hashes.put(filterstr, filter_hash(filterstr))
+
+    q = _compiled_filters.get((key, base_is_plot))
+    if q is None:
+        q = _parse_filter(canonical_filter(filterstr), mapping)
+        _compiled_filters.put((key, base_is_plot), q)
+
+    # Callers are free to combine the result with other Q objects,
+    # so never hand out the cached copy itself
+    return copy.deepcopy(q)
+
+
+def subquery_sql(queryset):
+    """
+    Returns (sql, params) selecting the primary keys of queryset, for
+    use in an 'IN (...)' clause
+    """
+    try:
+        return queryset.values('pk').query.sql_with_params()
+    except EmptyResultSet:
+        return 'SELECT NULL WHERE FALSE', ()
+
+
+# The rows that count_filters evaluates every filter against: one per
+# plot, along with its tree (OTM only supports one tree per plot) and
+# species. Each table goes by its name, which is the alias django gives
+# the first join to it, so compiled WHERE clauses can be used as is.
+_COUNT_TABLES = ('treemap_plot', 'treemap_mapfeature', 'treemap_tree',
+                 'treemap_species')
+
+_COUNT_FROM = (
+    'FROM treemap_plot '
+    'JOIN treemap_mapfeature '
+    '  ON treemap_mapfeature.id = treemap_plot.mapfeature_ptr_id '
+    'LEFT JOIN treemap_tree '
+    '  ON treemap_tree.plot_id = treemap_plot.mapfeature_ptr_id '
+    'LEFT JOIN treemap_species '
+    '  ON treemap_species.id = treemap_tree.species_id ')
+
+
+def _count_predicate(filterstr, base_is_plot):
+    """
+    The condition a row of _COUNT_FROM has to meet to match filterstr,
+    as (sql, params). The filter's own WHERE clause is used when it
+    only refers to _COUNT_TABLES, and a subquery otherwise.
+    """
+    queryset = create_filter(filterstr, base_is_plot)
+    query = queryset.query
+
+    used = {alias for alias, refs in query.alias_refcount.iteritems()
+            if refs}
+
+    if used <= set(_COUNT_TABLES):
+        compiler = query.get_compiler(connection=connection)
+        try:
+            sql, params = query.where.as_sql(
+                compiler.quote_name_unless_alias, connection)
+        except EmptyResultSet:
+            return 'FALSE', ()
+        return sql or 'TRUE', params
+    else:
+        column = ('treemap_plot.mapfeature_ptr_id' if base_is_plot
+                  else 'treemap_tree.id')
+        sql, params = subquery_sql(queryset)
+        return '%s IN (%s)' % (column, sql), params
+
+
+def count_filters(instance, filterstrs):
+    """
+    Count the plots and trees matching each of the given filters with a
+    single statement. Every filter becomes a pair of conditional sums
+    over one scan of the instance's plots and trees.
+
+    Returns a list of (number of plots, number of trees) in the same
+    order as filterstrs
+    """
+    if not filterstrs:
+        return []
+
+    columns, params = [], []
+    for filterstr in filterstrs:
+        sql, sql_params = _count_predicate(filterstr, True)
+        columns.append('SUM(CASE WHEN (%s) THEN 1 ELSE 0 END)' % sql)
+        params.extend(sql_params)
+
+        sql, sql_params = _count_predicate(filterstr, False)
+        columns.append('SUM(CASE WHEN treemap_tree.id IS NOT NULL '
+                       'AND (%s) THEN 1 ELSE 0 END)' % sql)
+        params.extend(sql_params)
+
+    params.append(instance.pk)
+
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT %s %s WHERE treemap_mapfeature.instance_id = %%s'
+        % (', '.join(columns), _COUNT_FROM), params)
+
+    row = cursor.fetchone()
+    return [(row[i] or 0, row[i + 1] or 0) for i in range(0, len(row), 2)]
+
+
+def canonical_filter(filterstr):
+    """
+    Returns the parsed filter in a normalized form, so that filters
+    that only differ in key order, nesting of identical combinators,
+    duplicated clauses or how a MIN/MAX range was split up compare
+    (and hash) equal.
+    """
+    if filterstr is None or filterstr == '':
+        return None
+    return _canonicalize(loads(filterstr))
+
+
+def filter_hash(filterstr):
+    """
+    A stable hash of the canonical form of the given filter string,
+    suitable for use in cache keys
+    """
+    canonical = dumps(canonical_filter(filterstr), sort_keys=True)
+    return hashlib.md5(canonical).hexdigest()
+
+
+def _canonical_sort_key(query):
+    return dumps(query, sort_keys=True)
+
+
+def _canonicalize(query):
+    if type(query) is dict:
+        return {key: _canonicalize_value(value)
+                for key, value in query.iteritems()}
+    elif type(query) is list and len(query) > 1 \
+            and query[0] in COMBINATORS:
+        combinator = query[0]
+
+        children = []
+        for child in (_canonicalize(p) for p in query[1:]):
+            if type(child) is list and child[:1] == [combinator]:
+                children.extend(child[1:])
+            else:
+                children.append(child)
+
+        if combinator == 'AND':
+            children = _merge_predicates(children)
+
+        unique = {_canonical_sort_key(c): c for c in children}
+        children = [unique[k] for k in sorted(unique)]
+
+        if len(children) == 1:
+            return children[0]
+        else:
+            return [combinator] + children
+    else:
+        return query
+
+
+def _canonicalize_value(value):
+    if type(value) is dict:
+        return {k: _canonicalize_min_max(v) if k in ('MIN', 'MAX') else v
+                for k, v in value.iteritems()}
+    else:
+        return value
+
+
+def _canonicalize_min_max(value):
+    # {'VALUE': 4, 'EXCLUSIVE': false} is the same as 4
+    if type(value) is dict and 'VALUE' in value \
+            and set(value.keys()) <= {'VALUE', 'EXCLUSIVE'} \
+            and not value.get('EXCLUSIVE'):
+        return value['VALUE']
+    else:
+        return value
+
+
+def _merge_predicates(children):
+    """
+    Fold the predicate dictionaries of an AND clause into as few
+    dictionaries as possible. Two predicates on the same key are only
+    merged when they are identical or are the two halves of a MIN/MAX
+    range.
+    """
+    merged = {}
+    rest = []
+
+    for child in children:
+        if type(child) is not dict:
+            rest.append(child)
+            continue
+
+        leftover = {}
+        for key, value in child.iteritems():
+            if key not in merged:
+                merged[key] = value
+            else:
+                combined = _merge_values(merged[key], value)
+                if combined is None:
+                    leftover[key] = value
+                else:
+                    merged[key] = combined
+
+        if leftover:
+            rest.append(leftover)
+
+    if merged:
+        return [merged] + rest
+    else:
+        return rest
+
+
+def _merge_values(a, b):
+    if a == b:
+        return a
+
+    range_keys = {'MIN', 'MAX'}
+    if type(a) is dict and type(b) is dict \
+            and set(a.keys()) <= range_keys \
+            and set(b.keys()) <= range_keys \
+            and not set(a.keys()) & set(b.keys()):
+        return dict(a, **b)
+
+    return None
+
+
 def _parse_filter(query, mapping):
     if type(query) is dict:
         return _parse_predicate(query, mapping)
@@ -157,23 +408,56 @@ def _parse_within_radius_value(predicate_value):
     buildup the geospatial value for the RHS of an
     on orm call and pair it with the LHS
     """
-    radius = _parse_value(predicate_value['RADIUS'])
-    x = _parse_value(predicate_value['POINT']['x'])
-    y = _parse_value(predicate_value['POINT']['y'])
+    try:
+        radius = float(predicate_value['RADIUS'])
+        x = float(predicate_value['POINT']['x'])
+        y = float(predicate_value['POINT']['y'])
+    except (KeyError, TypeError, ValueError):
+        raise ParseException(
+            'WITHIN_RADIUS needs a numeric RADIUS and POINT x and y: %s'
+            % predicate_value)
+
     point = Point(x, y, srid=3857)
 
     return {'__dwithin': (point, Distance(m=radius))}
 
 
+def _parse_in_bbox_value(predicate_value):
+    """
+    A bounding box given as {'XMIN': ..., 'YMIN': ..., 'XMAX': ...,
+    'YMAX': ...} in web mercator. This compiles to an '&&' test, which
+    only needs the spatial index.
+    """
+    try:
+        bbox = tuple(float(predicate_value[k])
+                     for k in ('XMIN', 'YMIN', 'XMAX', 'YMAX'))
+    except (KeyError, TypeError, ValueError):
+        raise ParseException(
+            'IN_BBOX needs numeric XMIN, YMIN, XMAX and YMAX: %s'
+            % predicate_value)
+
+    polygon = Polygon.from_bbox(bbox)
+    polygon.srid = 3857
+
+    return {'__bboverlaps': polygon}
+
+
 def _parse_in_boundary(boundary_id):
-    boundary = Boundary.objects.get(pk=boundary_id)
-    return {'__contained': boundary.geom}
+    map_features = MapFeatureBoundary.objects\
+                                     .filter(boundary_id=boundary_id)\
+                                     .values('map_feature_id')
+    return {'pk__in': map_features}
 
 
 # a predicate_builder takes a value for the
 # corresponding predicate type and returns
 # a singleton dictionary with a mapping of
-# predicate kwargs to pass to a Q object
+# predicate kwargs to pass to a Q object.
+#
+# The kwargs are normally suffixes for the field
+# being searched. Predicates that set
+# 'replaces_field' give lookups relative to the
+# field's model instead.
 PREDICATE_TYPES = {
     'MIN': {
         'combines_with': {'MAX'},
@@ -192,6 +476,8 @@ PREDICATE_TYPES = {
         'predicate_builder': (lambda value: {'': value})
     },
     'LIKE': {
+        # Served by the trigram indexes in treemap.textsearch, which
+        # are built on the expression postgres uses for icontains
         'combines_with': set(),
         'predicate_builder': (lambda value: {'__icontains': value})
     },
@@ -203,8 +489,13 @@ PREDICATE_TYPES = {
         'combines_with': set(),
         'predicate_builder': _parse_within_radius_value,
     },
+    'IN_BBOX': {
+        'combines_with': set(),
+        'predicate_builder': _parse_in_bbox_value,
+    },
     'IN_BOUNDARY': {
         'combines_with': set(),
+        'replaces_field': True,
         'predicate_builder': _parse_in_boundary
     }
 }
@@ -245,7 +536,18 @@ def _parse_dict_value(valuesdict):
 
 def _parse_predicate_pair(key, value, mapping):
     search_key = _parse_predicate_key(key, mapping)
+
+    prefix = mapping[key.split('.')[0]]
+    if prefix in TO_MANY_PREFIXES:
+        return _parse_to_many_predicate_pair(
+            search_key[len(prefix):], value, *TO_MANY_PREFIXES[prefix])
+
     if type(value) is dict:
+        if _replaces_field(value):
+            # Lookups are relative to the model, e.g. 'tree__'
+            field = key.split('.')[1]
+            search_key = search_key[:-len(field)]
+
         return Q(**{search_key + k: v
                     for (k, v)
                     in _parse_dict_value(value).iteritems()})
@@ -253,6 +555,33 @@ def _parse_predicate_pair(key, value, mapping):
         return Q(**{search_key: value})
 
 
+def _parse_to_many_predicate_pair(field, value, related_model, path):
+    """
+    Build a subquery-based predicate on field of related_model, where
+    path leads from related_model to the primary key being searched.
+
+    ISNULL checks become "has no related row where the field is set",
+    everything else becomes "has a related row matching the predicate"
+    """
+    if type(value) is dict:
+        params = _parse_dict_value(value)
+    else:
+        params = {'': value}
+
+    if params == {'__isnull': True}:
+        related = related_model.objects.filter(**{field + '__isnull': False})
+        return ~Q(pk__in=related.values(path))
+    else:
+        related = related_model.objects.filter(
+            **{field + k: v for (k, v) in params.iteritems()})
+        return Q(pk__in=related.values(path))
+
+
+def _replaces_field(valuesdict):
+    return any(PREDICATE_TYPES.get(k, {}).get('replaces_field')
+               for k in valuesdict)
+
+
 def _apply_combinator(combinator, predicates):
     """
     Apply the given combinator to the predicate list
@@ -15,6 +15,9 @@ def species_codes_for_regions(region_codes):
     # Converting to a set removes duplicates
     return list(set(species_codes))
 
+def itree_codes_for_region(region_code):
+    return _CODES.get(region_code, {})
+
 def get_itree_code(region_code, otm_code):
     if otm_code:
         if region_code in _CODES:
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import datetime
+
+from celery import task
+
+from django.conf import settings
+from django.utils import timezone
+
+from treemap import auditarchive, ecobenefits, ecohistory
+from treemap.cache import get_revision, set_summary
+from treemap.models import Tree, Instance
+from treemap.search import create_filter, filter_hash
+
+
+def update_tree_benefits(tree_filter):
+    ecobenefits.update_tree_benefits(Tree.objects.filter(**tree_filter))
+
+async_update_tree_benefits = task(update_tree_benefits)
+
+
+def refresh_summary_benefits(instance_id, filter_str):
+    instance = Instance.objects.get(pk=instance_id)
+    revision = get_revision(instance_id)
+
+    trees = create_filter(filter_str, base_is_plot=False)\
+        .filter(instance=instance)
+
+    set_summary(instance, filter_hash(filter_str),
+                ecobenefits.benefits_variant(instance),
+                ecobenefits.benefits_for_trees(trees, instance), revision)
+
+async_refresh_summary_benefits = task(refresh_summary_benefits)
+
+
+def schedule_summary_benefits_refresh(instance, filter_str):
+    if settings.SEARCH_BENEFITS_REFRESH_ASYNC:
+        async_refresh_summary_benefits.delay(instance.pk, filter_str)
+    else:
+        refresh_summary_benefits(instance.pk, filter_str)
+
+
+def update_benefits_history(instance_id, date):
+    ecohistory.update_benefits_history(
+        Instance.objects.get(pk=instance_id), date)
+
+async_update_benefits_history = task(update_benefits_history)
+
+
+def update_all_benefits_history():
+    """
+    Record yesterday's benefits history for every instance with eco
+    benefits
+    """
+    yesterday = timezone.localtime(timezone.now()).date() \
+        - datetime.timedelta(1)
+
+    for instance in Instance.objects.all():
+        if instance.has_itree_region():
+            async_update_benefits_history.delay(instance.pk, yesterday)
+
+async_update_all_benefits_history = task(update_all_benefits_history)
+
+
+def archive_audits():
+    auditarchive.archive_audits()
+
+async_archive_audits = task(archive_audits)
@@ -461,4 +461,15 @@ from json_field import *      # NOQA
 from units import *           # NOQA
 from management import *      # NOQA
 from ecobenefits import *   # NOQA
+from ecohistory import *    # NOQA
+from ecolocal import *      # NOQA
+from ecosample import *     # NOQA
+from ecosql import *        # NOQA
+from ecoservice import *    # NOQA
+from regions import *       # NOQA
+from cache import *         # NOQA
+from columnar import *      # NOQA
+from facets import *        # NOQA
+from textsearch import *    # NOQA
+from auditarchive import *  # NOQA
 from ui import *        # NOQA
@@ -228,6 +228,25 @@ class AuditTest(TestCase):
         self.assertEqual(get_id_sequence_name(Plot),
                          'treemap_mapfeature_id_seq')
 
+    def test_audits_have_map_feature_id(self):
+        plot = Plot(geom=self.instance.center, instance=self.instance)
+        plot.save_with_user(self.user1)
+
+        tree = Tree(plot=plot, instance=self.instance, readonly=True)
+        tree.save_with_user(self.user1)
+        tree_id = tree.pk
+        tree.delete_with_user(self.user1)
+
+        plot_audits = Audit.objects.filter(model='Plot', model_id=plot.pk)
+        tree_audits = Audit.objects.filter(model='Tree', model_id=tree_id)
+
+        self.assertTrue(plot_audits.exists())
+        self.assertTrue(tree_audits.filter(action=Audit.Type.Delete)
+                                   .exists())
+
+        for audit in list(plot_audits) + list(tree_audits):
+            self.assertEqual(audit.map_feature_id, plot.pk)
+
 
 class MultiUserTestCase(TestCase):
     def setUp(self):
@@ -784,6 +803,34 @@ class ReputationTest(TestCase):
         reputation = user.get_reputation(self.instance)
         self.assertGreater(reputation, 0)
 
+    def test_direct_write_score_applies_to_each_audit(self):
+        t = Tree(plot=self.plot, instance=self.instance,
+                 readonly=True, diameter=10)
+        t.save_with_user(self.privileged_user)
+
+        n_audits = Audit.objects.filter(model='Tree', model_id=t.pk,
+                                        action=Audit.Type.Insert).count()
+
+        user = User.objects.get(pk=self.privileged_user.id)
+        self.assertEqual(user.get_reputation(self.instance), 2 * n_audits)
+
+    def test_pending_audits_dont_change_reputation(self):
+        t = Tree(plot=self.plot, instance=self.instance, diameter=10)
+        t.save_with_user(self.commander)
+
+        ReputationMetric(instance=self.instance, model_name='Tree',
+                         action=Audit.Type.Update, direct_write_score=2,
+                         approval_score=20, denial_score=5).save()
+
+        # Apprentices can only suggest changes
+        t.diameter = 20
+        t.save_with_user(self.unprivileged_user)
+
+        self.assertTrue(Audit.objects.filter(model='Tree', model_id=t.pk,
+                                             requires_auth=True).exists())
+        self.assertEqual(
+            self.unprivileged_user.get_reputation(self.instance), 0)
+
     def test_reputation_metric_no_adjustment_for_no_rm_record(self):
         audit = Audit(model='Plot', model_id=1,
                       action=Audit.Type.Insert,
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import datetime
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib.gis.geos import Point
+from django.utils import timezone
+
+from treemap.audit import Audit, approve_or_reject_audits_and_apply
+from treemap.models import Plot
+from treemap.tests import (make_instance, make_commander_user,
+                           make_apprentice_user)
+from treemap.auditarchive import (archive_cutoff, archive_audits,
+                                  exclude_archived, existing_partitions)
+from treemap.views import _get_audits
+
+
+class ArchiveCutoffTest(TestCase):
+    def test_no_cutoff_by_default(self):
+        with self.settings(AUDIT_ARCHIVE_MONTHS=None):
+            self.assertIsNone(archive_cutoff())
+
+    def test_cutoff_is_start_of_month(self):
+        now = datetime.datetime(2014, 2, 17, 12, tzinfo=timezone.utc)
+
+        self.assertEqual(archive_cutoff(3, now),
+                         datetime.datetime(2013, 11, 1, tzinfo=timezone.utc))
+        self.assertEqual(archive_cutoff(0, now),
+                         datetime.datetime(2014, 2, 1, tzinfo=timezone.utc))
+
+
+@override_settings(AUDIT_ARCHIVE_MONTHS=6,
+                   AUDIT_ARCHIVE_INSTANCES_PER_PARTITION=100)
+class AuditArchiveTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_commander_user(self.instance)
+
+        self.old_plot = Plot(geom=Point(0, 0), instance=self.instance)
+        self.old_plot.save_with_user(self.user)
+
+        self.new_plot = Plot(geom=Point(1, 1), instance=self.instance)
+        self.new_plot.save_with_user(self.user)
+
+        self.old_date = archive_cutoff() - datetime.timedelta(days=40)
+        self.plot_audits = Audit.objects.filter(instance=self.instance,
+                                                model='Plot')
+        self.plot_audits.filter(model_id=self.old_plot.pk)\
+                        .update(created=self.old_date)
+
+    def _hot_ids(self):
+        cursor = connection.cursor()
+        cursor.execute('SELECT id FROM ONLY treemap_audit '
+                       'WHERE instance_id = %s', [self.instance.pk])
+        return {row[0] for row in cursor.fetchall()}
+
+    def test_old_audits_are_moved(self):
+        old_ids = set(self.plot_audits.filter(model_id=self.old_plot.pk)
+                                      .values_list('id', flat=True))
+        all_ids = set(self.plot_audits.values_list('id', flat=True))
+
+        moved = archive_audits()
+
+        self.assertEqual(sum(moved.values()), len(old_ids))
+        self.assertEqual(len(moved), 1)
+
+        name = moved.keys()[0]
+        self.assertIn(name, existing_partitions())
+        self.assertIn(self.old_date.strftime('%Y%m'), name)
+
+        self.assertFalse(old_ids & self._hot_ids())
+
+        # Archived audits can still be read through treemap_audit
+        self.assertEqual(
+            set(self.plot_audits.values_list('id', flat=True)), all_ids)
+
+    def test_archiving_twice_moves_nothing(self):
+        archive_audits()
+        self.assertEqual(sum(archive_audits().values()), 0)
+
+    def test_exclude_archived(self):
+        archive_audits()
+
+        model_ids = set(exclude_archived(self.plot_audits)
+                        .values_list('model_id', flat=True))
+        self.assertEqual(model_ids, {self.new_plot.pk})
+
+        model_ids = set(exclude_archived(self.plot_audits, True)
+                        .values_list('model_id', flat=True))
+        self.assertEqual(model_ids, {self.new_plot.pk, self.old_plot.pk})
+
+    def test_edit_feed_skips_archived_audits(self):
+        archive_audits()
+
+        def feed_model_ids(**kwargs):
+            audits = _get_audits(self.user, self.instance, {}, None,
+                                 ['Plot'], None, page_size=100, **kwargs)
+            return {audit.model_id for audit in audits['audits']}
+
+        self.assertEqual(feed_model_ids(), {self.new_plot.pk})
+        self.assertEqual(feed_model_ids(include_archived=True),
+                         {self.new_plot.pk, self.old_plot.pk})
+
+    def test_pending_edits_are_not_archived(self):
+        apprentice = make_apprentice_user(self.instance)
+        self.old_plot.width = 22
+        self.old_plot.save_with_user(apprentice)
+
+        pending = self.plot_audits.filter(requires_auth=True,
+                                          ref__isnull=True)
+        pending_ids = set(pending.values_list('id', flat=True))
+        self.assertTrue(pending_ids)
+        pending.update(created=self.old_date)
+
+        archive_audits()
+
+        # They can still be reviewed in treemap_audit itself
+        self.assertTrue(pending_ids <= self._hot_ids())
+
+        approve_or_reject_audits_and_apply(
+            Audit.objects.filter(pk__in=pending_ids), self.user, True)
+        archive_audits()
+
+        self.assertFalse(pending_ids & self._hot_ids())
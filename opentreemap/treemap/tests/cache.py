@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.test import TestCase
+from django.contrib.gis.geos import Point
+
+from treemap.exceptions import EcoServiceUnavailable
+from treemap.models import Plot
+from treemap.tests import make_instance, make_commander_user
+from treemap.cache import (get_revision, bump_revision, get_search_counts,
+                           search_cache_stats, get_summary, set_summary)
+
+
+class SearchCountCacheTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_commander_user(self.instance)
+        self.calls = 0
+
+    def _counts(self):
+        self.calls += 1
+        return (self.calls, self.calls)
+
+    def _add_plot(self):
+        plot = Plot(geom=Point(0, 0), instance=self.instance)
+        plot.save_with_user(self.user)
+        return plot
+
+    def test_audits_advance_revision(self):
+        before = get_revision(self.instance.pk)
+        self._add_plot()
+        self.assertTrue(get_revision(self.instance.pk) > before)
+
+    def test_saving_a_stale_instance_keeps_revision(self):
+        self._add_plot()
+        revision = get_revision(self.instance.pk)
+
+        self.instance.save()
+        self.assertEqual(get_revision(self.instance.pk), revision)
+
+        self.instance.save(force_update=True)
+        self.assertEqual(get_revision(self.instance.pk), revision)
+
+    def test_counts_are_cached_until_an_edit(self):
+        first = get_search_counts(self.instance, 'abc', self._counts)
+        second = get_search_counts(self.instance, 'abc', self._counts)
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.calls, 1)
+
+        self._add_plot()
+
+        third = get_search_counts(self.instance, 'abc', self._counts)
+
+        self.assertEqual(self.calls, 2)
+        self.assertNotEqual(first, third)
+
+    def test_stats_count_hits_and_misses(self):
+        before = search_cache_stats()
+
+        get_search_counts(self.instance, 'abc', self._counts)
+        get_search_counts(self.instance, 'abc', self._counts)
+
+        after = search_cache_stats()
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 1)
+
+
+class SummaryCacheTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.computed = 0
+        self.refreshes = 0
+
+    def _compute(self):
+        self.computed += 1
+        return self.computed
+
+    def _refresh(self):
+        self.refreshes += 1
+
+    def _get(self):
+        return get_summary(self.instance, 'abc', 'v', self._compute,
+                           self._refresh)
+
+    def test_miss_computes(self):
+        self.assertEqual(self._get(), (1, True))
+        self.assertEqual(self._get(), (1, True))
+        self.assertEqual(self.computed, 1)
+        self.assertEqual(self.refreshes, 0)
+
+    def test_stale_value_is_served_while_refreshing(self):
+        self._get()
+        bump_revision(self.instance.pk)
+
+        self.assertEqual(self._get(), (1, False))
+        self.assertEqual(self._get(), (1, False))
+
+        # Only one refresh is started, and nothing is computed inline
+        self.assertEqual(self.refreshes, 1)
+        self.assertEqual(self.computed, 1)
+
+    def test_set_summary_makes_it_fresh(self):
+        self._get()
+        bump_revision(self.instance.pk)
+        self._get()
+
+        set_summary(self.instance, 'abc', 'v', 2,
+                    get_revision(self.instance.pk))
+
+        self.assertEqual(self._get(), (2, True))
+
+        # A later edit can start another refresh
+        bump_revision(self.instance.pk)
+        self._get()
+        self.assertEqual(self.refreshes, 2)
+
+    def test_variants_are_separate(self):
+        self._get()
+        rslt = get_summary(self.instance, 'abc', 'w', self._compute,
+                           self._refresh)
+        self.assertEqual(rslt, (2, True))
+
+    def test_synchronous_refresh_is_returned(self):
+        self._get()
+        bump_revision(self.instance.pk)
+
+        def refresh():
+            set_summary(self.instance, 'abc', 'v', 'new',
+                        get_revision(self.instance.pk))
+
+        rslt = get_summary(self.instance, 'abc', 'v', self._compute, refresh)
+        self.assertEqual(rslt, ('new', True))
+
+    def test_failed_refresh_serves_stale_value(self):
+        self._get()
+        bump_revision(self.instance.pk)
+
+        def refresh():
+            self.refreshes += 1
+            raise EcoServiceUnavailable()
+
+        for __ in range(2):
+            rslt = get_summary(self.instance, 'abc', 'v', self._compute,
+                               refresh)
+            self.assertEqual(rslt, (1, False))
+
+        # The failed refresh doesn't stop the next one from starting
+        self.assertEqual(self.refreshes, 2)
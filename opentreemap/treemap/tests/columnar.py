@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import json
+
+from django.test import TestCase
+from django.contrib.gis.geos import Point
+
+from treemap.models import Plot, Tree, Species
+from treemap.tests import make_instance, make_commander_user
+from treemap.views import _execute_filter
+from treemap.columnar import InstanceColumns, UnsupportedFilter
+from treemap.search import canonical_filter
+
+
+class ColumnarSearchTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_commander_user(self.instance)
+
+        self.species = Species(otm_code='CEAT', genus='cedrus',
+                               species='atlantica', common_name='cedar',
+                               instance=self.instance)
+        self.species.save_with_user(self.user)
+
+        self.empty_plot = self._plot(1, 1)
+        self.tree1 = self._tree(self._plot(2, 2), 5.0, self.species)
+        self.tree2 = self._tree(self._plot(3, 3), 10.0, None)
+
+        self.columns = InstanceColumns(self.instance.pk)
+        self.columns.refresh()
+
+    def _plot(self, x, y):
+        plot = Plot(geom=Point(x, y), instance=self.instance)
+        plot.save_with_user(self.user)
+        return plot
+
+    def _tree(self, plot, diameter, species):
+        tree = Tree(plot=plot, instance=self.instance,
+                    diameter=diameter, species=species)
+        tree.save_with_user(self.user)
+        return tree
+
+    def assert_matches_orm(self, query):
+        filter_str = json.dumps(query)
+        expected = (_execute_filter(self.instance, filter_str).count(),
+                    _execute_filter(self.instance, filter_str,
+                                    base_is_plot=False).count())
+
+        self.columns.refresh()
+        self.assertEqual(
+            self.columns.counts(canonical_filter(filter_str)), expected)
+
+    def test_counts_match_orm(self):
+        queries = [
+            {'tree.diameter': {'MIN': 5}},
+            {'tree.diameter': {'MIN': {'VALUE': 5, 'EXCLUSIVE': True}}},
+            {'tree.diameter': {'ISNULL': True}},
+            {'species.id': {'ISNULL': True}},
+            {'species.id': self.species.pk},
+            {'species.common_name': {'LIKE': 'ceda'}},
+            {'tree.id': {'ISNULL': False}},
+            {'plot.geom': {'IN_BBOX': {'XMIN': 0, 'YMIN': 0,
+                                       'XMAX': 2.5, 'YMAX': 2.5}}},
+            ['OR', {'tree.diameter': {'MAX': 5}},
+             {'tree.diameter': {'ISNULL': True}}],
+        ]
+
+        for query in queries:
+            self.assert_matches_orm(query)
+
+    def test_refreshes_from_audits(self):
+        query = {'tree.diameter': {'MIN': 7}}
+        self.assert_matches_orm(query)
+
+        self.tree1.diameter = 20.0
+        self.tree1.save_with_user(self.user)
+        self._tree(self.empty_plot, 8.0, None)
+        self.assert_matches_orm(query)
+
+        self.tree2.delete_with_user(self.user)
+        self.assert_matches_orm(query)
+
+    def test_unsupported_predicates(self):
+        self.assertRaises(UnsupportedFilter, self.columns.counts,
+                          {'treePhoto.id': {'ISNULL': True}})
+        self.assertRaises(UnsupportedFilter, self.columns.counts,
+                          {'plot.address_street': {'MIN': 3}})
@@ -5,12 +5,19 @@ from __future__ import division
 
 import json
 
-from treemap.models import Plot, Tree, Species, ITreeRegion
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from treemap.models import (Plot, Tree, Species, ITreeRegion, TreeBenefit,
+                            ITreeCodeOverride)
 from treemap.tests import (UrlTestCase, make_instance, make_commander_user,
-                           make_request)
+                           make_apprentice_user, make_request)
 
-from treemap import ecobackend
-from treemap.ecobenefits import tree_benefits
+from treemap import ecobackend, ecobenefits
+from treemap.audit import approve_or_reject_audits_and_apply
+from treemap.cache import get_search_cache
+from treemap.ecobenefits import (tree_benefits, tree_benefits_cache_stats,
+                                 benefits_for_trees, batch_tree_benefits)
 
 from treemap.views import search_tree_benefits
 
@@ -100,3 +107,219 @@ class EcoTest(UrlTestCase):
         benefits = result['tree_benefits']
 
         self.assertTrue(len(benefits) > 0)
+
+
+class TreeBenefitsMemoTest(EcoTest):
+    def setUp(self):
+        super(TreeBenefitsMemoTest, self).setUp()
+
+        ecobenefits._tree_benefits_memo.reset()
+        ecobenefits._itree_codes.reset()
+        get_search_cache().clear()
+
+        self.calls = []
+        mockbenefits = ecobackend.json_benefits_call
+
+        def countingbenefits(endpoint, params, *args, **kwargs):
+            self.calls.append(dict(params))
+            return mockbenefits(endpoint, params, *args, **kwargs)
+
+        ecobackend.json_benefits_call = countingbenefits
+
+    def test_benefits_are_memoized(self):
+        first = tree_benefits(self.instance, self.tree)
+        second = tree_benefits(self.instance, self.tree)
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(tree_benefits_cache_stats(),
+                         {'eco_local_hits': 1,
+                          'eco_shared_hits': 0,
+                          'eco_misses': 1})
+
+    def test_memo_hits_do_not_query(self):
+        tree_benefits(self.instance, self.tree)
+
+        self.assertNumQueries(0, lambda: ecobenefits._raw_tree_benefits(
+            self.instance, 'NoEastXXX', self.species, self.tree.diameter))
+
+    def test_code_override_is_used_after_memoizing(self):
+        tree_benefits(self.instance, self.tree)
+
+        ITreeCodeOverride.objects.create(
+            instance_species=self.species,
+            region=ITreeRegion.objects.get(code='NoEastXXX'),
+            itree_code='BDM OTHER')
+        tree_benefits(self.instance, self.tree)
+
+        self.assertEqual(len(self.calls), 2)
+
+    def test_code_override_from_another_process_is_used(self):
+        tree_benefits(self.instance, self.tree)
+
+        # Another process saves an override, so this one's memo isn't
+        # reset and only the shared revision changes
+        ITreeCodeOverride.objects.bulk_create([ITreeCodeOverride(
+            instance_species=self.species,
+            region=ITreeRegion.objects.get(code='NoEastXXX'),
+            itree_code='BDM OTHER')])
+        ecobenefits._bump_itree_codes_revision()
+        tree_benefits(self.instance, self.tree)
+
+        self.assertEqual(len(self.calls), 2)
+
+    def test_shared_cache(self):
+        tree_benefits(self.instance, self.tree)
+        ecobenefits._tree_benefits_memo.reset()
+        tree_benefits(self.instance, self.tree)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(tree_benefits_cache_stats()['eco_shared_hits'], 1)
+
+    def test_diameter_quantization(self):
+        self.instance.eco_diameter_quantum = 10
+        self.instance.save()
+
+        for diameter in (1632, 1628):
+            self.tree.diameter = diameter
+            tree_benefits(self.instance, self.tree)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0]['diameter'], 1630)
+
+    def test_batch_calls_service_per_tree(self):
+        rslt = batch_tree_benefits(self.instance, [self.tree])
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0]['otmcode'], 'CEAT')
+        self.assertEqual(rslt[self.tree.pk],
+                         tree_benefits(self.instance, self.tree))
+
+    @override_settings(ECO_SERVICE_BATCH=True)
+    def test_batch_endpoint(self):
+        posted = []
+
+        def mockpost(endpoint, data):
+            posted.append((endpoint, data))
+            return {'Benefits': {t['id']: {f: 1.0 for f in ecobackend.FACTORS}
+                                 for t in data['trees']}}
+
+        origPostFn = ecobackend.json_post_call
+        ecobackend.json_post_call = mockpost
+        try:
+            rslt = batch_tree_benefits(self.instance, [self.tree])
+        finally:
+            ecobackend.json_post_call = origPostFn
+
+        self.assertEqual(len(posted), 1)
+        self.assertEqual(posted[0][0], 'eco_batch.json')
+        self.assertEqual(posted[0][1]['trees'][0]['otmcode'], 'CEAT')
+        self.assertEqual(self.calls, [])
+        self.assertIn('energy', rslt[self.tree.pk]['tree_benefits'])
+
+        # The batch results are cached like single tree results
+        self.assertEqual(rslt[self.tree.pk],
+                         tree_benefits(self.instance, self.tree))
+        self.assertEqual(self.calls, [])
+
+
+@override_settings(STORE_TREE_BENEFITS=True, STORE_TREE_BENEFITS_ASYNC=False)
+class StoredTreeBenefitsTest(TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def mockbenefits(endpoint, params, *args, **kwargs):
+            params = dict(params)
+            self.calls.append(params)
+            benefits = dict.fromkeys(ecobackend.FACTORS, 0)
+            benefits['electricity'] = float(params['diameter'])
+            return ({'Benefits': benefits}, None)
+
+        self.origBenefitFn = ecobackend.json_benefits_call
+        ecobackend.json_benefits_call = mockbenefits
+
+        ecobenefits._tree_benefits_memo.reset()
+        ecobenefits._itree_codes.reset()
+        get_search_cache().clear()
+
+        region = ITreeRegion.objects.get(code='NoEastXXX')
+        p = region.geometry.point_on_surface
+
+        self.instance = make_instance(point=p)
+        self.user = make_commander_user(self.instance)
+
+        self.species = Species(otm_code='CEAT', genus='cedrus',
+                               species='atlantica', instance=self.instance)
+        self.species.save_with_user(self.user)
+
+        self.trees = []
+        for diameter in (10, 20):
+            plot = Plot(geom=p, instance=self.instance)
+            plot.save_with_user(self.user)
+
+            tree = Tree(plot=plot, instance=self.instance,
+                        species=self.species, diameter=diameter)
+            tree.save_with_user(self.user)
+            self.trees.append(tree)
+
+    def tearDown(self):
+        ecobackend.json_benefits_call = self.origBenefitFn
+
+    def _stored_electricity(self, tree):
+        return TreeBenefit.objects.get(tree=tree).electricity
+
+    def test_benefits_are_stored(self):
+        self.assertEqual(self._stored_electricity(self.trees[0]), 10)
+        self.assertEqual(self._stored_electricity(self.trees[1]), 20)
+
+    def test_benefits_follow_diameter(self):
+        tree = self.trees[0]
+        tree.diameter = 15
+        tree.save_with_user(self.user)
+        self.assertEqual(self._stored_electricity(tree), 15)
+
+        tree.diameter = None
+        tree.save_with_user(self.user)
+        self.assertFalse(TreeBenefit.objects.filter(tree=tree).exists())
+
+    def test_approved_edits_are_stored(self):
+        apprentice = make_apprentice_user(self.instance)
+
+        tree = self.trees[0]
+        tree.diameter = 15
+        tree.save_with_user(apprentice)
+        self.assertEqual(self._stored_electricity(tree), 10)
+
+        approve_or_reject_audits_and_apply(
+            tree.audits().filter(requires_auth=True, ref__isnull=True),
+            self.user, True)
+        self.assertEqual(self._stored_electricity(tree), 15)
+
+        plot = Plot(geom=self.trees[1].plot.geom, instance=self.instance)
+        plot.save_with_user(self.user)
+        new_tree = Tree(plot=plot, instance=self.instance,
+                        species=self.species, diameter=30)
+        new_tree.save_with_user(apprentice)
+
+        approve_or_reject_audits_and_apply(new_tree.audits(), self.user,
+                                           True)
+        self.assertEqual(self._stored_electricity(new_tree), 30)
+
+    def test_unrelated_changes_are_ignored(self):
+        n_calls = len(self.calls)
+
+        tree = self.trees[0]
+        tree.readonly = True
+        tree.save_with_user(self.user)
+
+        self.assertEqual(len(self.calls), n_calls)
+
+    def test_summary_is_summed(self):
+        n_calls = len(self.calls)
+
+        benefits, n_trees = benefits_for_trees(
+            Tree.objects.filter(instance=self.instance), self.instance)
+
+        self.assertEqual(n_trees, 2)
+        self.assertAlmostEqual(benefits['energy']['value'], 30)
+        self.assertEqual(len(self.calls), n_calls)
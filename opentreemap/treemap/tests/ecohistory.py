@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import datetime
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from treemap.audit import Audit
+from treemap.models import Plot, Tree, Species, ITreeRegion, BenefitsHistory
+from treemap.tests import make_instance, make_commander_user
+from treemap.tests.ecolocal import COEFFICIENTS
+
+from treemap import ecolocal, ecobenefits
+from treemap.ecohistory import (backfill_benefits_history,
+                                update_benefits_history, _start_of_day)
+
+
+class BenefitsHistoryTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'NoEastXXX.csv'), 'w') as f:
+            f.write(COEFFICIENTS)
+
+        self.settings = override_settings(ECO_BACKEND='local',
+                                          ECO_COEFFICIENTS_DIR=self.dir)
+        self.settings.enable()
+        ecolocal._coefficients.clear()
+        ecobenefits._tree_benefits_memo.reset()
+
+        region = ITreeRegion.objects.get(code='NoEastXXX')
+        p = region.geometry.point_on_surface
+
+        self.instance = make_instance(point=p)
+        self.instance.itree_region_default = 'NoEastXXX'
+        self.instance.save()
+
+        self.user = make_commander_user(self.instance)
+
+        self.today = timezone.localtime(timezone.now()).date()
+        self.days = [self.today - datetime.timedelta(n) for n in (3, 2, 1)]
+
+        # Day 1: two cedars, 10 and 20 inches across
+        species = Species(otm_code='CEAT', genus='cedrus',
+                          species='atlantica', instance=self.instance)
+        species.save_with_user(self.user)
+
+        self.trees = []
+        for diameter in (10, 20):
+            plot = Plot(geom=p, instance=self.instance)
+            plot.save_with_user(self.user)
+
+            tree = Tree(plot=plot, instance=self.instance, species=species,
+                        diameter=diameter)
+            tree.save_with_user(self.user)
+            self.trees.append(tree)
+        self._move_audits_to(self.days[0])
+
+        # Day 2: the small one grows
+        self.trees[0].diameter = 20
+        self.trees[0].save_with_user(self.user)
+        self._move_audits_to(self.days[1])
+
+        # Day 3: the other one is cut down, and a tree with no
+        # species is added
+        self.trees[1].delete_with_user(self.user)
+
+        tree = Tree(plot=self.trees[1].plot, instance=self.instance,
+                    diameter=5)
+        tree.save_with_user(self.user)
+        self._move_audits_to(self.days[2])
+
+    def tearDown(self):
+        self.settings.disable()
+        ecolocal._coefficients.clear()
+        shutil.rmtree(self.dir)
+
+    def _move_audits_to(self, date):
+        Audit.objects\
+            .filter(instance=self.instance,
+                    created__gte=_start_of_day(self.today))\
+            .update(created=_start_of_day(date))
+
+    def _history(self):
+        return [(h.date, h.n_trees, h.n_trees_used, h.electricity)
+                for h in BenefitsHistory.objects.filter(
+                    instance=self.instance).order_by('date')]
+
+    def test_backfill(self):
+        backfill_benefits_history(self.instance)
+
+        self.assertEqual(self._history(),
+                         [(self.days[0], 2, 2, 50 + 100),
+                          (self.days[1], 2, 2, 100 + 100),
+                          (self.days[2], 2, 1, 100)])
+
+    def test_days_without_changes_are_filled_in(self):
+        backfill_benefits_history(self.instance,
+                                  self.today + datetime.timedelta(2))
+
+        history = self._history()
+        self.assertEqual(len(history), 5)
+        self.assertEqual(history[-1][1:], history[2][1:])
+
+    def test_incremental_update_matches_backfill(self):
+        backfill_benefits_history(self.instance)
+        expected = self._history()
+
+        BenefitsHistory.objects.filter(instance=self.instance,
+                                       date__gt=self.days[0]).delete()
+
+        update_benefits_history(self.instance, self.days[1])
+        update_benefits_history(self.instance, self.days[2])
+
+        self.assertEqual(self._history(), expected)
+
+    def test_update_fills_in_missed_days(self):
+        backfill_benefits_history(self.instance)
+        expected = self._history()
+
+        BenefitsHistory.objects.filter(instance=self.instance,
+                                       date__gt=self.days[0]).delete()
+
+        update_benefits_history(self.instance, self.days[2])
+
+        self.assertEqual(self._history(), expected)
+
+    def test_update_carries_totals_forward(self):
+        backfill_benefits_history(self.instance)
+
+        update_benefits_history(self.instance,
+                                self.today + datetime.timedelta(1))
+
+        history = self._history()
+        self.assertEqual(len(history), 5)
+        self.assertEqual(history[-1][1:], history[2][1:])
+        self.assertEqual(history[-2][1:], history[2][1:])
+
+    def test_update_without_history_backfills(self):
+        update_benefits_history(self.instance, self.days[2])
+
+        self.assertEqual(len(self._history()), 3)
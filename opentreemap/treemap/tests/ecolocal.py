@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from treemap.models import (Plot, Tree, Species, ITreeRegion,
+                            ITreeCodeOverride, TreeBenefit)
+from treemap.tests import make_instance, make_commander_user
+
+from treemap import ecolocal, ecobenefits
+from treemap.ecobackend import BAD_CODE_PAIR
+from treemap.cache import get_revision
+from treemap.ecobenefits import (tree_benefits, benefits_for_trees,
+                                 batch_tree_benefits, benefits_variant)
+
+# Diameters are in cm, so the breakpoints are at 0, 10 and 20 inches
+COEFFICIENTS = """factor,itree_code,0,25.4,50.8
+electricity,CEM OTHER,0,50,100
+co2_storage,CEM OTHER,0,1000,1500
+electricity,BDM OTHER,0,10,20
+"""
+
+
+class RegionCoefficientsTest(TestCase):
+    def setUp(self):
+        self.coefficients = ecolocal.RegionCoefficients(
+            iter(line.split(',') for line in COEFFICIENTS.splitlines()))
+        self.cem = self.coefficients.code_index('CEM OTHER')
+        self.bdm = self.coefficients.code_index('BDM OTHER')
+
+    def test_interpolation(self):
+        benefits, n = self.coefficients.benefits([5, 15], [self.cem] * 2)
+
+        self.assertEqual(n, 2)
+        self.assertAlmostEqual(benefits['electricity'], 25 + 75)
+        self.assertAlmostEqual(benefits['co2_storage'], 500 + 1250)
+        self.assertEqual(benefits['natural_gas'], 0)
+
+    def test_diameters_are_clamped(self):
+        benefits, _ = self.coefficients.benefits([30], [self.cem])
+        self.assertAlmostEqual(benefits['electricity'], 100)
+
+    def test_mixed_codes(self):
+        benefits, n = self.coefficients.benefits(
+            [10, 10, 10], [self.cem, self.bdm, -1])
+
+        self.assertEqual(n, 2)
+        self.assertAlmostEqual(benefits['electricity'], 50 + 10)
+
+
+class LocalBackendTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'NoEastXXX.csv'), 'w') as f:
+            f.write(COEFFICIENTS)
+
+        self.settings = override_settings(ECO_BACKEND='local',
+                                          ECO_COEFFICIENTS_DIR=self.dir)
+        self.settings.enable()
+        ecolocal._coefficients.clear()
+        ecobenefits._tree_benefits_memo.reset()
+
+        self.region = ITreeRegion.objects.get(code='NoEastXXX')
+        p = self.region.geometry.point_on_surface
+
+        self.instance = make_instance(point=p)
+        self.instance.itree_region_default = 'NoEastXXX'
+        self.instance.save()
+
+        self.user = make_commander_user(self.instance)
+
+        # NoEastXXX maps CEAT to 'CEM OTHER'
+        self.species = Species(otm_code='CEAT', genus='cedrus',
+                               species='atlantica', instance=self.instance)
+        self.species.save_with_user(self.user)
+
+        self.trees = []
+        for diameter in (10, 20):
+            plot = Plot(geom=p, instance=self.instance)
+            plot.save_with_user(self.user)
+
+            tree = Tree(plot=plot, instance=self.instance,
+                        species=self.species, diameter=diameter)
+            tree.save_with_user(self.user)
+            self.trees.append(tree)
+
+    def tearDown(self):
+        self.settings.disable()
+        ecolocal._coefficients.clear()
+        shutil.rmtree(self.dir)
+
+    def test_tree_benefits(self):
+        benefits = tree_benefits(self.instance, self.trees[0])
+
+        self.assertAlmostEqual(
+            benefits['tree_benefits']['energy']['value'], 50)
+
+    def test_code_override(self):
+        ITreeCodeOverride.objects.create(instance_species=self.species,
+                                         region=self.region,
+                                         itree_code='BDM OTHER')
+
+        benefits = tree_benefits(self.instance, self.trees[0])
+
+        self.assertAlmostEqual(
+            benefits['tree_benefits']['energy']['value'], 10)
+
+    def test_code_override_makes_summaries_stale(self):
+        revision = get_revision(self.instance.pk)
+
+        ITreeCodeOverride.objects.create(instance_species=self.species,
+                                         region=self.region,
+                                         itree_code='BDM OTHER')
+
+        self.assertNotEqual(get_revision(self.instance.pk), revision)
+
+    def test_benefits_variant(self):
+        variant = benefits_variant(self.instance)
+
+        self.instance.eco_sample_threshold = 1000
+        self.assertNotEqual(benefits_variant(self.instance), variant)
+
+    def test_unknown_code(self):
+        self.species.otm_code = 'NOTACODE'
+        self.species.save_with_user(self.user)
+
+        benefits = tree_benefits(self.instance, self.trees[0])
+
+        self.assertEqual(benefits['error'], BAD_CODE_PAIR)
+
+    def test_summary_benefits(self):
+        benefits, n_trees = benefits_for_trees(
+            Tree.objects.filter(instance=self.instance), self.instance)
+
+        self.assertEqual(n_trees, 2)
+        self.assertAlmostEqual(benefits['energy']['value'], 50 + 100)
+
+    def test_backfilled_benefits_match_backend_summary(self):
+        trees = Tree.objects.filter(instance=self.instance)
+        summed, n_summed = benefits_for_trees(trees, self.instance)
+
+        # The trees were saved without storing benefits
+        self.assertFalse(TreeBenefit.objects.filter(tree__in=trees).exists())
+
+        with override_settings(STORE_TREE_BENEFITS=True):
+            call_command('backfill_tree_benefits', stdout=StringIO(),
+                         instance=self.instance.pk)
+
+            self.assertEqual(
+                TreeBenefit.objects.filter(tree__in=trees).count(), 2)
+
+            stored, n_stored = benefits_for_trees(trees, self.instance)
+
+        self.assertEqual(n_stored, n_summed)
+        for group, benefit in summed.iteritems():
+            self.assertAlmostEqual(stored[group]['value'], benefit['value'])
+
+    def test_batch_tree_benefits(self):
+        plot = Plot(geom=self.trees[0].plot.geom, instance=self.instance)
+        plot.save_with_user(self.user)
+
+        tree = Tree(plot=plot, instance=self.instance, species=self.species)
+        tree.save_with_user(self.user)
+
+        rslts = batch_tree_benefits(self.instance, self.trees + [tree])
+
+        self.assertEqual(rslts[tree.pk]['error'], 'MISSING_DBH')
+
+        for tree in self.trees:
+            self.assertEqual(rslts[tree.pk],
+                             tree_benefits(self.instance, tree))
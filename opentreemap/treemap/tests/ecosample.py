@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import os
+import random
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from treemap.models import Plot, Tree, Species, ITreeRegion
+from treemap.tests import make_instance, make_commander_user
+from treemap.tests.ecolocal import COEFFICIENTS
+
+from treemap import ecolocal, ecobenefits
+from treemap.ecobenefits import benefits_for_trees
+from treemap.ecosample import (allocate, estimate_total, stratified_sample,
+                               MIN_STRATUM_SAMPLES)
+
+
+class EstimatorTest(TestCase):
+    def setUp(self):
+        rand = random.Random(1)
+        self.rows = [(i, i % 3, rand.uniform(1, 40)) for i in range(1, 3001)]
+
+    def test_allocation_is_proportional(self):
+        allocation = allocate({'a': 900, 'b': 100, 'c': 1}, 100)
+
+        # 'a' would get 90 but gives one up to stay within the total
+        self.assertEqual(allocation, {'a': 89, 'b': 10, 'c': 1})
+
+    def test_small_strata_get_minimum(self):
+        allocation = allocate({'a': 10000, 'b': 5}, 10)
+
+        self.assertEqual(allocation['b'], MIN_STRATUM_SAMPLES)
+
+    def test_many_strata_are_merged(self):
+        # Far more species than the sample can give two trees each
+        rows = [(i, i % 400, diameter) for i, __, diameter in self.rows]
+        sample = stratified_sample(iter(rows), 100, 1)
+
+        self.assertLessEqual(len(sample), 100 // MIN_STRATUM_SAMPLES)
+        self.assertEqual(sum(len(ids) for __, ids in sample.itervalues()),
+                         100)
+        self.assertEqual(sum(size for size, __ in sample.itervalues()),
+                         len(rows))
+        for size, ids in sample.itervalues():
+            self.assertGreaterEqual(len(ids), min(size, MIN_STRATUM_SAMPLES))
+
+    def test_diameter_classes_of_small_species_are_merged_first(self):
+        # Three common species with 8 diameter classes each, and 20 rare
+        # species with one tree each
+        rows = [(i, i % 3 if i <= 2980 else i, diameter)
+                for i, __, diameter in self.rows]
+        sample = stratified_sample(iter(rows), 60, 1)
+
+        self.assertEqual(len(sample), 30)
+        self.assertEqual(len([s for s in sample if s[0] == 1]), 8)
+        self.assertIn((0, None), sample)
+        self.assertIn((2, None), sample)
+
+    def test_sample_is_deterministic(self):
+        first = stratified_sample(iter(self.rows), 100, 7)
+        second = stratified_sample(reversed(self.rows), 100, 7)
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, stratified_sample(iter(self.rows), 100, 8))
+
+    def test_full_sample_is_exact(self):
+        total, margin = estimate_total([(3, [1, 2, 3]), (2, [5, 5])])
+
+        self.assertEqual(total, 16)
+        self.assertEqual(margin, 0)
+
+    def test_estimate_is_close_to_exact_total(self):
+        values = {tree_id: diameter ** 2
+                  for tree_id, __, diameter in self.rows}
+        exact = sum(values.itervalues())
+
+        sample = stratified_sample(iter(self.rows), 300, 1)
+        total, margin = estimate_total(
+            [(size, [values[tree_id] for tree_id in ids])
+             for size, ids in sample.itervalues()])
+
+        self.assertTrue(margin > 0)
+        self.assertTrue(abs(total - exact) <= margin,
+                        '%s is not within %s of %s' % (total, margin, exact))
+        self.assertTrue(margin < exact * 0.1)
+
+
+class SampledBenefitsTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'NoEastXXX.csv'), 'w') as f:
+            f.write(COEFFICIENTS)
+
+        self.settings = override_settings(ECO_BACKEND='local',
+                                          ECO_COEFFICIENTS_DIR=self.dir)
+        self.settings.enable()
+        ecolocal._coefficients.clear()
+        ecobenefits._tree_benefits_memo.reset()
+
+        region = ITreeRegion.objects.get(code='NoEastXXX')
+        p = region.geometry.point_on_surface
+
+        self.instance = make_instance(point=p)
+        self.instance.itree_region_default = 'NoEastXXX'
+        self.instance.save()
+
+        user = make_commander_user(self.instance)
+
+        species = Species(otm_code='CEAT', genus='cedrus',
+                          species='atlantica', instance=self.instance)
+        species.save_with_user(user)
+
+        for i in range(60):
+            plot = Plot(geom=p, instance=self.instance)
+            plot.save_with_user(user)
+
+            tree = Tree(plot=plot, instance=self.instance, species=species,
+                        diameter=1 + (i * 7) % 19)
+            tree.save_with_user(user)
+
+        self.trees = Tree.objects.filter(instance=self.instance)
+
+    def tearDown(self):
+        self.settings.disable()
+        ecolocal._coefficients.clear()
+        shutil.rmtree(self.dir)
+
+    def _sampled(self):
+        self.instance.eco_sample_threshold = 50
+        self.instance.eco_sample_size = 20
+        return benefits_for_trees(self.trees, self.instance)
+
+    def test_small_instances_are_not_sampled(self):
+        self.instance.eco_sample_threshold = 100
+        benefits, n_trees = benefits_for_trees(self.trees, self.instance)
+
+        self.assertEqual(n_trees, 60)
+        self.assertNotIn('margin', benefits['energy'])
+
+    def test_estimate_is_close_to_exact_total(self):
+        exact, exact_n = benefits_for_trees(self.trees, self.instance)
+        estimate, estimate_n = self._sampled()
+
+        self.assertEqual(estimate_n, exact_n)
+
+        # With this few trees the estimate isn't always within its
+        # confidence interval, but it is always close
+        for group in ('energy', 'co2storage'):
+            value = estimate[group]['value']
+            self.assertTrue(estimate[group]['margin'] > 0)
+            self.assertLess(abs(value - exact[group]['value']),
+                            exact[group]['value'] * 0.15)
+
+    def test_estimate_is_stable(self):
+        self.assertEqual(self._sampled(), self._sampled())
+
+    def test_no_sampled_benefits(self):
+        Species.objects.filter(instance=self.instance)\
+                       .update(otm_code='NOTACODE')
+        exact, __ = benefits_for_trees(self.trees, self.instance)
+        estimate, estimate_n = self._sampled()
+
+        self.assertEqual(estimate_n, 0)
+        self.assertEqual(set(estimate), set(exact))
+        self.assertEqual(estimate['energy']['value'], 0)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import json
+import threading
+import time
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from treemap.ecobackend import (json_benefits_call, BAD_CODE_PAIR,
+                                BENEFITS_UNAVAILABLE, FACTORS)
+from treemap.ecobenefits import tree_benefits
+from treemap.exceptions import EcoServiceUnavailable
+from treemap.models import Plot, Tree, Species, ITreeRegion
+from treemap.tests import make_instance, make_commander_user
+from treemap import ecobenefits
+
+
+class FakeEcoServer(ThreadingMixIn, HTTPServer):
+    """
+    A stand in for the eco service. Each request takes the next
+    response from 'responses', which can be:
+
+    'ok'        - 200 with some benefits
+    'error'     - 500
+    'slow'      - sleeps for 'delay' seconds before answering
+    'bad pair'  - 400 for an invalid otm code
+
+    and the last response is repeated once the list runs out.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _FakeEcoHandler)
+        self.responses = ['ok']
+        self.delay = 1
+        self.requests = []
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def next_response(self, path):
+        with self._lock:
+            self.requests.append(path)
+            if len(self.responses) > 1:
+                return self.responses.pop(0)
+            else:
+                return self.responses[0]
+
+    def handle_error(self, request, client_address):
+        # Clients that time out close the connection before the
+        # response is written
+        pass
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _FakeEcoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        response = self.server.next_response(self.path)
+
+        if response == 'slow':
+            time.sleep(self.server.delay)
+            response = 'ok'
+
+        if response == 'ok':
+            benefits = dict.fromkeys(FACTORS, 1.0)
+            self._respond(200, json.dumps({'Benefits': benefits}))
+        elif response == 'bad pair':
+            self._respond(400, 'invalid otm code for region\n')
+        else:
+            self._respond(500, 'error')
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class EcoServiceClientTest(TestCase):
+    def setUp(self):
+        self.server = FakeEcoServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.settings = override_settings(
+            ECO_SERVICE_URL=self.server.url,
+            ECO_SERVICE_CONNECT_TIMEOUT=1,
+            ECO_SERVICE_READ_TIMEOUT=0.2,
+            ECO_SERVICE_RETRIES=1,
+            ECO_SERVICE_RETRY_BACKOFF=0,
+            ECO_SERVICE_FAILURE_THRESHOLD=2,
+            ECO_SERVICE_RECOVERY_TIME=0.2)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def _call(self):
+        return json_benefits_call('eco.json', [('otmcode', 'CEAT')])
+
+    def test_connections_are_reused(self):
+        for __ in range(3):
+            rslt, err = self._call()
+            self.assertIsNone(err)
+            self.assertEqual(rslt['Benefits']['electricity'], 1.0)
+
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_bad_code_pair(self):
+        self.server.responses = ['bad pair']
+        self.assertEqual(self._call(), (None, BAD_CODE_PAIR))
+
+    def test_server_errors_are_retried(self):
+        self.server.responses = ['error', 'ok']
+
+        rslt, err = self._call()
+
+        self.assertIsNone(err)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_slow_responses_time_out(self):
+        self.server.responses = ['slow']
+
+        start = time.time()
+        self.assertRaises(EcoServiceUnavailable, self._call)
+
+        # One try and one retry, each cut off by the read timeout
+        self.assertLess(time.time() - start, self.server.delay)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_circuit_breaker(self):
+        self.server.responses = ['error']
+
+        for __ in range(2):
+            self.assertRaises(EcoServiceUnavailable, self._call)
+        n_requests = len(self.server.requests)
+
+        # The breaker is open, so the service isn't called
+        self.assertRaises(EcoServiceUnavailable, self._call)
+        self.assertEqual(len(self.server.requests), n_requests)
+
+        # After the recovery time a trial request closes it again
+        self.server.responses = ['ok']
+        time.sleep(0.3)
+        self.assertIsNone(self._call()[1])
+        self.assertIsNone(self._call()[1])
+
+    def test_tree_benefits_degrade(self):
+        self.server.responses = ['error']
+        ecobenefits._tree_benefits_memo.reset()
+
+        region = ITreeRegion.objects.get(code='NoEastXXX')
+        p = region.geometry.point_on_surface
+
+        instance = make_instance(point=p)
+        user = make_commander_user(instance)
+
+        species = Species(otm_code='CEAT', genus='cedrus',
+                          species='atlantica', instance=instance)
+        species.save_with_user(user)
+
+        plot = Plot(geom=p, instance=instance)
+        plot.save_with_user(user)
+
+        # An unusual diameter, so it can't already be cached
+        tree = Tree(plot=plot, instance=instance, species=species,
+                    diameter=12.3456)
+        tree.save_with_user(user)
+
+        rslt = tree_benefits(instance, tree)
+
+        self.assertEqual(rslt['error'], BENEFITS_UNAVAILABLE)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import os
+
+from django.test.utils import override_settings
+
+from treemap.models import Tree, ITreeRegion, ITreeCodeOverride
+from treemap.tests.ecolocal import LocalBackendTest, COEFFICIENTS
+
+from treemap import ecolocal, ecosql
+from treemap.ecobackend import FACTORS
+from treemap.regions import instance_regions
+
+
+class SqlBackendTest(LocalBackendTest):
+    """
+    Runs the LocalBackend tests against the sql backend, and checks that
+    both give the same summaries
+    """
+    def setUp(self):
+        super(SqlBackendTest, self).setUp()
+
+        self.sql_settings = override_settings(ECO_BACKEND='sql')
+        self.sql_settings.enable()
+
+        self._load_region('NoEastXXX')
+
+        self.local = ecolocal.LocalBackend()
+        self.sql = ecosql.SqlBackend()
+
+    def tearDown(self):
+        self.sql_settings.disable()
+        super(SqlBackendTest, self).tearDown()
+
+    def _load_region(self, region):
+        with open(os.path.join(self.dir, '%s.csv' % region), 'w') as f:
+            f.write(COEFFICIENTS)
+
+        ecosql.load_regions([region])
+
+    def _assert_same_summary(self, region):
+        trees = Tree.objects.filter(instance=self.instance)
+
+        local, __ = self.local.summary_benefits(self.instance, trees, region)
+        sql, __ = self.sql.summary_benefits(self.instance, trees, region)
+
+        self.assertEqual(sql['n_trees'], local['n_trees'])
+        for factor in FACTORS:
+            self.assertAlmostEqual(sql[factor], local[factor])
+
+    def test_coefficient_rows(self):
+        rows = list(ecosql.coefficient_rows(
+            'NoEastXXX', ecosql.RegionCoefficients.load('NoEastXXX')))
+
+        # Two codes, each with a segment below, between and above the
+        # three breakpoints
+        self.assertEqual(len(rows), 2 * 4)
+
+    def test_single_region(self):
+        self._assert_same_summary('NoEastXXX')
+
+    def test_multiple_regions(self):
+        self.instance.itree_region_default = None
+        self.instance.save()
+
+        for region in instance_regions(self.instance):
+            self._load_region(region)
+
+        self._assert_same_summary(None)
+
+    def test_clamped_diameters(self):
+        for tree, diameter in zip(self.trees, (0.1, 300)):
+            tree.diameter = diameter
+            tree.save_with_user(self.user)
+
+        self._assert_same_summary('NoEastXXX')
+
+    def test_code_override(self):
+        ITreeCodeOverride.objects.create(
+            instance_species=self.species,
+            region=ITreeRegion.objects.get(code='NoEastXXX'),
+            itree_code='BDM OTHER')
+
+        self._assert_same_summary('NoEastXXX')
+
+    def test_unknown_code(self):
+        self.species.otm_code = 'NOTACODE'
+        self.species.save_with_user(self.user)
+
+        trees = Tree.objects.filter(instance=self.instance)
+        sql, __ = self.sql.summary_benefits(self.instance, trees, 'NoEastXXX')
+
+        self.assertEqual(sql['n_trees'], 0)
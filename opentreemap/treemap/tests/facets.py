@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import json
+
+from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.contrib.gis.geos import Point
+
+from treemap.models import Plot, Tree, Species
+from treemap.tests import make_instance, make_commander_user
+from treemap.views import _execute_filter
+from treemap.facets import search_facets, _column
+
+
+class SearchFacetsTest(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+        self.user = make_commander_user(self.instance)
+
+        self.species = Species(otm_code='CEAT', genus='cedrus',
+                               species='atlantica', common_name='cedar',
+                               instance=self.instance)
+        self.species.save_with_user(self.user)
+
+        for diameter, species in ((2.0, self.species), (3.0, self.species),
+                                  (12.0, None), (None, self.species)):
+            plot = Plot(geom=Point(0, 0), instance=self.instance)
+            plot.save_with_user(self.user)
+            Tree(plot=plot, instance=self.instance, diameter=diameter,
+                 species=species).save_with_user(self.user)
+
+        Plot(geom=Point(0, 0), instance=self.instance)\
+            .save_with_user(self.user)
+
+    def _facets(self, query=''):
+        return search_facets(self.instance,
+                             _execute_filter(self.instance, query))
+
+    def _count(self, facets, identifier, value='true'):
+        fields = [f for f in self.instance.advanced_search_fields['missing'] +
+                  self.instance.advanced_search_fields['display']
+                  if f.get('identifier') == identifier
+                  and f.get('value') == value]
+        return facets['counts'][fields[0]['id']]['count']
+
+    def test_facets(self):
+        facets = self._facets()
+
+        self.assertEqual(facets['total'], 5)
+        self.assertEqual(facets['species'],
+                         [{'id': self.species.pk, 'common_name': 'cedar',
+                           'count': 3}])
+
+        # Plot without a tree and tree without a species
+        self.assertEqual(self._count(facets, 'species.id'), 2)
+        self.assertEqual(self._count(facets, 'tree.diameter'), 2)
+        self.assertEqual(self._count(facets, 'treePhoto.id'), 5)
+        self.assertEqual(self._count(facets, 'tree.id', 'false'), 4)
+        self.assertEqual(self._count(facets, 'tree.id', 'true'), 1)
+
+        diameters = [h for h in facets['histograms'].values()
+                     if h['identifier'] == 'tree.diameter'][0]
+        self.assertEqual(diameters['buckets'],
+                         [{'min': 0, 'max': 5, 'count': 2},
+                          {'min': 10, 'max': 15, 'count': 1}])
+
+    def test_facets_are_filtered(self):
+        facets = self._facets(json.dumps({'tree.diameter': {'MIN': 10}}))
+
+        self.assertEqual(facets['total'], 1)
+        self.assertEqual(facets['species'], [])
+        self.assertEqual(self._count(facets, 'species.id'), 1)
+
+    def test_unknown_field(self):
+        self.assertRaises(ValidationError, _column, 'tree.no_such_field')
+        self.assertEqual(_column('tree.udf:Stewardship'), (None, None))
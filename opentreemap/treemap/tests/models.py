@@ -11,6 +11,7 @@ from django.core.exceptions import ValidationError
 from treemap.models import (Tree, Instance, Plot, FieldPermission, Species,
                             ITreeRegion)
 from treemap.audit import Audit, ReputationMetric, Role
+from treemap.regions import reset_region_index
 from treemap.tests import (make_instance, make_commander_user,
                            make_user_with_default_role, make_user,
                            make_simple_boundary)
@@ -71,6 +72,58 @@ class HashModelTest(TestCase):
 
         self.assertNotEqual(h1, h2, "Hashes should change")
 
+    def _hash(self, plot):
+        return Plot.objects.get(pk=plot.pk).hash
+
+    def test_hash_doesnt_query(self):
+        plot = Plot(geom=self.p1, instance=self.instance)
+        plot.save_with_user(self.user)
+
+        tree = Tree(plot=plot, instance=self.instance)
+        tree.save_with_user(self.user)
+
+        self.assertNumQueries(0, lambda: plot.hash)
+        self.assertNumQueries(0, lambda: tree.hash)
+
+    def test_tree_changes_change_plot_hash(self):
+        plot1 = Plot(geom=self.p1, instance=self.instance)
+        plot1.save_with_user(self.user)
+        plot2 = Plot(geom=self.p2, instance=self.instance)
+        plot2.save_with_user(self.user)
+
+        tree = Tree(plot=plot1, instance=self.instance)
+        tree.save_with_user(self.user)
+
+        h1, h2 = self._hash(plot1), self._hash(plot2)
+
+        # Moving a tree changes both plots
+        tree.plot = plot2
+        tree.save_with_user(self.user)
+
+        self.assertNotEqual(h1, self._hash(plot1))
+        self.assertNotEqual(h2, self._hash(plot2))
+
+        h2 = self._hash(plot2)
+        tree.delete_with_user(self.user)
+
+        self.assertNotEqual(h2, self._hash(plot2))
+
+    def test_saving_a_stale_copy_keeps_revision(self):
+        plot = Plot(geom=self.p1, instance=self.instance)
+        plot.save_with_user(self.user)
+
+        stale = Plot.objects.get(pk=plot.pk)
+
+        plot.width = 44
+        plot.save_with_user(self.user)
+
+        stale.address_street = 'test'
+        stale.save_with_user(self.user)
+
+        self.assertEqual(stale.revision, plot.revision + 1)
+        self.assertEqual(stale.revision,
+                         Plot.objects.get(pk=plot.pk).revision)
+
 
 class GeoRevIncr(TestCase):
     def setUp(self):
@@ -394,6 +447,10 @@ class InstanceTest(TestCase):
         self.assertEqual(instance.has_itree_region(), True)
 
     def test_has_itree_region_with_intersects(self):
+        # The region index would otherwise keep the region once the
+        # test's transaction is rolled back
+        self.addCleanup(reset_region_index)
+
         p1 = Point(0, 0)
         instance = make_instance(point=p1)
         instance.save()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+from django.test import TestCase
+from django.contrib.gis.geos import Point, MultiPolygon
+
+from treemap.models import ITreeRegion
+from treemap.regions import (region_for_point, instance_regions,
+                             reset_region_index)
+from treemap.tests import make_instance
+
+
+class RegionIndexTest(TestCase):
+    def setUp(self):
+        reset_region_index()
+        self.addCleanup(reset_region_index)
+
+        self.region = ITreeRegion.objects.get(code='NoEastXXX')
+        self.point = self.region.geometry.point_on_surface
+
+    def test_region_for_point(self):
+        self.assertEqual(region_for_point(self.point), 'NoEastXXX')
+        self.assertIsNone(region_for_point(Point(0, 0)))
+
+    def test_matches_database(self):
+        for region in ITreeRegion.objects.all():
+            point = region.geometry.point_on_surface
+            expected = ITreeRegion.objects\
+                                  .filter(geometry__contains=point)\
+                                  .values_list('code', flat=True)[0]
+
+            self.assertEqual(region_for_point(point), expected)
+
+    def test_instance_regions(self):
+        instance = make_instance(point=self.point)
+        self.assertEqual(instance_regions(instance), ('NoEastXXX',))
+
+        instance.itree_region_default = 'PiedmtCLT'
+        self.assertEqual(instance_regions(instance), ('PiedmtCLT',))
+
+    def test_instance_bounds_change(self):
+        instance = make_instance()
+        self.assertEqual(instance_regions(instance), ())
+
+        instance.bounds = MultiPolygon(self.point.buffer(10))
+        self.assertEqual(instance_regions(instance), ('NoEastXXX',))
+
+    def test_new_regions_are_indexed(self):
+        instance = make_instance()
+        self.assertFalse(instance.has_itree_region())
+
+        ITreeRegion.objects.create(code='Test',
+                                   geometry=MultiPolygon(Point(0, 0)
+                                                         .buffer(10)))
+
+        self.assertTrue(instance.has_itree_region())
+        self.assertEqual(region_for_point(Point(1, 1)), 'Test')
@@ -9,6 +9,8 @@ import psycopg2
 from datetime import datetime
 
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.core.exceptions import ValidationError
 from django.db.models import Q
 from django.db import connection
 from django.utils.tree import Node
@@ -17,9 +19,15 @@ from django.contrib.gis.geos import Point, MultiPolygon
 from django.contrib.gis.measure import Distance
 
 from treemap.tests import (make_instance, make_commander_user,
-                           make_simple_polygon, set_write_permissions)
-from treemap.views import _execute_filter
-from treemap.models import (Tree, Plot, Boundary, Species)
+                           make_apprentice_user, make_observer_user,
+                           make_simple_polygon,
+                           set_write_permissions,
+                           LocalMediaTestCase, media_dir)
+from treemap.views import (_execute_filter, _add_bbox_to_filter,
+                           _search_result_pages, search_facets,
+                           search_counts, search_results_endpoint)
+from treemap.models import (Tree, Plot, Boundary, Species, TreePhoto)
+from treemap.audit import approve_or_reject_audits_and_apply
 from treemap.udf import UserDefinedFieldDefinition
 from treemap import search
 
@@ -140,8 +148,42 @@ class FilterParserTests(TestCase):
             sort_order=1)
 
         inparams = search._parse_dict_value({'IN_BOUNDARY': b.pk})
-        self.assertEqual(inparams,
-                         {'__contained': b.geom})
+        self.assertEqual(inparams.keys(), ['pk__in'])
+
+        plot = Plot(geom=Point(0.5, 0.5), instance=make_instance())
+        plot.save_with_user(make_commander_user(plot.instance))
+
+        self.assertEqual(list(inparams['pk__in']),
+                         [{'map_feature_id': plot.pk}])
+
+    def test_boundary_constraint_is_relative_to_model(self):
+        pred = search._parse_predicate_pair(
+            'plot.geom', {'IN_BOUNDARY': 1}, mapping=search.TREE_MAPPING)
+
+        self.assertEqual([k for k, v in pred.children], ['plot__pk__in'])
+
+    def test_bbox_constraint(self):
+        inparams = search._parse_dict_value(
+            {'IN_BBOX': {'XMIN': 0, 'YMIN': 1, 'XMAX': 2, 'YMAX': 3}})
+
+        self.assertEqual(inparams.keys(), ['__bboverlaps'])
+        self.assertEqual(inparams['__bboverlaps'].extent, (0, 1, 2, 3))
+        self.assertEqual(inparams['__bboverlaps'].srid, 3857)
+
+    def test_to_many_predicates_use_subqueries(self):
+        pred = search._parse_predicate_pair(
+            'treePhoto.id', {'ISNULL': True}, mapping=search.PLOT_MAPPING)
+
+        self.assertTrue(pred.negated)
+        [(key, subquery)] = pred.children[0].children
+        self.assertEqual(key, 'pk__in')
+        self.assertEqual(subquery.model, TreePhoto)
+
+        pred = search._parse_predicate_pair(
+            'treePhoto.id', {'ISNULL': False}, mapping=search.TREE_MAPPING)
+
+        self.assertFalse(pred.negated)
+        self.assertEqual([k for k, v in pred.children], ['pk__in'])
 
     def test_constraints_in(self):
         inparams = search._parse_dict_value({'IN': [1, 2, 3]})
@@ -347,6 +389,39 @@ class FilterParserTests(TestCase):
         date = datetime(2013, 4, 1, 12, 0, 0)
         self.assertEqual(search._parse_value("2013-04-01 12:00:00"), date)
 
+    def test_canonical_filter_ignores_ordering_and_nesting(self):
+        a = json.dumps(['AND',
+                        {'tree.height': 9},
+                        ['AND', {'plot.width': {'MIN': 5}},
+                         {'plot.width': {'MAX': 9}}]])
+        b = json.dumps(['AND',
+                        {'plot.width': {'MAX': {'VALUE': 9,
+                                                'EXCLUSIVE': False},
+                                        'MIN': 5},
+                         'tree.height': 9}])
+
+        self.assertEqual(search.canonical_filter(a),
+                         {'plot.width': {'MIN': 5, 'MAX': 9},
+                          'tree.height': 9})
+        self.assertEqual(search.filter_hash(a), search.filter_hash(b))
+
+    def test_canonical_filter_keeps_or_clauses_distinct(self):
+        a = json.dumps(['OR', {'tree.height': 9}, {'tree.height': 10}])
+        b = json.dumps(['AND', {'tree.height': 9}, {'tree.height': 10}])
+
+        self.assertNotEqual(search.filter_hash(a), search.filter_hash(b))
+        self.assertEqual(search.canonical_filter(a),
+                         ['OR', {'tree.height': 9}, {'tree.height': 10}])
+
+    def test_compiled_filter_is_not_shared(self):
+        filterstr = json.dumps({'tree.height': 9})
+        q1 = search._compile_filter(filterstr, True, search.PLOT_MAPPING)
+        q2 = search._compile_filter(filterstr, True, search.PLOT_MAPPING)
+
+        self.assertIsNot(q1, q2)
+        self.assertEqual(self.destructure_query_set(q1),
+                         self.destructure_query_set(q2))
+
 
 class SearchTests(TestCase):
     def setUp(self):
@@ -556,6 +631,190 @@ class SearchTests(TestCase):
         self.assertEqual(
             0, len(_execute_filter(self.instance, boundary3_filter)))
 
+    def test_boundary_search_finds_approved_plots(self):
+        boundary = Boundary.objects.create(
+            geom=MultiPolygon(make_simple_polygon(0)),
+            name='whatever',
+            category='whatever',
+            sort_order=1)
+        boundary_filter = json.dumps({'plot.geom':
+                                      {'IN_BOUNDARY': boundary.pk}})
+
+        apprentice = make_apprentice_user(self.instance)
+        plot = Plot(geom=Point(0.5, 0.5), instance=self.instance)
+        plot.save_with_user(apprentice)
+
+        approve_or_reject_audits_and_apply(plot.audits(), self.commander,
+                                           True)
+
+        self.assertEqual(
+            {plot.pk},
+            {p.pk for p in _execute_filter(self.instance, boundary_filter)})
+
+        # Moving the plot out of the boundary takes effect on approval
+        plot = Plot.objects.get(pk=plot.pk)
+        plot.geom = Point(5, 5)
+        plot.save_with_user(apprentice)
+
+        approve_or_reject_audits_and_apply(
+            plot.audits().filter(requires_auth=True, ref__isnull=True),
+            self.commander, True)
+
+        self.assertEqual(
+            0, len(_execute_filter(self.instance, boundary_filter)))
+
+    def test_bbox_search(self):
+        plot1 = Plot(geom=Point(1, 1), instance=self.instance)
+        plot2 = Plot(geom=Point(5, 5), instance=self.instance)
+
+        for p in (plot1, plot2):
+            p.save_with_user(self.commander)
+
+        bbox_filter = _add_bbox_to_filter('', '0,0,2,2')
+
+        self.assertEqual(
+            {plot1.pk},
+            {p.pk for p in _execute_filter(self.instance, bbox_filter)})
+
+        width_filter = json.dumps({'plot.width': {'ISNULL': True}})
+        bbox_filter = _add_bbox_to_filter(width_filter, '4,4,6,6')
+
+        self.assertEqual(
+            {plot2.pk},
+            {p.pk for p in _execute_filter(self.instance, bbox_filter)})
+
+    def test_malformed_bbox(self):
+        for bbox in ('0,0,2', '0,0,2,2,4', '0,0,two,2', ''):
+            self.assertRaises(ValidationError, _add_bbox_to_filter, '', bbox)
+
+        request = RequestFactory().get('/', {'bbox': '0,0,2'})
+        response = search_facets(request, self.instance)
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_facets_rejects_bad_filters(self):
+        for params in ({'q': '{not json'}, {'q': '{"planet.width": 1}'},
+                       {'q': '{not json', 'bbox': '0,0,2,2'}):
+            request = RequestFactory().get('/', params)
+            response = search_facets(request, self.instance)
+            self.assertEqual(response.status_code, 400)
+
+    def test_count_filters(self):
+        self.create_tree_and_plot()
+        p, t = self.create_tree_and_plot()
+        t.diameter = 10
+        t.save_with_user(self.commander)
+
+        Plot(geom=self.p1, instance=self.instance)\
+            .save_with_user(self.commander)
+
+        filters = ['',
+                   json.dumps({'tree.diameter': {'MIN': 5}}),
+                   json.dumps({'tree.id': {'ISNULL': True}}),
+                   json.dumps({'plot.id': -1}),
+                   json.dumps({'species.id': {'ISNULL': True}}),
+                   json.dumps({'treePhoto.id': {'ISNULL': False}})]
+
+        self.assertEqual(search.count_filters(self.instance, filters),
+                         [(3, 2), (1, 1), (1, 0), (0, 0), (3, 2), (0, 0)])
+
+    def test_search_results_rejects_bad_params(self):
+        for params in ({'after': 'x'}, {'limit': '1.5'},
+                       {'q': '{not json'}, {'q': '{"planet.width": 1}'},
+                       {'q': '{not json', 'format': 'ndjson'},
+                       {'q': '{"planet.width": 1}', 'format': 'ndjson'}):
+            request = RequestFactory().get('/', params)
+            request.user = self.commander
+            response = search_results_endpoint(request, self.instance)
+            self.assertEqual(response.status_code, 400)
+
+        request = RequestFactory().get('/', {'limit': '1'})
+        request.user = self.commander
+        response = search_results_endpoint(request, self.instance)
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_counts_rejects_bad_filters(self):
+        for filters in ('[{"plot": 1}]', '[{"planet.width": 1}]',
+                        '["{not json"]',
+                        '[{"plot.geom": {"WITHIN_RADIUS": {"RADIUS": 1}}}]',
+                        '[{"plot.geom": {"WITHIN_RADIUS": 5}}]',
+                        '[{"plot.geom": {"IN_BBOX": {"XMIN": "a"}}}]'):
+            request = RequestFactory().get('/', {'filters': filters})
+            response = search_counts(request, self.instance)
+            self.assertEqual(response.status_code, 400)
+
+    def test_search_result_pages(self):
+        plots = [Plot(geom=self.p1, instance=self.instance)
+                 for _ in range(5)]
+        for plot in plots:
+            plot.save_with_user(self.commander)
+        ids = sorted(p.pk for p in plots)
+
+        pages = list(_search_result_pages(self.instance, self.commander,
+                                          '', 0, 2))
+
+        self.assertEqual([[r['id'] for r in page] for page in pages],
+                         [ids[0:2], ids[2:4], ids[4:]])
+
+        pages = list(_search_result_pages(self.instance, self.commander,
+                                          '', ids[2], 10))
+
+        self.assertEqual([[r['id'] for r in page] for page in pages],
+                         [ids[3:]])
+
+    def test_search_results_hide_unreadable_fields(self):
+        plot, tree = self.create_tree_and_plot()
+        plot.address_street = '123 Main St'
+        plot.save_with_user(self.commander)
+        tree.diameter = 10
+        tree.save_with_user(self.commander)
+
+        def result(user):
+            pages = list(_search_result_pages(self.instance, user, '', 0, 10))
+            return pages[0][0]
+
+        rslt = result(self.commander)
+        self.assertEqual(rslt['address_street'], '123 Main St')
+        self.assertEqual(rslt['diameter'], 10)
+
+        # Observers can only read a few fields, which don't include the
+        # plot's address
+        rslt = result(make_observer_user(self.instance))
+        self.assertEqual(rslt['id'], plot.pk)
+        self.assertIsNone(rslt['address_street'])
+        self.assertEqual(rslt['diameter'], 10)
+        self.assertIsNotNone(rslt['x'])
+
+    def test_boundary_search_follows_edits(self):
+        b1 = Boundary.objects.create(
+            geom=MultiPolygon(make_simple_polygon(0)),
+            name='whatever',
+            category='whatever',
+            sort_order=1)
+
+        plot = Plot(geom=Point(2.5, 2.5), instance=self.instance)
+        plot.save_with_user(self.commander)
+
+        boundary1_filter = json.dumps({'plot.geom':
+                                       {'IN_BOUNDARY': b1.pk}})
+
+        def search_result():
+            return {p.pk for p
+                    in _execute_filter(self.instance, boundary1_filter)}
+
+        self.assertEqual(set(), search_result())
+
+        # Moving the plot into the boundary
+        plot.geom = Point(0.5, 0.5)
+        plot.save_with_user(self.commander)
+
+        self.assertEqual({plot.pk}, search_result())
+
+        # Moving the boundary away from the plot
+        b1.geom = MultiPolygon(make_simple_polygon(5))
+        b1.save()
+
+        self.assertEqual(set(), search_result())
+
     def setup_diameter_test(self):
         p1, t1 = self.create_tree_and_plot()
         t1.diameter = 2.0
@@ -677,3 +936,54 @@ class SearchTests(TestCase):
             self.instance, species_like_filter)
 
         self.assertEqual(len(result), 0)
+
+
+class PhotoSearchPlanTests(LocalMediaTestCase):
+    def setUp(self):
+        super(PhotoSearchPlanTests, self).setUp()
+
+        self.instance = make_instance()
+        self.user = make_commander_user(self.instance)
+
+    def _seed(self):
+        # Plots with no tree, a tree without photos and trees with
+        # one and two photos
+        for n_photos in (None, 0, 1, 2, 2):
+            plot = Plot(geom=Point(0, 0), instance=self.instance)
+            plot.save_with_user(self.user)
+
+            if n_photos is not None:
+                tree = Tree(plot=plot, instance=self.instance)
+                tree.save_with_user(self.user)
+
+                for __ in range(n_photos):
+                    tree.add_photo(self.load_resource('tree1.gif'),
+                                   self.user)
+
+    def _explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+    @media_dir
+    def test_photo_predicates_are_not_joined(self):
+        self._seed()
+
+        missing = json.dumps({'treePhoto.id': {'ISNULL': True}})
+        present = json.dumps({'treePhoto.id': {'ISNULL': False}})
+
+        for filter_str, n_plots, n_trees in ((missing, 2, 1),
+                                             (present, 3, 3)):
+            plots = _execute_filter(self.instance, filter_str)
+            trees = _execute_filter(self.instance, filter_str,
+                                    base_is_plot=False)
+
+            # A join would count the plots with two photos twice
+            self.assertEqual(plots.count(), n_plots)
+            self.assertEqual(trees.count(), n_trees)
+
+            for qs in (plots, trees):
+                plan = self._explain(qs)
+                self.assertNotIn('Left Join', plan)
+                self.assertNotIn('Nested Loop Left', plan)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import json
+
+from django.db import connection
+from django.test import TestCase
+
+from treemap.models import Plot, Species
+from treemap.udf import UserDefinedFieldDefinition
+from treemap.textsearch import (create_udf_trigram_indexes, existing_indexes,
+                                column_index_name, udf_index_name,
+                                TRIGRAM_COLUMNS)
+from treemap.tests import make_instance
+
+
+class TrigramIndexTests(TestCase):
+    def setUp(self):
+        self.instance = make_instance()
+
+    def _explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        # The test tables are tiny, so the planner would always pick a
+        # sequential scan if it were allowed to
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def test_column_indexes_exist(self):
+        indexes = existing_indexes()
+
+        for table, columns in TRIGRAM_COLUMNS.iteritems():
+            for column in columns:
+                self.assertIn(column_index_name(table, column), indexes)
+
+    def test_like_uses_column_index(self):
+        plots = Plot.objects.filter(address_street__icontains='main')
+        self.assertIn(
+            column_index_name('treemap_mapfeature', 'address_street'),
+            self._explain(plots))
+
+        species = Species.objects.filter(common_name__icontains='oak')
+        self.assertIn(column_index_name('treemap_species', 'common_name'),
+                      self._explain(species))
+
+    def test_udf_indexes(self):
+        UserDefinedFieldDefinition.objects.create(
+            instance=self.instance,
+            model_type='Plot',
+            datatype=json.dumps({'type': 'string'}),
+            iscollection=False,
+            name='Test string')
+
+        UserDefinedFieldDefinition.objects.create(
+            instance=self.instance,
+            model_type='Plot',
+            datatype=json.dumps({'type': 'float'}),
+            iscollection=False,
+            name='Test float')
+
+        name = udf_index_name('treemap_mapfeature', 'Test string')
+
+        self.assertEqual(create_udf_trigram_indexes(), [name])
+        self.assertEqual(create_udf_trigram_indexes(), [])
+
+        plots = Plot.objects.filter(**{'udf:Test string__icontains': 'x'})
+        self.assertIn(name, self._explain(plots))
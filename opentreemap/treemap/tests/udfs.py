@@ -19,9 +19,10 @@ from treemap.tests import (make_instance, make_commander_user,
                            make_officer_user,
                            set_write_permissions)
 
-from treemap.udf import UserDefinedFieldDefinition
+from treemap.udf import (UserDefinedFieldDefinition,
+                         visible_collection_udfs_audit_names_by_role)
 from treemap.models import Plot
-from treemap.audit import (AuthorizeException, FieldPermission,
+from treemap.audit import (AuthorizeException, FieldPermission, Role,
                            approve_or_reject_audit_and_apply,
                            approve_or_reject_audits_and_apply)
 
@@ -862,3 +863,74 @@ class CollectionUDFTest(TestCase):
             ValidationError,
             self.plot.save_with_user,
             self.commander_user)
+
+
+class CollectionUDFVisibilityTest(TestCase):
+
+    def setUp(self):
+        self.instance = make_instance()
+        self.udf = make_collection_udf(self.instance, 'Stewardship')
+
+        self.commander_user = make_commander_user(self.instance)
+        set_write_permissions(self.instance, self.commander_user,
+                              'Plot', ['udf:Stewardship'])
+
+        self.role = self.commander_user.get_role(self.instance)
+        self.role_model = (self.role.pk, 'Plot')
+
+    def _visible_names(self):
+        return visible_collection_udfs_audit_names_by_role(
+            [self.role_model])[self.role_model]
+
+    def test_matches_names_visible_to_user(self):
+        plot = Plot(instance=self.instance)
+
+        self.assertEqual(
+            self._visible_names(),
+            plot.visible_collection_udfs_audit_names(self.commander_user))
+        self.assertEqual(self._visible_names(), ['udf:%s' % self.udf.pk])
+
+    def test_permission_change_is_seen(self):
+        self.assertEqual(self._visible_names(), ['udf:%s' % self.udf.pk])
+
+        perm = FieldPermission.objects.get(role=self.role, model_name='Plot',
+                                           field_name='udf:Stewardship')
+        perm.permission_level = FieldPermission.NONE
+        perm.save()
+
+        self.assertEqual(self._visible_names(), [])
+
+    def test_names_are_keyed_on_role_revision(self):
+        self.assertEqual(self._visible_names(), ['udf:%s' % self.udf.pk])
+
+        # Another process revoking the permission leaves the names it
+        # cached under the old revision behind
+        FieldPermission.objects\
+            .filter(role=self.role, model_name='Plot',
+                    field_name='udf:Stewardship')\
+            .update(permission_level=FieldPermission.NONE)
+        Role.increment_visibility_rev(pk=self.role.pk)
+
+        self.assertEqual(self._visible_names(), [])
+
+    def test_saving_a_stale_role_keeps_revision(self):
+        Role.increment_visibility_rev(pk=self.role.pk)
+        self.role.save()
+
+        self.assertEqual(Role.objects.get(pk=self.role.pk).visibility_rev,
+                         self.role.visibility_rev + 1)
+
+    def test_new_udf_is_seen(self):
+        self.assertEqual(self._visible_names(), ['udf:%s' % self.udf.pk])
+
+        # bulk_create doesn't send signals, so only saving the udf can
+        # move the role to a new visibility revision
+        FieldPermission.objects.bulk_create([FieldPermission(
+            instance=self.instance, role=self.role, model_name='Plot',
+            field_name='udf:Other',
+            permission_level=FieldPermission.READ_ONLY)])
+        other = make_collection_udf(self.instance, 'Other')
+
+        self.assertEqual(sorted(self._visible_names()),
+                         sorted(['udf:%s' % self.udf.pk,
+                                 'udf:%s' % other.pk]))
@@ -242,6 +242,17 @@ class TreemapUrlTests(UrlTestCase):
             self.prefix + 'benefit/search',
             'treemap/partials/eco_benefits.html')
 
+    def test_search_facets(self):
+        self.assert_200(self.prefix + 'search/facets')
+
+    def test_search_counts(self):
+        self.assert_200(self.prefix + 'search/counts?filters=%5B%5D')
+        self.assert_status_code(self.prefix + 'search/counts', 400)
+
+    def test_search_results(self):
+        self.assert_200(self.prefix + 'search/results')
+        self.assert_200(self.prefix + 'search/results?format=ndjson')
+
     def test_user(self):
         username = make_commander_user(self.instance).username
         self.assert_redirects(
@@ -35,7 +35,7 @@ from treemap.views import (species_list, boundary_to_geojson, plot_detail,
                            compile_scss, approve_or_reject_photo,
                            upload_user_photo, static_page, instance_user_view,
                            delete_map_feature, delete_tree, user,
-                           forgot_username)
+                           forgot_username, user_audits_view)
 
 from treemap.tests import (ViewTestCase, make_instance, make_officer_user,
                            make_commander_user, make_apprentice_user,
@@ -284,10 +284,19 @@ class ApproveOrRejectPhotoTest(TreePhotoTestCase):
 
         tp_pk = tp_audit.current_value
 
+        tree_hash = Tree.objects.get(pk=self.tree.pk).hash
+        plot_hash = Plot.objects.get(pk=self.plot.pk).hash
+
         approve_or_reject_photo(
             make_request(user=self.user),
             self.instance, self.plot.pk, self.tree.pk, tp_pk, 'reject')
 
+        # Clients showing the pending photo need to see that it's gone
+        self.assertNotEqual(Tree.objects.get(pk=self.tree.pk).hash,
+                            tree_hash)
+        self.assertNotEqual(Plot.objects.get(pk=self.plot.pk).hash,
+                            plot_hash)
+
         audit_list = Audit.objects.filter(
             model='TreePhoto', field='id', model_id=tp_pk)
 
@@ -873,6 +882,36 @@ class PlotViewTest(PlotViewTestCase):
         self.assertEqual(insert_audit.model_id, tree.pk)
         self.assertEqual(insert_audit.action, Audit.Type.Insert)
 
+    def test_deleted_tree_audits_show_up(self):
+        plot = Plot(instance=self.instance, geom=self.p)
+        plot.save_with_user(self.user)
+
+        other_plot = Plot(instance=self.instance, geom=self.p)
+        other_plot.save_with_user(self.user)
+
+        tree = Tree(instance=self.instance, plot=plot)
+        tree.save_with_user(self.user)
+        tree_id = tree.pk
+        tree.delete_with_user(self.user)
+
+        other_tree = Tree(instance=self.instance, plot=other_plot)
+        other_tree.save_with_user(self.user)
+
+        details = plot_detail(make_request(user=self.user),
+                              self.instance,
+                              plot.pk)
+
+        _, _, audit_list = details['recent_activity'][0]
+
+        self.assertEqual(audit_list[0].model, 'Tree')
+        self.assertEqual(audit_list[0].model_id, tree_id)
+        self.assertEqual(audit_list[0].action, Audit.Type.Delete)
+
+        audits = [audit for __, __, audits in details['recent_activity']
+                  for audit in audits]
+        self.assertNotIn(other_tree.pk, [audit.model_id for audit in audits
+                                         if audit.model == 'Tree'])
+
     def test_plot_with_tree(self):
         species = Species(instance=self.instance, otm_code='BDM OTHER')
         species.save_with_user(self.user)
@@ -1101,12 +1140,43 @@ class RecentEditsViewTest(ViewTestCase):
                                % self.instance.pk, self.commander.username,
                                [self.next_plot_delta, self.plot_delta])
 
+    def _get_page(self, view, url, *args):
+        req = self.factory.get(url)
+        req.user = AnonymousUser()
+        return view(req, *args)
+
     def test_paging(self):
-        self.check_audits('/blah/?page_size=1&page=1', [self.plot_delta])
-        self.check_user_audits('/eblah/?page_size=1&page=1&instance_id=%s'
-                               % self.instance.pk,
+        first_page = self._get_page(edits, '/blah/?page_size=1',
+                                    self.instance)
+        self.assertIsNone(first_page['prev_page'])
+        self.check_audits('/blah/' + first_page['next_page'],
+                          [self.plot_delta])
+
+        first_page = self._get_page(
+            user_audits, '/eblah/?page_size=1&instance_id=%s'
+            % self.instance.pk, self.commander.username)
+        self.check_user_audits('/eblah/' + first_page['next_page'],
                                self.commander.username, [self.plot_delta])
 
+    def test_paging_back(self):
+        first_page = self._get_page(edits, '/blah/?page_size=1',
+                                    self.instance)
+        second_page = self._get_page(edits, '/blah/' + first_page['next_page'],
+                                     self.instance)
+
+        self.check_audits('/blah/' + second_page['prev_page'],
+                          [self.next_plot_delta])
+
+    def test_invalid_cursor(self):
+        self.assertRaises(Exception, self.check_audits,
+                          '/blah/?page_size=1&before=tomorrow', [])
+
+    def test_bad_params_return_400(self):
+        for query in ('before=tomorrow', 'after=1_2_3', 'page_size=x'):
+            response = self._get_page(user_audits_view, '/eblah/?' + query,
+                                      self.commander.username)
+            self.assertEqual(response.status_code, 400, query)
+
     def test_model_filtering_errors(self):
         self.assertRaises(Exception,
                           self.check_audits,
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import hashlib
+
+from django.db import connection, transaction
+
+from treemap.udf import UserDefinedFieldDefinition, safe_get_udf_model_class
+
+# The 'LIKE' search predicate compiles to django's icontains lookup,
+# which postgres runs as:
+#
+#   UPPER(column::text) LIKE UPPER('%value%')
+#
+# A pg_trgm GIN index on that exact expression can serve the query,
+# so the indexes are built on UPPER(...::text) rather than on the bare
+# column. The indexes on regular columns are created by a migration,
+# the ones on udfs (which come and go with their definitions) by
+# create_udf_trigram_indexes
+TRIGRAM_COLUMNS = {
+    'treemap_mapfeature': ('address_street', 'address_city', 'address_zip'),
+    'treemap_species': ('common_name', 'genus', 'species', 'cultivar',
+                        'other'),
+}
+
+# UDF types that are searched with 'LIKE'
+TRIGRAM_UDF_TYPES = {'string'}
+
+
+def column_index_name(table, column):
+    return '%s_%s_trgm' % (table, column)
+
+
+def udf_index_name(table, udf_name):
+    digest = hashlib.md5(udf_name.encode('utf-8')).hexdigest()[:10]
+    return '%s_udf_%s_trgm' % (table, digest)
+
+
+def _udf_expression(udf_name):
+    return "UPPER((udfs -> '%s')::text)" % udf_name.replace("'", "''")
+
+
+def trigram_index_sql(name, table, expression):
+    return ('CREATE INDEX %s ON %s USING gin (%s gin_trgm_ops)'
+            % (name, table, expression))
+
+
+def _udf_table(model_type):
+    model = safe_get_udf_model_class(model_type)
+    __, field_model, __, __ = model._meta.get_field_by_name('udfs')
+    return (field_model or model)._meta.db_table
+
+
+def udf_trigram_indexes():
+    """
+    The (index name, table, expression) of every trigram index needed
+    for the scalar text udfs that are currently defined
+    """
+    indexes = {}
+    for udfd in UserDefinedFieldDefinition.objects.filter(
+            iscollection=False):
+        if udfd.datatype_dict.get('type') in TRIGRAM_UDF_TYPES:
+            table = _udf_table(udfd.model_type)
+            name = udf_index_name(table, udfd.name)
+            indexes[name] = (name, table, _udf_expression(udfd.name))
+
+    return sorted(indexes.values())
+
+
+def existing_indexes():
+    cursor = connection.cursor()
+    cursor.execute("SELECT indexname FROM pg_indexes "
+                   "WHERE indexname LIKE %s", ['%_trgm'])
+    return {row[0] for row in cursor.fetchall()}
+
+
+def create_udf_trigram_indexes():
+    """
+    Create any missing trigram indexes for text udfs. Udfs share an
+    index across instances, since the expression only depends on the
+    table and the udf name.
+
+    Returns the names of the indexes that were created
+    """
+    existing = existing_indexes()
+    created = []
+
+    cursor = connection.cursor()
+    for name, table, expression in udf_trigram_indexes():
+        if name not in existing:
+            cursor.execute(trigram_index_sql(name, table, expression))
+            created.append(name)
+
+    transaction.commit_unless_managed()
+
+    return created
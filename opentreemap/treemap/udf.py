@@ -13,7 +13,7 @@ from django.contrib.gis.db import models
 from django.db.models import Q
 from django.db.models.base import ModelBase
 from django.db.models.sql.constants import ORDER_PATTERN
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
 from django.contrib.gis.db.models.sql.where import GeoWhereNode
@@ -24,8 +24,9 @@ from djorm_hstore.models import HStoreManager, HStoreQueryset
 
 from treemap.instance import Instance
 from treemap.audit import (UserTrackable, Audit, UserTrackingException,
-                           _reserve_model_id, FieldPermission,
+                           _reserve_model_id, FieldPermission, Role,
                            AuthorizeException, Authorizable, Auditable)
+from treemap.cache import get_many_visible_audit_names
 from treemap.util import safe_get_model_class
 
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
@@ -78,6 +79,10 @@ class UserDefinedCollectionValue(UserTrackable, models.Model):
         self._do_not_track.add('data')
         self.populate_previous_state()
 
+        # Set by the model the value is saved with, see
+        # Auditable.audit_map_feature_id
+        self.audit_map_feature_id = None
+
     @property
     def tracked_fields(self):
         return super(UserDefinedCollectionValue, self).tracked_fields + \
@@ -208,6 +213,7 @@ class UserDefinedCollectionValue(UserTrackable, models.Model):
                 model_id=model_id,
                 field=field,
                 instance=self.field_definition.instance,
+                map_feature_id=self.audit_map_feature_id,
                 user=user,
                 action=audit_type,
                 requires_auth=pending)
@@ -709,6 +715,58 @@ def clear_udf_cache(*args, **kwargs):
     udf_cache.reset()
 
 
+def visible_collection_udfs_audit_names_by_role(role_models):
+    """
+    The audit names of the collection udfs that each of a list of
+    (role id, model name) pairs can see, i.e. what
+    UDFModel.visible_collection_udfs_audit_names would return for a
+    user with that role. Cached until the role's field permissions or
+    the instance's udfs change.
+
+    Returns a dictionary of (role id, model name) to audit names
+    """
+    roles = Role.objects\
+        .filter(pk__in={role_id for role_id, __ in role_models})\
+        .values_list('pk', 'instance_id', 'visibility_rev')
+    instance_ids, revisions = {}, {}
+    for role_id, instance_id, revision in roles:
+        instance_ids[role_id] = instance_id
+        revisions[role_id] = revision
+
+    def compute_names(missing):
+        role_ids = {role_id for role_id, __ in missing}
+        readable = set(FieldPermission.objects
+                       .filter(role__in=role_ids,
+                               permission_level__gte=FieldPermission.READ_ONLY)
+                       .values_list('role_id', 'model_name', 'field_name'))
+
+        names = []
+        for role_id, model_name in missing:
+            instance_id = instance_ids.get(role_id)
+            udfs = (udf_cache.get_defs_for_model(model_name, instance_id)
+                    if instance_id else [])
+            names.append(['udf:%s' % udf.pk for udf in udfs
+                          if udf.iscollection and
+                          (role_id, model_name, udf.canonical_name)
+                          in readable])
+        return names
+
+    return get_many_visible_audit_names(role_models, revisions,
+                                        compute_names)
+
+
+@receiver(post_save, sender=FieldPermission)
+@receiver(post_delete, sender=FieldPermission)
+def invalidate_role_visibility(sender, instance, **kwargs):
+    Role.increment_visibility_rev(pk=instance.role_id)
+
+
+@receiver(post_save, sender=UserDefinedFieldDefinition)
+@receiver(post_delete, sender=UserDefinedFieldDefinition)
+def invalidate_udf_visibility(sender, instance, **kwargs):
+    Role.increment_visibility_rev(instance=instance.instance_id)
+
+
 class UDFModel(UserTrackable, models.Model):
     """
     Classes that extend this model gain support for scalar UDF
@@ -887,6 +945,8 @@ class UDFModel(UserTrackable, models.Model):
                         model_id=self.pk)
 
                 udcv.data = value_dict
+                udcv.audit_map_feature_id = getattr(
+                    self, 'audit_map_feature_id', None)
                 udcv.save_with_user(user)
 
                 ids_specified.append(udcv.pk)
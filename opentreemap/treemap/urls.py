@@ -20,7 +20,8 @@ from treemap.views import (boundary_to_geojson_view, index_view, map_view,
                            photo_review_partial_endpoint, get_plot_eco_view,
                            edit_plot_detail_view, static_page_view,
                            get_map_feature_sidebar_view, tree_detail_view,
-                           get_map_feature_add_view)
+                           get_map_feature_add_view, search_facets_view,
+                           search_counts_view, search_results_view)
 
 # Testing notes:
 # We want to test that every URL succeeds (200) or fails with bad data (404).
@@ -83,6 +84,9 @@ urlpatterns = patterns(
     url(r'^config/settings.js$',
         instance_settings_js_view, name='settings'),
     url(r'^benefit/search$', search_tree_benefits_view),
+    url(r'^search/facets$', search_facets_view),
+    url(r'^search/counts$', search_counts_view),
+    url(r'^search/results$', search_results_view),
     url(r'^users/%s/$' % USERNAME_PATTERN, instance_user_view,
         name="user_profile"),
     url(r'^users/%s/edits/$' % USERNAME_PATTERN, instance_user_audits),
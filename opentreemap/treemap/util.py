@@ -5,6 +5,7 @@ from __future__ import division
 
 import json
 import datetime
+import threading
 from collections import OrderedDict
 
 from urlparse import urlparse
@@ -160,6 +161,28 @@ def leaf_subclasses(cls):
     return leaves
 
 
+_SAVE_ARGS = ('force_insert', 'force_update', 'using', 'update_fields')
+
+
+def save_kwargs_without_counter(obj, counter, args, kwargs):
+    """
+    Counters such as revisions are only advanced with UPDATEs, so
+    saving a copy of an existing object that was loaded before one of
+    them must not write its counter back.
+
+    Returns the keyword arguments for saving obj (args are the
+    positional ones of Model.save) without the counter field, unless
+    the caller passed update_fields or force_insert itself
+    """
+    kwargs = dict(zip(_SAVE_ARGS, args), **kwargs)
+
+    if (obj.pk is not None and not kwargs.get('force_insert') and
+            kwargs.get('update_fields') is None):
+        kwargs['update_fields'] = [f.name for f in obj._meta.fields
+                                   if not f.primary_key and f.name != counter]
+    return kwargs
+
+
 def to_object_name(model_name):
     """BenefitCurrencyConversion -> benefitCurrencyConversion"""
     return model_name[0].lower() + model_name[1:]
@@ -168,3 +191,47 @@ def to_object_name(model_name):
 def to_model_name(object_name):
     """benefitCurrencyConversion -> BenefitCurrencyConversion"""
     return object_name[0].upper() + object_name[1:]
+
+
+class LRUCache(object):
+    """
+    A bounded in-process mapping. Once max_size keys are stored the
+    least recently used key is evicted to make room for a new one.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+        return value
+
+    def remove(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -16,13 +16,15 @@ import sass
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404, render_to_response
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import (HttpResponse, HttpResponseRedirect, Http404,
+                         StreamingHttpResponse)
 from django.views.decorators.http import etag
 from django.conf import settings
 from django.contrib.gis.geos import Point, MultiPolygon, Polygon
 from django.contrib.auth.decorators import login_required
 from django.utils.translation import ugettext as trans
 from django.utils.formats import number_format
+from django.utils import timezone
 from django.db import transaction
 from django.db.models import Q
 from django.template import RequestContext
@@ -34,19 +36,29 @@ from treemap.decorators import (json_api_call, render_template, login_or_401,
                                 require_http_method, string_as_file_call,
                                 requires_feature, get_instance_or_404,
                                 creates_instance_user, instance_request,
-                                username_matches_request_user)
+                                username_matches_request_user,
+                                return_400_if_validation_errors)
 from treemap.util import (package_validation_errors,
                           bad_request_json_response, to_object_name)
 from treemap.images import save_image_from_request
-from treemap.search import create_filter
+from treemap.search import (create_filter, filter_hash, count_filters,
+                            ParseException)
 from treemap.audit import (Audit, approve_or_reject_existing_edit,
                            approve_or_reject_audits_and_apply)
-from treemap.models import (Plot, Tree, User, Species, Instance,
-                            TreePhoto, StaticPage, MapFeature)
+from treemap.auditarchive import exclude_archived
+from treemap.models import (Tree, User, Species, Instance, TreePhoto,
+                            StaticPage, MapFeature, InstanceUser, Plot)
+from treemap.udf import visible_collection_udfs_audit_names_by_role
 from treemap.units import get_units, get_display_value, Convertible
 from treemap.ecobenefits import (benefits_for_trees, tree_benefits,
-                                 get_benefit_label)
+                                 get_benefit_label, benefits_variant)
 from treemap.ecobackend import BAD_CODE_PAIR
+from treemap.exceptions import EcoServiceUnavailable
+from treemap.cache import (get_search_counts, get_many_search_counts,
+                           get_summary)
+from treemap.tasks import schedule_summary_benefits_refresh
+from treemap import columnar
+from treemap.facets import search_facets as facets_for_plots
 from treemap.util import leaf_subclasses
 
 USER_EDIT_FIELDS = collections.OrderedDict([
@@ -262,8 +274,13 @@ def _context_dict_for_map_feature(instance, feature):
     return context
 
 
-def context_dict_for_plot(instance, plot,
-                          tree_id=None, user=None, supports_eco=False):
+def context_dict_for_plot(instance, plot, tree_id=None, user=None,
+                          supports_eco=False, benefits_and_error=None):
+    """
+    benefits_and_error may be passed the result of tree_benefits for
+    the plot's tree, e.g. from batch_tree_benefits when building the
+    context for many plots
+    """
     context = _context_dict_for_map_feature(instance, plot)
 
     if tree_id:
@@ -301,7 +318,8 @@ def context_dict_for_plot(instance, plot,
                             supports_eco)
 
     if should_calculate_eco:
-        benefits_and_error = tree_benefits(instance, tree)
+        if benefits_and_error is None:
+            benefits_and_error = tree_benefits(instance, tree)
         benefits = benefits_and_error.get('tree_benefits', None)
         berror = benefits_and_error.get('error', None)
 
@@ -556,12 +574,55 @@ def update_map_feature(request_dict, user, feature):
     return feature, tree
 
 
-def _get_audits(logged_in_user, instance, query_vars, user, models,
-                model_id, page=0, page_size=20, exclude_pending=True,
-                should_count=False):
-    start_pos = page * page_size
-    end_pos = start_pos + page_size
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _audit_cursor(audit):
+    delta = audit.created - _EPOCH
+    micros = ((delta.days * 86400 + delta.seconds) * 10 ** 6 +
+              delta.microseconds)
+    return '%d_%d' % (micros, audit.pk)
+
+
+def _parse_audit_cursor(cursor):
+    try:
+        micros, pk = (int(part) for part in cursor.split('_'))
+        return _EPOCH + datetime.timedelta(microseconds=micros), pk
+    except (ValueError, OverflowError):
+        raise ValidationError(trans('Invalid cursor: %s') % cursor)
+
+
+def _visible_collection_udfs_audit_names(logged_in_user, instances, models):
+    # Only add UDF collections if their parent models are being shown
+    models = [model for model in models if model in ('Tree', 'Plot')]
+    if not models:
+        return []
+
+    # Which collection UDFs are visible depends on the user's role in
+    # each instance, so find all of the roles with one query and look
+    # up their (cached) names together, rather than checking the
+    # permissions of every instance in turn
+    roles = dict(instances.values_list('pk', 'default_role_id'))
+
+    if logged_in_user is not None and not logged_in_user.is_anonymous():
+        roles.update(InstanceUser.objects
+                     .filter(user=logged_in_user, instance__in=roles.keys())
+                     .values_list('instance_id', 'role_id'))
+
+    names_by_role = visible_collection_udfs_audit_names_by_role(
+        [(role_id, model) for role_id in set(roles.itervalues())
+         for model in models])
+
+    # UDF ids are unique across instances, so names visible in one
+    # instance won't show audits from another
+    return sorted({name for names in names_by_role.itervalues()
+                   for name in names})
+
 
+def _get_audits(logged_in_user, instance, query_vars, user, models,
+                model_id, before=None, after=None, page_size=20,
+                exclude_pending=True, should_count=False,
+                include_archived=False):
     model_filter = Q(model__in=models)
 
     # We only want to show the TreePhoto's image, not other fields
@@ -592,30 +653,19 @@ def _get_audits(logged_in_user, instance, query_vars, user, models,
 
     instances = Instance.objects.filter(instance_filter)
 
-    # We need a filter per-instance in order to only show UDF collection
-    # visible to the user
-    for inst in Instance.objects.filter(instance_filter):
-        # Only add UDF collections if their parent models are being shown
-        for model in models:
-            if model == 'Tree':
-                fake_model = Tree(instance=inst)
-            elif model == 'Plot':
-                fake_model = Plot(instance=inst)
-            else:
-                continue
-
-            model_collection_udfs_audit_names =\
-                fake_model.visible_collection_udfs_audit_names(logged_in_user)
+    collection_udfs_audit_names = _visible_collection_udfs_audit_names(
+        logged_in_user, instances, models)
 
-            # Don't show the fields that every collection UDF has, because they
-            # are not very interesting
-            model_filter = model_filter |\
-                (Q(model__in=model_collection_udfs_audit_names) &
-                 ~Q(field__in=('id', 'model_id', 'field_definition')))
+    # Don't show the fields that every collection UDF has, because they
+    # are not very interesting
+    if collection_udfs_audit_names:
+        model_filter = model_filter |\
+            (Q(model__in=collection_udfs_audit_names) &
+             ~Q(field__in=('id', 'model_id', 'field_definition')))
 
     audits = Audit.objects.filter(model_filter)\
-                          .filter(instance__in=instances)\
-                          .order_by('-created', 'id')
+                          .filter(instance__in=instances)
+    audits = exclude_archived(audits, include_archived)
 
     if user:
         audits = audits.filter(user=user)
@@ -625,19 +675,55 @@ def _get_audits(logged_in_user, instance, query_vars, user, models,
         audits = audits.exclude(requires_auth=True, ref__isnull=True)
 
     total_count = audits.count() if should_count else 0
-    audits = audits[start_pos:end_pos]
 
-    query_vars = {k: v for (k, v) in query_vars.iteritems() if k != 'page'}
+    # Pages are found from the audit before or after them (by created
+    # and id) rather than an offset, so that later pages don't have to
+    # skip over every audit on the earlier ones
+    newest_first = audits.order_by('-created', '-id')
+    page = None
+
+    if after:
+        created, pk = _parse_audit_cursor(after)
+        page = list(audits.filter(Q(created__gt=created) |
+                                  Q(created=created, id__gt=pk))
+                          .order_by('created', 'id')[:page_size + 1])
+        page.reverse()
+
+        has_newer = len(page) > page_size
+        page = page[-page_size:]
+        has_older = True
+
+        # Going back to the newest audits shows the first page, which
+        # is full even if fewer audits are newer than the cursor
+        if not has_newer:
+            page = None
+    elif before:
+        created, pk = _parse_audit_cursor(before)
+        page = list(newest_first.filter(Q(created__lt=created) |
+                                        Q(created=created, id__lt=pk))
+                    [:page_size + 1])
+        has_newer = True
+        has_older = len(page) > page_size
+        page = page[:page_size]
+
+    if page is None:
+        page = list(newest_first[:page_size + 1])
+        has_newer = False
+        has_older = len(page) > page_size
+        page = page[:page_size]
+
+    query_vars = {k: v for (k, v) in query_vars.iteritems()
+                  if k not in ('page', 'before', 'after')}
     next_page = None
     prev_page = None
-    if len(audits) == page_size:
-        query_vars['page'] = page + 1
-        next_page = "?" + urllib.urlencode(query_vars)
-    if page > 0:
-        query_vars['page'] = page - 1
-        prev_page = "?" + urllib.urlencode(query_vars)
-
-    return {'audits': audits,
+    if page and has_older:
+        next_page = "?" + urllib.urlencode(
+            dict(query_vars, before=_audit_cursor(page[-1])))
+    if page and has_newer:
+        prev_page = "?" + urllib.urlencode(
+            dict(query_vars, after=_audit_cursor(page[0])))
+
+    return {'audits': page,
             'total_count': total_count,
             'next_page': next_page,
             'prev_page': prev_page}
@@ -656,8 +742,13 @@ def _get_audits_params(request):
 
     r = request.REQUEST
 
-    page_size = min(int(r.get('page_size', PAGE_DEFAULT)), PAGE_MAX)
-    page = int(r.get('page', 0))
+    try:
+        page_size = min(int(r.get('page_size', PAGE_DEFAULT)), PAGE_MAX)
+    except ValueError:
+        raise ValidationError(trans('"page_size" must be an integer'))
+
+    before = r.get('before', None)
+    after = r.get('after', None)
 
     models = []
 
@@ -680,8 +771,10 @@ def _get_audits_params(request):
                         "when looking up by id")
 
     exclude_pending = r.get('exclude_pending', "false") == "true"
+    include_archived = r.get('include_archived', "false") == "true"
 
-    return (page, page_size, models, model_id, exclude_pending)
+    return (before, after, page_size, models, model_id, exclude_pending,
+            include_archived)
 
 
 def edits(request, instance):
@@ -700,13 +793,20 @@ def edits(request, instance):
        - exclude (default: true)
          Set to false to ignore edits that are currently pending
 
+       - include_archived (default: false)
+         Set to true to include edits older than AUDIT_ARCHIVE_MONTHS
+
        - page_size
          Size of each page to return (up to PAGE_MAX)
-       - page
-         The page to return
+       - before
+         Return the page of edits older than this cursor (as given
+         in next_page)
+       - after
+         Return the page of edits newer than this cursor (as given
+         in prev_page)
     """
-    (page, page_size, models, model_id,
-     exclude_pending) = _get_audits_params(request)
+    (before, after, page_size, models, model_id,
+     exclude_pending, include_archived) = _get_audits_params(request)
 
     user_id = request.GET.get('user', None)
     user = None
@@ -715,64 +815,40 @@ def edits(request, instance):
         user = User.objects.get(pk=user_id)
 
     return _get_audits(request.user, instance, request.REQUEST, user,
-                       models, model_id, page, page_size, exclude_pending)
+                       models, model_id, before, after, page_size,
+                       exclude_pending, include_archived=include_archived)
 
 
-def _plot_audits(user, instance, plot):
+def _plot_audits(user, instance, plot, include_archived=False):
     readable_plot_fields = plot.visible_fields(user)
 
-    plot_filter = Q(model='Plot', model_id=plot.pk,
-                    field__in=readable_plot_fields)
-
-    plot_collection_udfs_filter = Q(
-        model__in=plot.visible_collection_udfs_audit_names(user),
-        model_id__in=plot.collection_udfs_audit_ids())
+    plot_filter = Q(model='Plot', field__in=readable_plot_fields)
 
     fake_tree = Tree(instance=instance)
     tree_visible_fields = fake_tree.visible_fields(user)
 
-    # Get a history of trees that were on this plot
-    tree_history = plot.get_tree_history()
+    tree_filter = Q(model='Tree', field__in=tree_visible_fields)
 
-    tree_filter = Q(model='Tree',
-                    field__in=tree_visible_fields,
-                    model_id__in=tree_history)
+    tree_delete_filter = Q(model='Tree', action=Audit.Type.Delete)
 
-    tree_delete_filter = Q(model='Tree',
-                           action=Audit.Type.Delete,
-                           model_id__in=tree_history)
-
-    tree_collection_udfs_audit_names =\
-        fake_tree.visible_collection_udfs_audit_names(user)
-
-    tree_collection_udfs_filter = Q(
-        model__in=tree_collection_udfs_audit_names,
-        model_id__in=Tree.static_collection_udfs_audit_ids(
-            (instance,), tree_history, tree_collection_udfs_audit_names))
-
-    # Seems to be much faster to do three smaller
-    # queries here instead of ORing them together
-    # (about a 50% inprovement!)
-    # TODO: Verify this is still the case now that we are also getting
-    # collection udf audits
-    iaudit = Audit.objects.filter(instance=instance)
-
-    audits = []
-    for afilter in [tree_filter, tree_delete_filter, plot_filter]:
-        audits += list(iaudit.filter(afilter).order_by('-updated')[:5])
+    collection_udfs_audit_names = (
+        plot.visible_collection_udfs_audit_names(user) +
+        fake_tree.visible_collection_udfs_audit_names(user))
 
     # UDF collection audits have some fields which aren't very useful to show
-    udf_collection_exclude_filter = Q(
-        field__in=['model_id', 'field_definition'])
+    collection_udfs_filter = (
+        Q(model__in=collection_udfs_audit_names) &
+        ~Q(field__in=['model_id', 'field_definition']))
 
-    for afilter in [plot_collection_udfs_filter, tree_collection_udfs_filter]:
-        audits += list(iaudit.filter(afilter)
-                             .exclude(udf_collection_exclude_filter)
-                             .order_by('-updated')[:5])
+    # The audits of the plot, the trees that were on it and their
+    # collection udfs all have the plot's id as their map_feature_id,
+    # so this is one scan of the (map_feature_id, updated) index
+    audits = Audit.objects.filter(instance=instance, map_feature_id=plot.pk)\
+                          .filter(plot_filter | tree_filter |
+                                  tree_delete_filter | collection_udfs_filter)\
+                          .order_by('-updated')
 
-    audits = sorted(audits, key=lambda audit: audit.updated, reverse=True)[:5]
-
-    return audits
+    return list(exclude_archived(audits, include_archived)[:5])
 
 
 def user_audits(request, username):
@@ -782,11 +858,12 @@ def user_audits(request, username):
     instance = (get_instance_or_404(pk=instance_id)
                 if instance_id else None)
 
-    (page, page_size, models, model_id,
-     exclude_pending) = _get_audits_params(request)
+    (before, after, page_size, models, model_id,
+     exclude_pending, include_archived) = _get_audits_params(request)
 
     return _get_audits(request.user, instance, request.REQUEST, user,
-                       models, model_id, page, page_size, exclude_pending)
+                       models, model_id, before, after, page_size,
+                       exclude_pending, include_archived=include_archived)
 
 
 def instance_user_audits(request, instance_url_name, username):
@@ -872,11 +949,41 @@ def _execute_filter(instance, filter_str, base_is_plot=True):
         .filter(instance=instance)
 
 
+def _add_bbox_to_filter(filter_str, bbox_str):
+    """
+    Restrict a search filter to a bounding box given as
+    'xmin,ymin,xmax,ymax' in web mercator
+    """
+    try:
+        xmin, ymin, xmax, ymax = [float(c) for c in bbox_str.split(',')]
+    except ValueError:
+        raise ValidationError(
+            trans('bbox must be four numbers: xmin,ymin,xmax,ymax'))
+
+    bbox_filter = {'mapFeature.geom': {'IN_BBOX': {'XMIN': xmin,
+                                                   'YMIN': ymin,
+                                                   'XMAX': xmax,
+                                                   'YMAX': ymax}}}
+    if filter_str:
+        return json.dumps(['AND', json.loads(filter_str), bbox_filter])
+    else:
+        return json.dumps(bbox_filter)
+
+
+def _search_counts(instance, filter_str, plots, trees):
+    if settings.SEARCH_COLUMNAR_ENGINE:
+        counts = columnar.search_counts(instance, filter_str)
+        if counts is not None:
+            return counts
+
+    return plots.count(), trees.count()
+
+
 def search_tree_benefits(request, instance):
     try:
-        filter_str = request.REQUEST['q']
-    except KeyError:
-        filter_str = ''
+        filter_str = _get_filter_str(request)
+    except ValidationError as e:
+        return bad_request_json_response('; '.join(e.messages))
 
     try:
         hide_summary_text = request.REQUEST['hide_summary']
@@ -890,11 +997,11 @@ def search_tree_benefits(request, instance):
     # Tree.objects.filter(plot_id__in=plots)
     trees = _execute_filter(instance, filter_str, base_is_plot=False)
 
-    total_plots = plots.count()
-    total_trees = trees.count()
-
-    if not request.instance_supports_ecobenefits:
+    total_plots, total_trees = get_search_counts(
+        instance, filter_hash(filter_str),
+        lambda: _search_counts(instance, filter_str, plots, trees))
 
+    def without_benefits():
         return {'tree_benefits': None,
                 'currency_symbol': None,
                 'basis': {'n_trees_used': None,
@@ -906,10 +1013,210 @@ def search_tree_benefits(request, instance):
                                    'n_resources_total': 0,
                                    'n_resources': 0,
                                    'percent': 0}}
+
+    if not request.instance_supports_ecobenefits:
+        return without_benefits()
+
+    try:
+        (benefits, ntrees), fresh = get_summary(
+            instance, filter_hash(filter_str), benefits_variant(instance),
+            lambda: benefits_for_trees(trees, instance),
+            lambda: schedule_summary_benefits_refresh(instance, filter_str))
+    except EcoServiceUnavailable:
+        # Still show the counts while the eco service is down
+        rslt = without_benefits()
+        rslt['benefits_unavailable'] = True
+        return rslt
+
+    rslt = _format_benefits(instance, benefits, ntrees,
+                            total_trees, total_plots, hide_summary)
+    rslt['benefits_fresh'] = fresh
+
+    return rslt
+
+
+def search_counts(request, instance):
+    """
+    Counts for several filters at once. 'filters' is a JSON list where
+    each item is either a filter string or a filter object.
+    """
+    try:
+        filters = json.loads(request.REQUEST['filters'])
+    except (KeyError, ValueError):
+        return bad_request_json_response(
+            'Expected a JSON list of filters in "filters"')
+
+    if type(filters) is not list:
+        return bad_request_json_response(
+            'Expected a JSON list of filters in "filters"')
+
+    filter_strs = [f if isinstance(f, basestring) else json.dumps(f)
+                   for f in filters]
+
+    try:
+        hashes = {filter_hash(f): f for f in filter_strs}
+
+        counts = get_many_search_counts(
+            instance, hashes.keys(),
+            lambda missing: count_filters(instance,
+                                          [hashes[h] for h in missing]))
+    except ValueError:
+        return bad_request_json_response('Filters must be valid JSON')
+    except ParseException as e:
+        return bad_request_json_response(e.message)
+
+    return {'counts': [dict(zip(('plots', 'trees'), counts[filter_hash(f)]))
+                       for f in filter_strs]}
+
+
+def _get_filter_str(request):
+    filter_str = request.REQUEST.get('q', '')
+
+    bbox_str = request.REQUEST.get('bbox', '')
+    if bbox_str:
+        filter_str = _add_bbox_to_filter(filter_str, bbox_str)
+
+    return filter_str
+
+
+def search_facets(request, instance):
+    try:
+        filter_str = _get_filter_str(request)
+        return facets_for_plots(instance,
+                                _execute_filter(instance, filter_str))
+    except ValidationError as e:
+        return bad_request_json_response('; '.join(e.messages))
+    except ValueError:
+        return bad_request_json_response('Filters must be valid JSON')
+    except ParseException as e:
+        return bad_request_json_response(e.message)
+
+
+SEARCH_RESULTS_PAGE_SIZE = 1000
+SEARCH_RESULTS_MAX_PAGE_SIZE = 5000
+
+
+# Each search result key, the column it is read from and the model and
+# field a user needs to be able to read to see it
+_SEARCH_RESULT_COLUMNS = (
+    ('x', 'x', 'Plot', 'geom'),
+    ('y', 'y', 'Plot', 'geom'),
+    ('address_street', 'address_street', 'Plot', 'address_street'),
+    ('address_city', 'address_city', 'Plot', 'address_city'),
+    ('address_zip', 'address_zip', 'Plot', 'address_zip'),
+    ('tree_id', 'tree__id', None, None),
+    ('diameter', 'tree__diameter', 'Tree', 'diameter'),
+    ('species_id', 'tree__species__id', 'Tree', 'species'),
+    ('species_name', 'tree__species__common_name', 'Tree', 'species'))
+
+
+def _search_result_pages(instance, user, filter_str, after, page_size):
+    """
+    An iterator over pages of plots matching filter_str with an id
+    greater than after. Each page starts where the last one ended
+    ('WHERE id > n ORDER BY id LIMIT m'), so every page costs the same
+    no matter how deep into the results it is.
+
+    Fields that user can't read are null in every result. The filter
+    is compiled straight away, so a bad one raises before any page is
+    read.
+    """
+    visible = {'Plot': set(Plot(instance=instance).visible_fields(user)),
+               'Tree': set(Tree(instance=instance).visible_fields(user))}
+    columns = [(key, column) for key, column, model, field
+               in _SEARCH_RESULT_COLUMNS
+               if model is None or field in visible[model]]
+
+    plots = _execute_filter(instance, filter_str)\
+        .extra(select={'x': 'ST_X(the_geom_webmercator)',
+                       'y': 'ST_Y(the_geom_webmercator)'})\
+        .order_by('pk')\
+        .values('pk', *[column for _, column in columns])
+
+    def result(plot):
+        rslt = dict.fromkeys(key for key, _, _, _ in _SEARCH_RESULT_COLUMNS)
+        rslt.update((key, plot[column]) for key, column in columns)
+        rslt['id'] = plot['pk']
+        return rslt
+
+    def pages(after):
+        while True:
+            page = list(plots.filter(pk__gt=after)[:page_size])
+            if page:
+                yield [result(p) for p in page]
+
+            if len(page) < page_size:
+                return
+
+            after = page[-1]['pk']
+
+    return pages(after)
+
+
+def _search_results_params(request):
+    try:
+        after = int(request.REQUEST.get('after', 0))
+        page_size = int(request.REQUEST.get('limit',
+                                            SEARCH_RESULTS_PAGE_SIZE))
+    except ValueError:
+        raise ValidationError(trans('"after" and "limit" must be integers'))
+
+    page_size = min(max(page_size, 1), SEARCH_RESULTS_MAX_PAGE_SIZE)
+
+    return _get_filter_str(request), after, page_size
+
+
+def search_results(request, instance):
+    """
+    A single page of plots matching the search in 'q'. Pass the 'next'
+    value of the response as 'after' to get the following page
+    """
+    filter_str, after, page_size = _search_results_params(request)
+
+    pages = _search_result_pages(instance, request.user, filter_str, after,
+                                 page_size)
+    results = next(pages, [])
+
+    if len(results) == page_size:
+        next_cursor = results[-1]['id']
     else:
-        benefits, ntrees = benefits_for_trees(trees, instance)
-        return _format_benefits(instance, benefits, ntrees,
-                                total_trees, total_plots, hide_summary)
+        next_cursor = None
+
+    return {'results': results, 'next': next_cursor}
+
+
+def search_results_stream(request, instance):
+    """
+    Every plot matching the search in 'q' (starting after 'after'), as
+    newline delimited JSON. Rows are fetched a page at a time, so
+    memory use doesn't grow with the size of the result set
+    """
+    filter_str, after, page_size = _search_results_params(request)
+
+    pages = _search_result_pages(instance, request.user, filter_str, after,
+                                 page_size)
+
+    def lines():
+        for page in pages:
+            for result in page:
+                yield json.dumps(result) + '\n'
+
+    return StreamingHttpResponse(lines(),
+                                 content_type='application/x-ndjson')
+
+
+def search_results_endpoint(request, instance):
+    try:
+        if request.REQUEST.get('format') == 'ndjson':
+            return search_results_stream(request, instance)
+        else:
+            return json_api_call(search_results)(request, instance)
+    except ValidationError as e:
+        return bad_request_json_response('; '.join(e.messages))
+    except ValueError:
+        return bad_request_json_response('Filters must be valid JSON')
+    except ParseException as e:
+        return bad_request_json_response(e.message)
 
 
 def _format_benefits(instance, benefits, num_calculated_trees,
@@ -926,8 +1233,17 @@ def _format_benefits(instance, benefits, num_calculated_trees,
             benefit['currency_saved'] = currency_symbol + number_format(
                 benefit['currency'], decimal_pos=0)
 
+            if 'currency_margin' in benefit:
+                benefit['currency_margin'] = currency_symbol + number_format(
+                    benefit['currency_margin'], decimal_pos=0)
+
         _, value = get_display_value(instance, 'eco', key, benefit['value'])
         benefit['value'] = value
+
+        if 'margin' in benefit:
+            _, margin = get_display_value(instance, 'eco', key,
+                                          benefit['margin'])
+            benefit['margin'] = margin
         benefit['label'] = get_benefit_label(key)
         benefit['unit'] = get_units(instance, 'eco', key)
 
@@ -939,6 +1255,9 @@ def _format_benefits(instance, benefits, num_calculated_trees,
         percent = float(num_calculated_trees) / total_trees
         for key in benefits:
             benefits[key]['value'] /= percent
+            if 'margin' in benefits[key]:
+                benefits[key]['margin'] /= percent
+                benefits[key]['currency_margin'] /= percent
 
     currency = None
     if instance.eco_benefits_conversion:
@@ -954,7 +1273,10 @@ def _format_benefits(instance, benefits, num_calculated_trees,
             'tree_basis': {'n_trees_used': num_calculated_trees,
                            'n_trees_total': total_trees,
                            'n_plots': total_plots,
-                           'percent': percent},
+                           'percent': percent,
+                           # Estimated from a sample of the trees
+                           'sampled': any('margin' in b
+                                          for b in benefits.itervalues())},
             'resource_benefits': None,
             'resource_basis': {'n_resources_used': 0,
                                'n_resources_total': 0,
@@ -1112,6 +1434,8 @@ def _photo_audits(instance):
                                   model_id__in=photo_ids)\
                           .order_by('-created')
 
+    # Photos wait for review however old they are, so archived audits
+    # are included
     return audits
 
 
@@ -1274,7 +1598,8 @@ tree_detail_view = instance_request(tree_detail)
 
 edits_view = instance_request(
     requires_feature('recent_edits_report')(
-        render_template('treemap/edits.html', edits)))
+        return_400_if_validation_errors(
+            render_template('treemap/edits.html', edits))))
 
 index_view = instance_request(index)
 
@@ -1345,14 +1670,20 @@ search_tree_benefits_view = instance_request(
 
 species_list_view = json_api_call(instance_request(species_list))
 
+search_facets_view = json_api_call(instance_request(search_facets))
+
+search_counts_view = json_api_call(instance_request(search_counts))
+
+search_results_view = instance_request(search_results_endpoint)
+
 user_view = render_template("treemap/user.html", user)
 
 update_user_view = require_http_method("PUT")(
     username_matches_request_user(
         json_api_call(update_user)))
 
-user_audits_view = render_template("treemap/recent_user_edits.html",
-                                   user_audits)
+user_audits_view = return_400_if_validation_errors(
+    render_template("treemap/recent_user_edits.html", user_audits))
 
 upload_user_photo_view = require_http_method("POST")(
     username_matches_request_user(